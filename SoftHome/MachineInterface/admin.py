@@ -1,6 +1,6 @@
 from django.contrib import admin
-from .models import Sensor, Light, Scene, WIFILocation, PhilipsHueBridge, Outlet
+from .models import Sensor, Light, Scene, SceneLightState, WIFILocation, PhilipsHueBridge, Outlet
 # Register your models here.
 
 
-admin.site.register([Sensor, Light, Scene, WIFILocation, PhilipsHueBridge, Outlet])
\ No newline at end of file
+admin.site.register([Sensor, Light, Scene, SceneLightState, WIFILocation, PhilipsHueBridge, Outlet])
\ No newline at end of file
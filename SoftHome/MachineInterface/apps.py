@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class MachineinterfaceConfig(AppConfig):
     name = 'MachineInterface'
+
+    def ready(self):
+        from . import signals
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from MachineInterface.pollers import SensorPollDaemon
+
+
+class Command(BaseCommand):
+    help = 'Poll the sensors of every Philips Hue bridge and record their state changes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+                            help='Poll each bridge once instead of running until stopped')
+
+    def handle(self, *args, **options):
+        daemon = SensorPollDaemon()
+        if not options['once']:
+            daemon.run()
+            return
+        daemon.load()
+        for poller in daemon.pollers.values():
+            written = poller.poll()
+            self.stdout.write('{0}: {1} sensors changed'.format(poller.bridge, len(written)))
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from MachineInterface.models import PhilipsHueBridge
+from MachineInterface.sync import BridgeSyncWorker, sync_bridge
+
+
+class Command(BaseCommand):
+    help = 'Sync lights, sensors and groups from every Philips Hue bridge'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true',
+                            help='Keep running and sync each bridge on its sync_interval or when a page asks for it')
+        parser.add_argument('--full', action='store_true',
+                            help='Rewrite every device instead of only those that changed')
+
+    def handle(self, *args, **options):
+        if options['loop']:
+            BridgeSyncWorker().run()
+            return
+        for bridge in PhilipsHueBridge.objects.filter(enabled=True):
+            sync_bridge(bridge, incremental=not options['full'])
+            self.stdout.write('{0}: synced in {1:.2f} s'.format(bridge, bridge.last_sync_duration))
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.3 on 2026-10-18 09:12
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('MachineInterface', '0007_auto_20170206_0351'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='philipshuebridge',
+            name='last_sync',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='philipshuebridge',
+            name='last_sync_duration',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='philipshuebridge',
+            name='last_sync_error',
+            field=models.CharField(blank=True, max_length=200, null=True),
+        ),
+        migrations.AddField(
+            model_name='philipshuebridge',
+            name='sync_interval',
+            field=models.PositiveIntegerField(default=300),
+        ),
+    ]
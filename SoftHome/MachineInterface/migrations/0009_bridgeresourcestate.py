@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.3 on 2026-10-18 09:40
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Portal', '0003_auto_20170202_0002'),
+        ('MachineInterface', '0008_philipshuebridge_sync'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BridgeResourceState',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('resource', models.CharField(max_length=20)),
+                ('index', models.PositiveSmallIntegerField(default=0)),
+                ('digest', models.CharField(max_length=40)),
+                ('last_changed', models.DateTimeField()),
+                ('controller', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='resource_states', to='Portal.Device')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='bridgeresourcestate',
+            unique_together=set([('controller', 'resource', 'index')]),
+        ),
+    ]
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.3 on 2026-10-18 14:20
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Portal', '0003_auto_20170202_0002'),
+        ('MachineInterface', '0009_bridgeresourcestate'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='scene',
+            name='bridge_scene_id',
+            field=models.CharField(blank=True, max_length=32, null=True),
+        ),
+        migrations.AddField(
+            model_name='scene',
+            name='controller',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='scenes', to='Portal.Device'),
+        ),
+        migrations.AddField(
+            model_name='scene',
+            name='group_index',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='SceneLightState',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('on', models.BooleanField(default=True)),
+                ('brightness', models.PositiveSmallIntegerField(blank=True, null=True)),
+                ('color_temperature', models.PositiveSmallIntegerField(blank=True, null=True)),
+                ('light', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='scene_states', to='MachineInterface.Light')),
+                ('scene', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='light_states', to='MachineInterface.Scene')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='scenelightstate',
+            unique_together=set([('scene', 'light')]),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.3 on 2026-10-18 15:05
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('MachineInterface', '0010_scene_engine'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='scene',
+            name='bridge_digest',
+            field=models.CharField(blank=True, max_length=40, null=True),
+        ),
+        migrations.AddField(
+            model_name='scene',
+            name='bridge_last_updated',
+            field=models.CharField(blank=True, max_length=30, null=True),
+        ),
+    ]
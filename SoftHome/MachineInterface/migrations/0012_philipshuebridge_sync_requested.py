@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.3 on 2026-10-18 18:05
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('MachineInterface', '0011_scene_bridge_sync'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='philipshuebridge',
+            name='sync_requested',
+            field=models.BooleanField(default=False),
+        ),
+    ]
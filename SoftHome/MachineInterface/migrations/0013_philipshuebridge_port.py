@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.3 on 2026-10-18 19:10
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('MachineInterface', '0012_philipshuebridge_sync_requested'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='philipshuebridge',
+            name='port',
+            field=models.PositiveIntegerField(default=80),
+        ),
+    ]
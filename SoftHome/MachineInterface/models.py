@@ -1,11 +1,26 @@
-import json
+import sys
+sys.path.append('/var/www/modules')
+
+import concurrent.futures
+import contextlib
+import logging
 import socket
-import http.client as httplib
 from decimal import *
-from django.db import models
+from django.conf import settings
+from django.db import models, transaction
 from django.apps import apps
 from django.contrib.auth.models import User
+from django.utils import timezone
 from Portal.models import Device
+from . import reconcile
+from .registry import registry
+import hue_async
+import hue_batch
+import hue_names
+import hue_pool
+import hue_throttle
+
+logger = logging.getLogger(__name__)
 
 
 class WIFILocation(Device):
@@ -33,45 +48,68 @@ class Sensor(Device):
     def __str__(self):
         return self.name
 
+    @staticmethod
+    def parse_state(state):
+        """ The stored state value of a sensor's 'state' object from the bridge """
+        for key in state:
+            if key != 'lastupdated':
+                if state[key] in (None, False, 'false'):
+                    return 0
+                elif state[key] in (True, 'true'):
+                    return 1
+                else:
+                    return Decimal(state[key])
+        return 0
+
+    @staticmethod
+    def philips_version(sensor):
+        """ Changes whenever the bridge updates a sensor's state """
+        last_updated = sensor['state'].get('lastupdated')
+        if last_updated in (None, 'none'):
+            return reconcile.digest(sensor['state'])
+        return last_updated
+
+    @classmethod
+    def philips_fields(cls, sensor, controller):
+        """ Model fields for one sensor of a bridge /sensors payload """
+        state_value = cls.parse_state(sensor['state'])
+
+        return {
+            'user_id': controller.user_id,
+            'type': sensor['type'],
+            'model_id': sensor['modelid'],
+            'unique_id': sensor.get('uniqueid'),
+            'name': sensor['name'],
+            'device_type': 'sensor',
+            'api': 'philips',
+            'state': state_value,
+            'reachable': True,
+            'ip_address': controller.ip_address,
+            'mac_address': controller.mac_address,
+        }
+
+    def history_row(self):
+        """ The analytics history (model name, fields) for the current state, or None """
+        if self.type == 'ZLLPresence':
+            return 'MotionSensorHistory', {'sensor_id': self.pk, 'state': bool(self.state)}
+        if self.type == 'ZLLTemperature':
+            # the bridge reports hundredths of a degree
+            return 'TemperatureSensorHistory', {'sensor_id': self.pk, 'temperature': Decimal(self.state) / 100}
+        if self.type == 'ZLLLightLevel':
+            return 'LightSensorHistory', {'sensor_id': self.pk, 'level': min(int(self.state), 32767)}
+        return None
+
     @classmethod
-    def import_all(cls, api, controller):
-        new_sensors = []
+    def import_all(cls, api, controller, sensors=None, present=None):
+        """ Reconcile this controller's sensors with the bridge, returns a Reconciliation.
+        sensors may hold only the changed sensors if present lists every index still on the bridge.
+        """
         if api == 'philips':
-            sensors = controller.get_sensor()
-            for sensor in sensors:
-                state_value = 0
-                for key in sensors[sensor]['state']:
-                    if key != 'lastupdated':
-                        state = key
-                        if sensors[sensor]['state'][state] == 'false':
-                            state_value = 0
-                        elif sensors[sensor]['state'][state] == 'true':
-                            state_value = 1
-                        else:
-                            state_value = Decimal(sensors[sensor]['state'][state])
-                        break
-
-                new_sensor, created = cls.objects.update_or_create(
-                    user=controller.user,
-                    type=sensors[sensor]['type'],
-                    model_id=sensors[sensor]['modelid'],
-                    unique_id=sensors[sensor].get('uniqueid'),
-                    controller=controller.philips_device,
-                    controller_index=int(sensor),
-                    name=sensors[sensor]['name'],
-                    device_type='sensor',
-                    api=api,
-                    defaults={
-                        'state': state_value,
-                        'reachable': True,
-                        'ip_address': controller.ip_address,
-                        'mac_address': controller.mac_address,
-                    }
-                    )
-
-                new_sensors.append(new_sensor)
-                new_sensors[-1].save()
-        return new_sensors
+            if sensors is None:
+                sensors = controller.get_sensor()
+            rows = dict((int(sensor), cls.philips_fields(sensors[sensor], controller)) for sensor in sensors)
+            return reconcile.reconcile(cls, controller, rows, present)
+        return reconcile.Reconciliation()
 
 
 class Light(Device):
@@ -89,95 +127,156 @@ class Light(Device):
     controller = models.ForeignKey("Portal.Device", related_name='light_controller', null=True, blank=True)
     controller_index = models.PositiveSmallIntegerField(default=0)   # #pk used by 3rd party controller
 
+    # bridge state parameter -> model field
+    STATE_FIELDS = {'on': 'state', 'bri': 'brightness', 'ct': 'color_temperature'}
+
     def __str__(self):
         return self.name
 
     @classmethod
-    def import_all(cls, api, controller):
-        new_lights = []
+    def philips_fields(cls, light, controller):
+        """ Model fields for one light of a bridge /lights payload """
+        color_ct = 153
+        color_cie = '[0.31306, 0.32318]'
+        if 'ct' in light['state']:
+            color_ct = int(light['state']['ct'])
+            color_cie = cls.convert_color(light['state']['ct'])
+        elif 'xy' in light['state']:
+            color_cie = light['state']['xy']
+            color_ct = cls.convert_color(int(light['state']['xy']))
+
+        return {
+            'user_id': controller.user_id,
+            'model_id': light['modelid'],
+            'unique_id': light['uniqueid'],
+            'name': light['name'],
+            'device_type': 'light bulb',
+            'api': 'philips',
+            'state': light['state']['on'],
+            'brightness': int(light['state']['bri']),
+            'color_temperature': color_ct,
+            'color_cie_xy': color_cie,
+            'colormode': light['state']['colormode'],
+            'alert': light['state']['alert'],
+            'reachable': light['state']['reachable'],
+            'type': light['type'],
+            'ip_address': controller.ip_address,
+            'mac_address': controller.mac_address,
+        }
+
+    @classmethod
+    def import_all(cls, api, controller, lights=None, present=None):
+        """ Reconcile this controller's lights with the bridge, returns a Reconciliation.
+        lights may hold only the changed lights if present lists every index still on the bridge.
+        """
         if api == 'philips':
-            lights = controller.get_light()
-            for light in lights:
-                color_ct = 153
-                color_cie = '[0.31306, 0.32318]'
-                if 'ct' in lights[light]['state']:
-                    color_ct = int(lights[light]['state']['ct'])
-                    color_cie = cls.convert_color(lights[light]['state']['ct'])
-                elif 'xy' in lights[light]['state']:
-                    color_cie = lights[light]['state']['xy']
-                    color_ct = cls.convert_color(int(lights[light]['state']['xy']))
-
-                new_light, created = cls.objects.update_or_create(
-                    user=controller.user,
-                    model_id=lights[light]['modelid'],
-                    unique_id=lights[light]['uniqueid'],
-                    controller=controller.philips_device,
-                    controller_index=int(light),
-                    name=lights[light]['name'],
-                    device_type='light bulb',
-                    api=api,
-                    defaults={
-                        'state': lights[light]['state']['on'],
-                        'brightness': int(lights[light]['state']['bri']),
-                        'color_temperature': color_ct,
-                        'color_cie_xy': color_cie,
-                        'colormode': lights[light]['state']['colormode'],
-                        'alert': lights[light]['state']['alert'],
-                        'reachable': lights[light]['state']['reachable'],
-                        'type': lights[light]['type'],
-                        'ip_address': controller.ip_address,
-                        'mac_address': controller.mac_address,
-                    }
-                    )
-                new_lights.append(new_light)
-                new_lights[-1].save()
-        return new_lights
+            if lights is None:
+                lights = controller.get_light()
+            rows = dict((int(light), cls.philips_fields(lights[light], controller)) for light in lights)
+            return reconcile.reconcile(cls, controller, rows, present)
+        return reconcile.Reconciliation()
 
-    def on(self, transition_time=None):
+    def hub(self):
+        """ The bridge controlling this light, resolved from the process registry """
+        return registry.bridge(self.controller_id)
+
+    _pending = None
+
+    def _command(self, parameter, value, transition_time=None):
+        if self._pending is not None:
+            self._pending[parameter] = value
+            return None
+        return self._send({parameter: value}, transition_time)
+
+    def _send(self, data, transition_time=None):
         if self.api == 'philips':
-            hub = PhilipsHueBridge.objects.get(device=self.controller.philips_device)
-            result = hub.set_light(self.controller_index, 'on', True, transition_time)
-            if 'error' in list(result[-1][0].keys()):
+            result = self.hub().set_light(self.controller_index, dict(data), None, transition_time)
+            if any('error' in line for line in result[-1]):
                 return False
             else:
-                self.state = True
-                self.save()
+                self.remember(**dict((self.STATE_FIELDS[parameter], value) for parameter, value in data.items()))
                 return True
 
+    @contextlib.contextmanager
+    def batch(self, transition_time=None):
+        """ Send every command issued inside the block as one state write when it ends:
+            >>> with light.batch(transition_time=4):
+            ...     light.on()
+            ...     light.set_brightness(200)
+            ...     light.set_color(300)
+        Commands inside the block return None; nothing is sent if it raises.
+        """
+        if self._pending is not None:
+            raise RuntimeError('{0} is already in a batch'.format(self))
+        self._pending = {}
+        try:
+            yield self
+        except BaseException:
+            self._pending = None
+            raise
+        data, self._pending = self._pending, None
+        if data:
+            self._send(data, transition_time)
+
+    def remember(self, **fields):
+        """ Persist only the state fields that changed """
+        changed = [field for field, value in fields.items() if getattr(self, field) != value]
+        for field in changed:
+            setattr(self, field, fields[field])
+        if changed:
+            self.save(update_fields=changed + ['last_updated'])
+
+    def on(self, transition_time=None):
+        return self._command('on', True, transition_time)
+
     def off(self, transition_time=None):
-        if self.api == 'philips':
-            hub = PhilipsHueBridge.objects.get(device=self.controller.philips_device)
-            result = hub.set_light(self.controller_index, 'on', False, transition_time)
-            if 'error' in list(result[-1][0].keys()):
-                return False
-            else:
-                self.state = False
-                self.save()
-                return True
+        return self._command('on', False, transition_time)
 
     def set_brightness(self, brightness, percentage=False, transition_time=None):
         if percentage is True:
             brightness = brightness*255/100
-        if self.api == 'philips':
-            hub = PhilipsHueBridge.objects.get(device=self.controller.philips_device)
-            result = hub.set_light(self.controller_index, 'bri', brightness, transition_time)
-            if 'error' in list(result[-1][0].keys()):
-                return False
-            else:
-                self.brightness = brightness
-                self.save()
-                return True
+        return self._command('bri', brightness, transition_time)
 
     def set_color(self, ct, transition_time=None):
-        if self.api == 'philips':
-            hub = PhilipsHueBridge.objects.get(device=self.controller.philips_device)
-            result = hub.set_light(self.controller_index, 'ct', ct, transition_time)
-            if 'error' in list(result[-1][0].keys()):
-                return False
-            else:
-                self.ct = ct
-                self.save()
-                return True
+        return self._command('ct', ct, transition_time)
+
+    @classmethod
+    def set_many(cls, lights, parameter, value=None, transition_time=None):
+        """ Set one parameter on many lights, across bridges.
+        Each bridge's share goes through PhilipsHueBridge.set_light, so it is
+        batched into group actions and paced by the bridge's command queue;
+        bridges are written in parallel.
+        Returns {light pk: True|False} for every philips light passed in.
+        """
+        by_hub = {}
+        for light in lights:
+            if light.api == 'philips':
+                by_hub.setdefault(light.controller_id, []).append(light)
+        if not by_hub:
+            return {}
+
+        def send(hub_id):
+            try:
+                return registry.bridge(hub_id).set_light([light.controller_index for light in by_hub[hub_id]],
+                                                         parameter, value, transition_time)
+            except Exception:
+                logger.exception("set_many on bridge {0} failed".format(hub_id))
+                return None
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(by_hub)) as executor:
+            results = dict(zip(by_hub, executor.map(send, list(by_hub))))
+
+        success = {}
+        field = cls.STATE_FIELDS.get(parameter)
+        for hub_id, hub_lights in by_hub.items():
+            result = results[hub_id]
+            for light, light_result in zip(hub_lights, result if isinstance(result, list) else []):
+                success[light.pk] = bool(light_result) and all('error' not in line for line in light_result)
+                if success[light.pk] and field is not None:
+                    light.remember(**{field: value})
+            for light in hub_lights:
+                success.setdefault(light.pk, False)
+        return success
 
     @staticmethod
     def convert_color(color):
@@ -203,22 +302,78 @@ class Scene(models.Model):
     brightness = models.PositiveSmallIntegerField(default=0)
     picture = models.FileField(max_length=200, null=True, blank=True)
     last_updated = models.DateTimeField(auto_now=True)
+    controller = models.ForeignKey("Portal.Device", related_name='scenes', null=True, blank=True)
+    group_index = models.PositiveSmallIntegerField(default=0)   # #bridge group the scene belongs to, 0 = all lights
+    bridge_scene_id = models.CharField(max_length=32, null=True, blank=True)   # #id when stored on the bridge
+    bridge_digest = models.CharField(max_length=40, null=True, blank=True)   # #hash of the body last stored
+    bridge_last_updated = models.CharField(max_length=30, null=True, blank=True)   # #bridge lastupdated after that
 
     def __str__(self):
         return self.name
 
+    def group_payload(self):
+        """ State for every light of the group, used when the scene has no per-light states """
+        data = {'on': True}
+        if self.brightness:
+            data['bri'] = self.brightness
+        if self.ct:
+            data['ct'] = self.ct
+        return data
+
+
+class SceneLightState(models.Model):
+    scene = models.ForeignKey(Scene, related_name='light_states')
+    light = models.ForeignKey("MachineInterface.Light", related_name='scene_states')
+    on = models.BooleanField(default=True)
+    brightness = models.PositiveSmallIntegerField(null=True, blank=True)
+    color_temperature = models.PositiveSmallIntegerField(null=True, blank=True)
+
+    class Meta:
+        unique_together = ('scene', 'light')
+
+    def __str__(self):
+        return '{0}: {1}'.format(self.scene, self.light)
+
+    def payload(self):
+        """ Bridge state for this light; brightness and color are left alone when unset or off """
+        data = {'on': self.on}
+        if self.on:
+            if self.brightness is not None:
+                data['bri'] = self.brightness
+            if self.color_temperature is not None:
+                data['ct'] = self.color_temperature
+        return data
+
+    def light_fields(self):
+        """ Light model fields the payload sets """
+        return dict((Light.STATE_FIELDS[parameter], value) for parameter, value in self.payload().items())
+
 
 class PhilipsHueBridge(Device):
     device = models.OneToOneField(Device, parent_link=True, related_name='philips_device')
     bridge_user = models.CharField(max_length=100, default='None')
     bridge_id = models.CharField(max_length=100, default='None')
     swversion = models.CharField(max_length=50, default='None')
+    sync_interval = models.PositiveIntegerField(default=300)   # #seconds between background syncs
+    last_sync = models.DateTimeField(null=True, blank=True)
+    last_sync_duration = models.FloatField(default=0)
+    last_sync_error = models.CharField(max_length=200, null=True, blank=True)
+    sync_requested = models.BooleanField(default=False)   # #picked up by the sync worker, wherever it runs
+    port = models.PositiveIntegerField(default=80)
 
     def __str__(self):
         return self.name
 
+    @property
+    def host(self):
+        """ 'ip', 'ip:port' or '[IPv6]:port' of the bridge's REST API, as http.client expects it """
+        host = '[{0}]'.format(self.ip_address) if ':' in self.ip_address else self.ip_address
+        if self.port != 80:
+            host += ':{0}'.format(self.port)
+        return host
+
     @classmethod
-    def register(cls, ip_address):
+    def register(cls, ip_address, port=80):
         try:
             user = User.objects.get(username='default_machine')
         except User.DoesNotExist:
@@ -228,6 +383,7 @@ class PhilipsHueBridge(Device):
         bridge = cls.objects.create(user=user,
                                     name='Philips Hue Bridge',
                                     ip_address=ip_address,
+                                    port=port,
                                     device_type='controller',
                                     api='philips'
                                     )
@@ -252,30 +408,122 @@ class PhilipsHueBridge(Device):
         return bridge
 
     def request(self, mode='GET', address=None, data=None):
-        """ Utility function for HTTP GET/PUT requests for the API"""
-        connection = httplib.HTTPConnection(self.ip_address, timeout=10)
-
+        """ Utility function for HTTP GET/PUT requests for the API.
+        Requests share a keep-alive connection pool per bridge host. """
         try:
-            if mode == 'GET' or mode == 'DELETE':
-                connection.request(mode, address)
-            if mode == 'PUT' or mode == 'POST':
-                connection.request(mode, address, json.dumps(data))
-
+            return hue_pool.request(self.host, mode, address, data)
         except socket.timeout:
-            error = "{} Request to {}{} timed out.".format(mode, self.ip, address)
+            error = "{} Request to {}{} timed out.".format(mode, self.host, address)
             raise TimeoutError(None, error)
 
-        result = connection.getresponse()
-        connection.close()
+    def pool_stats(self):
+        return hue_pool.get_pool(self.host).stats()
+
+    def command_queue(self):
+        """ Paced, coalescing queue for light state and group action writes to this bridge.
+        Rate settings: HUE_COMMAND_RATE (per second), HUE_COMMAND_BURST, HUE_GROUP_COMMAND_COST
+        """
+        request = self.request
+        base = '/api/' + self.bridge_user
+
+        def send(kind, target, data):
+            if kind == 'group':
+                return request('PUT', base + '/groups/' + target + '/action', data)
+            return request('PUT', base + '/lights/' + target + '/state', data)
+
+        return hue_throttle.get_queue(self.host + base, send,
+                                      rate=getattr(settings, 'HUE_COMMAND_RATE', 10),
+                                      burst=getattr(settings, 'HUE_COMMAND_BURST', None),
+                                      group_cost=getattr(settings, 'HUE_GROUP_COMMAND_COST', 1))
+
+    def names(self):
+        """ Name <-> id index of this bridge, shared with phue clients of the same bridge, see modules/hue_names.py """
+        return hue_names.get_index(self.host, self.bridge_user)
 
-        return json.loads(str(result.read(), encoding='utf-8'))
+    def async_client(self, max_concurrency=4):
+        """ asyncio client for this bridge, see modules/hue_async.py """
+        return hue_async.AsyncBridge(self.host, self.bridge_user, max_concurrency)
 
     def import_all(self):
         LightGroup = apps.get_model('operations', 'LightGroup')
         lights = Light.import_all(self.api, self)
         sensors = Sensor.import_all(self.api, self)
         groups = LightGroup.import_all(self.api, self)
-        return {'lights': lights, 'sensors': sensors, 'groups': groups}
+        for resource, objects in (('lights', lights), ('sensors', sensors), ('groups', groups)):
+            self.names().load(resource, dict((obj.controller_index, {'name': obj.name}) for obj in objects))
+        return {
+            'lights': lights,
+            'sensors': sensors,
+            'groups': groups,
+            'import_counts': {
+                'lights': lights.counts(),
+                'sensors': sensors.counts(),
+                'groups': groups.counts(),
+            },
+        }
+
+    def synced_devices(self):
+        """ Lights, sensors and groups of this bridge as stored by the last sync """
+        LightGroup = apps.get_model('operations', 'LightGroup')
+        return {
+            'lights': Light.objects.filter(controller_id=self.pk).order_by('controller_index'),
+            'sensors': Sensor.objects.filter(controller_id=self.pk).order_by('controller_index'),
+            'groups': LightGroup.objects.filter(controller_id=self.pk).order_by(
+                'controller_index').prefetch_related('lights__light_device'),
+        }
+
+    def import_changes(self):
+        """ Incremental sync from one GET of the full bridge state.
+        Each light, sensor and group is hashed and only resources whose hash
+        differs from the one stored at the last sync are written, so a bridge
+        where nothing changed costs one request, one query and no writes.
+        """
+        LightGroup = apps.get_model('operations', 'LightGroup')
+        state = self.request('GET', '/api/' + self.bridge_user)
+        self.names().load_state(state)
+        stored = dict(((record.resource, record.index), record)
+                      for record in BridgeResourceState.objects.filter(controller_id=self.pk))
+
+        now = timezone.now()
+        changed = {}
+        present = {}
+        new_records = []
+        changed_records = []
+        for resource in BridgeResourceState.RESOURCES:
+            payload = state.get(resource, {})
+            changed[resource] = {}
+            present[resource] = set(int(index) for index in payload)
+            for index in payload:
+                resource_digest = reconcile.digest(payload[index])
+                record = stored.get((resource, int(index)))
+                if record is None:
+                    new_records.append(BridgeResourceState(controller_id=self.pk, resource=resource, index=int(index),
+                                                           digest=resource_digest, last_changed=now))
+                elif record.digest != resource_digest:
+                    record.digest = resource_digest
+                    record.last_changed = now
+                    changed_records.append(record)
+                else:
+                    continue
+                changed[resource][index] = payload[index]
+        removed = [(resource, record.pk) for (resource, index), record in stored.items()
+                   if index not in present[resource]]
+
+        result = {}
+        with transaction.atomic():
+            for resource, model in (('lights', Light), ('sensors', Sensor), ('groups', LightGroup)):
+                if changed[resource] or resource in dict(removed):
+                    result[resource] = model.import_all(self.api, self, changed[resource], present[resource])
+                else:
+                    result[resource] = reconcile.Reconciliation(unchanged=len(present[resource]))
+            BridgeResourceState.objects.bulk_create(new_records)
+            for record in changed_records:
+                record.save(update_fields=['digest', 'last_changed'])
+            if removed:
+                BridgeResourceState.objects.filter(pk__in=[pk for resource, pk in removed]).delete()
+
+        result['import_counts'] = dict((resource, result[resource].counts()) for resource in BridgeResourceState.RESOURCES)
+        return result
 
     def update_config(self):
         address = '/api/' + self.bridge_user + '/config/'
@@ -293,7 +541,9 @@ class PhilipsHueBridge(Device):
         if isinstance(light_id, str):
             light_id = self.get_light_id_by_name(light_id)
         if light_id is None:
-            return self.request('GET', '/api/' + self.bridge_user + '/lights/')
+            lights = self.request('GET', '/api/' + self.bridge_user + '/lights/')
+            self.names().load('lights', lights)
+            return lights
         state = self.request('GET', '/api/' + self.bridge_user + '/lights/' + str(light_id))
         if parameter is None:
             return state
@@ -307,11 +557,7 @@ class PhilipsHueBridge(Device):
 
     def get_light_id_by_name(self, name):
         """ Lookup a light id based on string name. Case-sensitive. """
-        lights = self.get_light()
-        for light_id in lights:
-            if name == lights[light_id]['name']:
-                return light_id
-        return False
+        return self.names().id_for('lights', name, self.get_light)
 
     def set_light(self, light_id, parameter, value=None, transitiontime=None):
         """ Adjust properties of one or more lights.
@@ -334,28 +580,102 @@ class PhilipsHueBridge(Device):
         light_id_array = light_id
         if isinstance(light_id, int) or isinstance(light_id, str):
             light_id_array = [light_id]
-        result = []
-        for light in light_id_array:
-            if parameter == 'name':
-                result.append(self.request('PUT', '/api/' + self.bridge_user + '/lights/' + str(light_id), data))
-            else:
-                if isinstance(light, str):
-                    converted_light = self.get_light_id_by_name(light)
+        if parameter == 'name':
+            result = []
+            for light in light_id_array:
+                result.append(self.request('PUT', '/api/' + self.bridge_user + '/lights/' + str(light), data))
+                if 'success' in result[-1][0]:
+                    self.names().rename('lights', light, value)
+            return result
+
+        return self.set_light_states([(light, data) for light in light_id_array])
+
+    def set_light_states(self, states):
+        """ Apply a list of (light_id, data) pairs with as few requests as possible.
+        Lights sharing a payload are written with one group action (group 0 or an
+        existing LightGroup with the same lights while the stored memberships are
+        fresh, or a temporary group), mixed payloads fall back to one PUT per light.
+        Returns one response per pair, shaped like PUT /lights/<id>/state.
+        """
+        converted_states = []
+        for light, data in states:
+            if isinstance(light, str):
+                light = self.get_light_id_by_name(light)
+            converted_states.append((str(light), data))
+
+        all_lights = None
+        groups = None
+        if len(set(str(light) for light, data in converted_states)) > 1 and self.memberships_fresh():
+            all_lights, groups = self.get_light_memberships()
+        plan = hue_batch.plan_light_writes(converted_states, all_lights, groups)
+
+        adhoc_groups = []
+        light_results = {}
+        try:
+            # queue every write first so the bridge queue can pace them as one burst
+            pending = []
+            for kind, target, data, lights in plan:
+                if kind == 'adhoc':
+                    target = self._create_adhoc_group(lights)
+                    if target is None:
+                        kind = 'light'
+                    else:
+                        adhoc_groups.append(target)
+                if kind == 'light':
+                    for light in lights:
+                        pending.append(('light', light, data, [light], self.command_queue().submit('light', light, data)))
                 else:
-                    converted_light = light
-                result.append(self.request(
-                    'PUT', '/api/' + self.bridge_user + '/lights/' + str(converted_light) + '/state', data))
+                    pending.append((kind, target, data, lights, self.command_queue().submit('group', target, data)))
+
+            for kind, target, data, lights, future in pending:
+                try:
+                    response = future.result()
+                except hue_throttle.CommandDropped:
+                    address = '/lights/{0}/state' if kind == 'light' else '/groups/{0}/action'
+                    response = hue_throttle.dropped_response(address.format(target))
+                if kind == 'light':
+                    light_results[(target, hue_batch.payload_key(data))] = response
+                    continue
+                for light, light_result in hue_batch.expand_group_result(response, target, lights).items():
+                    light_results[(light, hue_batch.payload_key(data))] = light_result
+        finally:
+            # bridges only hold a few dozen groups, never leave one behind
+            for group_id in adhoc_groups:
+                self.delete_group(group_id)
+
+        return [light_results[(light, hue_batch.payload_key(data))] for light, data in converted_states]
+
+    def memberships_fresh(self):
+        """ True while the stored lights and groups are from a sync within sync_interval.
+        Writes to group 0 or a stored group only reach the intended lights while this holds. """
+        if self.last_sync is None or self.last_sync_error:
+            return False
+        return (timezone.now() - self.last_sync).total_seconds() < self.sync_interval
 
-        return result
+    def get_light_memberships(self):
+        """ Returns (light indexes, {group index: light indexes}) for this bridge as last synced """
+        LightGroup = apps.get_model('operations', 'LightGroup')
+        all_lights = Light.objects.filter(controller_id=self.pk).values_list('controller_index', flat=True)
+        groups = {}
+        members = LightGroup.lights.through.objects.filter(
+            lightgroup__controller_id=self.pk
+        ).values_list('lightgroup__controller_index', 'device__light_device__controller_index')
+        for group_index, light_index in members:
+            if light_index is not None:
+                groups.setdefault(group_index, set()).add(light_index)
+        return set(all_lights), groups
+
+    def _create_adhoc_group(self, lights):
+        """ Create a short-lived group for a batch write, returns its id or None """
+        result = self.create_group('SoftHome batch', lights)
+        if 'success' in result[0]:
+            return str(result[0]['success']['id'])
+        return None
 
     #  Sensors
     def get_sensor_id_by_name(self, name):
         """ Lookup a sensor id based on string name. Case-sensitive. """
-        sensors = self.get_sensor()
-        for sensor_id in sensors:
-            if name == sensors[sensor_id]['name']:
-                return sensor_id
-        return False
+        return self.names().id_for('sensors', name, self.get_sensor)
 
     def create_sensor(self, name, modelid, swversion, sensor_type,
                       uniqueid, manufacturername, state, config, recycle=False):
@@ -380,6 +700,7 @@ class PhilipsHueBridge(Device):
 
         if "success" in result[0].keys():
             new_id = result[0]["success"]["id"]
+            self.names().add('sensors', new_id, name)
             return new_id, None
         else:
             return None, result[0]
@@ -390,7 +711,9 @@ class PhilipsHueBridge(Device):
         if isinstance(sensor_id, str):
             sensor_id = self.get_sensor_id_by_name(sensor_id)
         if sensor_id is None:
-            return self.request('GET', '/api/' + self.bridge_user + '/sensors/')
+            sensors = self.request('GET', '/api/' + self.bridge_user + '/sensors/')
+            self.names().load('sensors', sensors)
+            return sensors
         data = self.request('GET', '/api/' + self.bridge_user + '/sensors/' + str(sensor_id))
 
         if isinstance(data, list):
@@ -411,6 +734,8 @@ class PhilipsHueBridge(Device):
             data = {parameter: value}
 
         result = self.request('PUT', '/api/' + self.bridge_user + '/sensors/' + str(sensor_id), data)
+        if 'name' in data and 'success' in result[0]:
+            self.names().rename('sensors', sensor_id, data['name'])
         return result
 
     def set_sensor_content(self, sensor_id, parameter, value=None, structure="state"):
@@ -434,6 +759,7 @@ class PhilipsHueBridge(Device):
         return result
 
     def delete_sensor(self, sensor_id):
+        self.names().remove('sensors', sensor_id)
         try:
             return self.request('DELETE', '/api/' + self.bridge_user + '/sensors/' + str(sensor_id))
         except:
@@ -447,7 +773,9 @@ class PhilipsHueBridge(Device):
             # logger.error('Group name does not exit')
             return
         if group_id is None:
-            return self.request('GET', '/api/' + self.bridge_user + '/groups/')
+            groups = self.request('GET', '/api/' + self.bridge_user + '/groups/')
+            self.names().load('groups', groups)
+            return groups
         if parameter is None:
             return self.request('GET', '/api/' + self.bridge_user + '/groups/' + str(group_id))
         elif parameter == 'name' or parameter == 'lights':
@@ -457,11 +785,7 @@ class PhilipsHueBridge(Device):
 
     def get_group_id_by_name(self, name):
         """ Lookup a group id based on string name. Case-sensitive. """
-        groups = self.get_group()
-        for group_id in groups:
-            if name == groups[group_id]['name']:
-                return group_id
-        return False
+        return self.names().id_for('groups', name, self.get_group)
 
     def set_group(self, group_id, parameter, value=None, transitiontime=None):
         """ Change light settings for a group
@@ -497,9 +821,17 @@ class PhilipsHueBridge(Device):
                 return
             if parameter == 'name' or parameter == 'lights':
                 result.append(self.request('PUT', '/api/' + self.bridge_user + '/groups/' + str(converted_group), data))
+                if parameter == 'name' and 'success' in result[-1][0]:
+                    self.names().rename('groups', converted_group, value)
             else:
-                result.append(self.request('PUT', '/api/' + self.bridge_user + '/groups/' +
-                                           str(converted_group) + '/action', data))
+                result.append((converted_group, self.command_queue().submit('group', converted_group, data)))
+        for i, line in enumerate(result):
+            if isinstance(line, tuple):
+                converted_group, future = line
+                try:
+                    result[i] = future.result()
+                except hue_throttle.CommandDropped:
+                    result[i] = hue_throttle.dropped_response('/groups/{0}/action'.format(converted_group))
 
         # if 'error' in list(result[-1][0].keys()):
             # logger.warn("ERROR: {0} for group {1}".format(result[-1][0]['error']['description'], group))
@@ -515,52 +847,71 @@ class PhilipsHueBridge(Device):
             List of lights to be in the group.
         """
         data = {'lights': [str(x) for x in lights], 'name': name}
-        return self.request('POST', '/api/' + self.bridge_user + '/groups/', data)
+        result = self.request('POST', '/api/' + self.bridge_user + '/groups/', data)
+        if 'success' in result[0]:
+            self.names().add('groups', result[0]['success']['id'], name)
+        return result
 
     def delete_group(self, group_id):
+        self.names().remove('groups', group_id)
         return self.request('DELETE', '/api/' + self.bridge_user + '/groups/' + str(group_id))
 
     # Scenes #####
-    def get_scene(self):
-        return self.request('GET', '/api/' + self.bridge_user + '/scenes')
+    def get_scene(self, scene_id=None):
+        if scene_id is None:
+            return self.request('GET', '/api/' + self.bridge_user + '/scenes')
+        return self.request('GET', '/api/' + self.bridge_user + '/scenes/' + str(scene_id))
+
+    def create_scene(self, data):
+        """ Store a scene on the bridge, returns its id or None """
+        result = self.request('POST', '/api/' + self.bridge_user + '/scenes', data)
+        if isinstance(result, list) and 'success' in result[0]:
+            return str(result[0]['success']['id'])
+        return None
+
+    def update_scene(self, scene_id, data):
+        return self.request('PUT', '/api/' + self.bridge_user + '/scenes/' + str(scene_id), data)
+
+    def delete_scene(self, scene_id):
+        return self.request('DELETE', '/api/' + self.bridge_user + '/scenes/' + str(scene_id))
 
     def activate_scene(self, group_id, scene_id):
         return self.request('PUT', '/api/' + self.bridge_user + '/groups/' +
                             str(group_id) + '/action',
                             {"scene": scene_id})
 
-    def run_scene(self, group_name, scene_name):
+    def run_scene(self, group_name, scene_name, transition_time=None):
         """Run a scene by group and scene name.
-        As of 1.11 of the Hue API the scenes are accessable in the
-        API. With the gen 2 of the official HUE app everything is
-        organized by room groups.
-        This provides a convenience way of activating scenes by group
-        name and scene name. If we find exactly 1 group and 1 scene
-        with the matching names, we run them.
-        If we find more than one we run the first scene who has
-        exactly the same lights defined as the group. This is far from
-        perfect, but is convenient for setting lights symbolically (and
-        can be improved later).
+        SoftHome scenes stored for this bridge are run by the local scene
+        engine (see scenes.py), which needs no lookup requests. Otherwise
+        the bridge's own scenes are searched: if exactly 1 scene has the
+        name it is run, if more than one does we run the first that
+        belongs to the group or has exactly the group's lights.
         """
-        groups = [x for x in self.groups if x.name == group_name]
-        scenes = [x for x in self.scenes if x.name == scene_name]
-        if len(groups) != 1:
-            # logger.warn("run_scene: More than 1 group found by name %s", group_name)
+        from .scenes import engine
+        group_id = self.get_group_id_by_name(group_name)
+        if group_id is False:
+            # logger.warn("run_scene: No group found by name %s", group_name)
+            return
+        scene = engine.find(self.pk, group_id, scene_name)
+        if scene is not None:
+            return engine.activate(scene, transition_time)
+
+        scenes = self.get_scene()
+        if not isinstance(scenes, dict):
             return
-        group = groups[0]
+        scenes = [(scene_id, scene) for scene_id, scene in scenes.items() if scene.get('name') == scene_name]
         if len(scenes) == 0:
             # logger.warn("run_scene: No scene found %s", scene_name)
             return
-        if len(scenes) == 1:
-            self.activate_scene(group.group_id, scenes[0].scene_id)
-            return True
-        # otherwise, lets figure out if one of the named scenes uses
-        # all the lights of the group
-        group_lights = sorted([x.light_id for x in group.lights])
-        for scene in scenes:
-            if group_lights == scene.lights:
-                self.activate_scene(group.group_id, scene.scene_id)
-                return True
+        if len(scenes) > 1:
+            group_lights = sorted(self.get_group(int(group_id), 'lights') or [], key=int)
+            scenes = [(scene_id, scene) for scene_id, scene in scenes
+                      if scene.get('group') == str(group_id) or sorted(scene.get('lights', []), key=int) == group_lights]
+            if not scenes:
+                return
+        self.activate_scene(group_id, scenes[0][0])
+        return True
 
     # Schedules #####
     def get_schedule(self, schedule_id=None, parameter=None):
@@ -603,6 +954,23 @@ class PhilipsHueBridge(Device):
         return self.request('DELETE', '/api/' + self.bridge_user + '/schedules/' + str(schedule_id))
 
 
+class BridgeResourceState(models.Model):
+    """ Hash of a bridge resource as of the last sync, used by PhilipsHueBridge.import_changes """
+    RESOURCES = ('lights', 'sensors', 'groups')
+
+    controller = models.ForeignKey("Portal.Device", related_name='resource_states')
+    resource = models.CharField(max_length=20)
+    index = models.PositiveSmallIntegerField(default=0)   # #pk used by 3rd party controller
+    digest = models.CharField(max_length=40)
+    last_changed = models.DateTimeField()
+
+    class Meta:
+        unique_together = ('controller', 'resource', 'index')
+
+    def __str__(self):
+        return '{0} {1}'.format(self.resource, self.index)
+
+
 class Outlet(Device):
     device = models.OneToOneField(Device, parent_link=True, related_name='outlet_device')
     controller = models.ForeignKey("Portal.Device", related_name='get_outlet', null=True, blank=True)
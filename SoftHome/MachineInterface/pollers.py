@@ -0,0 +1,225 @@
+import heapq
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from .models import Light, PhilipsHueBridge, Sensor
+import hue_events
+
+logger = logging.getLogger(__name__)
+
+MOTION_TYPES = ('ZLLPresence', 'CLIPPresence')
+
+
+class SensorPoller(object):
+
+    """ Polls /sensors of one bridge and writes only the sensors whose
+    lastupdated moved since the previous poll. Saves go through post_save,
+    which feeds analytics history and the rule engine.
+
+    The interval adapts to activity: motion drops it to fast and keeps it
+    there for hold seconds, after which each quiet poll doubles it up to
+    slow. Failed polls back off the same way, so an unreachable bridge is
+    not hammered. While the bridge's event stream is healthy (start_push())
+    changes arrive through it and polling drops to a consistency check
+    every consistency seconds.
+    """
+    def __init__(self, bridge, fast=1.0, slow=30.0, hold=60.0, consistency=300.0):
+        self.bridge = bridge
+        self.fast = fast
+        self.slow = slow
+        self.hold = hold
+        self.consistency = consistency
+        self.interval = fast
+        self.stream = None
+        self._lock = threading.Lock()
+        self.last_activity = None
+        self.versions = {}  # controller_index -> philips_version at the last poll
+        self.polls = 0
+        self.writes = 0
+        self.errors = 0
+
+    def poll(self):
+        """ Poll once, returns the sensors that were written """
+        self.polls += 1
+        try:
+            sensors = self.bridge.get_sensor()
+            if not isinstance(sensors, dict):
+                raise ValueError('Unexpected /sensors response: {0!r}'.format(sensors))
+        except Exception:
+            logger.exception("Polling sensors of bridge {0} failed".format(self.bridge.pk))
+            self.backoff()
+            return []
+
+        moved = {}
+        versions = {}
+        motion = False
+        for index, sensor in sensors.items():
+            version = Sensor.philips_version(sensor)
+            if self.versions.get(int(index)) != version:
+                moved[int(index)] = sensor
+                versions[int(index)] = version
+                if sensor['type'] in MOTION_TYPES and sensor['state'].get('presence'):
+                    motion = True
+
+        written = self.apply(moved)
+        # only now, so sensors whose write failed are compared again next poll
+        self.versions.update(versions)
+
+        now = time.time()
+        if motion:
+            self.last_activity = now
+        if self.stream is not None and self.stream.healthy():
+            self.interval = self.consistency
+        elif self.last_activity is not None and now - self.last_activity < self.hold:
+            self.interval = self.fast
+        else:
+            self.interval = min(self.interval * 2, self.slow)
+        return written
+
+    def backoff(self):
+        """ Count a failed poll and double the interval up to slow """
+        self.errors += 1
+        self.interval = min(self.interval * 2, self.slow)
+
+    def apply(self, sensors):
+        """ Write {controller_index: sensor payload} to the stored sensors that differ.
+        Payloads may be partial: reachable is only compared when config is present. """
+        written = []
+        if not sensors:
+            return written
+        with self._lock:
+            for obj in Sensor.objects.filter(controller_id=self.bridge.pk, controller_index__in=list(sensors)):
+                sensor = sensors[obj.controller_index]
+                fields = {'state': Sensor.parse_state(sensor['state'])}
+                if 'reachable' in sensor.get('config', {}):
+                    fields['reachable'] = sensor['config']['reachable']
+                changed = [name for name, value in fields.items() if getattr(obj, name) != value]
+                if changed:
+                    for name in changed:
+                        setattr(obj, name, fields[name])
+                    obj.save(update_fields=changed + ['last_updated'])
+                    written.append(obj)
+            self.writes += len(written)
+        return written
+
+    def start_push(self):
+        """ Follow the bridge's event stream in the background """
+        if self.stream is None or not self.stream.is_alive():
+            self.stream = hue_events.EventStream(self.bridge.ip_address, self.bridge.bridge_user, self.handle_events)
+            self.stream.start()
+        return self.stream
+
+    def stop_push(self):
+        if self.stream is not None:
+            self.stream.stop()
+            self.stream = None
+
+    def handle_events(self, updates):
+        """ Feed event stream updates through the same writes as polling """
+        sensors = {}
+        lights = {}
+        for resource, index, state in hue_events.v1_updates(updates):
+            if resource == 'sensors':
+                sensors.setdefault(index, {'state': {}})['state'].update(state)
+                if state.get('presence'):
+                    self.last_activity = time.time()
+            elif resource == 'lights':
+                lights.setdefault(index, {}).update(state)
+        try:
+            self.apply(sensors)
+            for light in Light.objects.filter(controller_id=self.bridge.pk, controller_index__in=list(lights)):
+                light.remember(**dict((Light.STATE_FIELDS[name], value)
+                                      for name, value in lights[light.controller_index].items()))
+        finally:
+            close_old_connections()
+
+    def stats(self):
+        return {
+            'interval': self.interval,
+            'polls': self.polls,
+            'writes': self.writes,
+            'errors': self.errors,
+            'last_activity': self.last_activity,
+            'push': self.stream.stats() if self.stream is not None else None,
+        }
+
+
+class SensorPollDaemon(threading.Thread):
+
+    """ Runs a SensorPoller per enabled bridge, each on its own adaptive
+    interval. Pollers are kept in a heap ordered by when they are next due,
+    and the bridge list is reloaded every reload seconds.
+    Intervals come from HUE_POLL_FAST, HUE_POLL_SLOW, HUE_POLL_HOLD and
+    HUE_POLL_CONSISTENCY; HUE_EVENT_STREAM = True also follows each bridge's
+    event stream.
+    """
+    def __init__(self, reload=60.0):
+        threading.Thread.__init__(self, name='hue-sensor-poll')
+        self.daemon = True
+        self.reload = reload
+        self.pollers = {}
+        self._heap = []
+        self._loaded = None
+        self._stopped = threading.Event()
+
+    def stop(self):
+        self._stopped.set()
+        for poller in self.pollers.values():
+            poller.stop_push()
+
+    def load(self):
+        bridges = dict((bridge.pk, bridge) for bridge in PhilipsHueBridge.objects.filter(enabled=True))
+        for pk in list(self.pollers):
+            if pk not in bridges:
+                self.pollers.pop(pk).stop_push()
+        now = time.time()
+        for pk, bridge in bridges.items():
+            if pk in self.pollers:
+                self.pollers[pk].bridge = bridge
+            else:
+                self.pollers[pk] = SensorPoller(bridge,
+                                                fast=getattr(settings, 'HUE_POLL_FAST', 1.0),
+                                                slow=getattr(settings, 'HUE_POLL_SLOW', 30.0),
+                                                hold=getattr(settings, 'HUE_POLL_HOLD', 60.0),
+                                                consistency=getattr(settings, 'HUE_POLL_CONSISTENCY', 300.0))
+                heapq.heappush(self._heap, (now, pk))
+            if getattr(settings, 'HUE_EVENT_STREAM', False):
+                self.pollers[pk].start_push()
+        self._loaded = now
+
+    def run_once(self):
+        """ Poll every bridge that is due, returns seconds until the next one is """
+        close_old_connections()
+        now = time.time()
+        if self._loaded is None or now - self._loaded >= self.reload:
+            self.load()
+        while self._heap and self._heap[0][0] <= now:
+            due, pk = heapq.heappop(self._heap)
+            poller = self.pollers.get(pk)
+            if poller is None:
+                continue
+            try:
+                poller.poll()
+            except Exception:
+                logger.exception("Applying sensors of bridge {0} failed".format(pk))
+                poller.backoff()
+            finally:
+                # a poller that is not pushed back is never polled again
+                heapq.heappush(self._heap, (time.time() + poller.interval, pk))
+        if not self._heap:
+            return self.reload
+        return max(0, min(self._heap[0][0], self._loaded + self.reload) - time.time())
+
+    def run(self):
+        while not self._stopped.is_set():
+            try:
+                wait = self.run_once()
+            except Exception:
+                logger.exception("Sensor poll loop failed")
+                wait = self.reload
+            self._stopped.wait(wait)
+        close_old_connections()
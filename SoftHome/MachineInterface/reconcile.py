@@ -0,0 +1,111 @@
+import hashlib
+import json
+
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.db import transaction
+
+
+class Reconciliation(list):
+
+    """ Reconciled objects ordered by controller_index, with row counts """
+    def __init__(self, objects=(), created=0, updated=0, unchanged=0, removed=0):
+        list.__init__(self, objects)
+        self.created = created
+        self.updated = updated
+        self.unchanged = unchanged
+        self.removed = removed
+
+    def counts(self):
+        return {
+            'created': self.created,
+            'updated': self.updated,
+            'unchanged': self.unchanged,
+            'removed': self.removed,
+        }
+
+
+def digest(payload):
+    """ Stable hash of one resource of a bridge payload """
+    return hashlib.sha1(json.dumps(payload, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def _normalize(model, name, value):
+    """ Coerce a payload value the way the field stores it, so diffs compare like with like.
+    Values the field would reject (e.g. a 'host:port' ip_address) are compared as they are. """
+    try:
+        return model._meta.get_field(name).to_python(value)
+    except (FieldDoesNotExist, ValidationError):
+        return value
+
+
+def reconcile(model, controller, rows, present=None, remove_missing=True):
+    """ Bring the rows of model belonging to controller in line with a bridge payload.
+    rows maps controller_index to a dict of model fields. Existing rows are
+    fetched in one query and keyed by controller_index; only rows whose fields
+    differ are written, and only the differing columns. Rows whose index is
+    not in present (defaults to the keys of rows) are deleted.
+    Multi-table models cannot use bulk_create, so new rows are saved one at a time.
+    """
+    if present is None:
+        present = rows.keys()
+    result = Reconciliation()
+
+    with transaction.atomic():
+        existing = dict((obj.controller_index, obj) for obj in model.objects.filter(controller_id=controller.pk))
+        objects = {}
+        for index, fields in rows.items():
+            obj = existing.get(index)
+            if obj is None:
+                obj = model(controller_id=controller.pk, controller_index=index, **fields)
+                obj.save()
+                result.created += 1
+            else:
+                normalized = dict((name, _normalize(model, name, value)) for name, value in fields.items())
+                changed = [name for name, value in normalized.items() if getattr(obj, name) != value]
+                if changed:
+                    for name in changed:
+                        setattr(obj, name, normalized[name])
+                    obj.save(update_fields=changed + ['last_updated'] if hasattr(obj, 'last_updated') else changed)
+                    result.updated += 1
+                else:
+                    result.unchanged += 1
+            objects[index] = obj
+
+        missing = [obj.pk for index, obj in existing.items() if index not in present]
+        if remove_missing and missing:
+            model.objects.filter(pk__in=missing).delete()
+            result.removed = len(missing)
+
+    for index in sorted(existing):
+        if index in present and index not in objects:
+            objects[index] = existing[index]
+    result.extend(objects[index] for index in sorted(objects))
+    return result
+
+
+def reconcile_members(through, owner_field, member_field, memberships):
+    """ Set-based update of a many-to-many through table.
+    memberships maps an owner pk to the set of member pks it should have;
+    missing links are added with one bulk_create and stale links removed with
+    one delete per owner that lost members. Returns (added, removed).
+    """
+    owner_id = owner_field + '_id'
+    member_id = member_field + '_id'
+    current = {}
+    for owner, member in through.objects.filter(
+            **{owner_id + '__in': list(memberships)}).values_list(owner_id, member_id):
+        current.setdefault(owner, set()).add(member)
+
+    new_links = []
+    removed = 0
+    with transaction.atomic():
+        for owner, members in memberships.items():
+            have = current.get(owner, set())
+            for member in members - have:
+                new_links.append(through(**{owner_id: owner, member_id: member}))
+            stale = have - members
+            if stale:
+                through.objects.filter(**{owner_id: owner, member_id + '__in': list(stale)}).delete()
+                removed += len(stale)
+        through.objects.bulk_create(new_links)
+    return len(new_links), removed
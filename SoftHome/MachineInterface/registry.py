@@ -0,0 +1,46 @@
+import threading
+import time
+
+from django.apps import apps
+from django.conf import settings
+
+
+class DeviceRegistry(object):
+
+    """ Process-level cache of bridge credentials, keyed by controller pk.
+    Entries are dropped by the save/delete signals in MachineInterface.signals,
+    which only fire in the process that saved the row, so every entry is also
+    re-read once it is ttl seconds old to pick up changes made elsewhere.
+    """
+    def __init__(self, ttl=None):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._bridges = {}  # controller pk -> (PhilipsHueBridge, time.time() loaded)
+
+    def _ttl(self):
+        if self.ttl is not None:
+            return self.ttl
+        return getattr(settings, 'DEVICE_REGISTRY_TTL', 30)
+
+    def bridge(self, controller_id):
+        """ The PhilipsHueBridge with pk controller_id, queried on a cache miss or once the entry expired """
+        now = time.time()
+        with self._lock:
+            bridge, loaded = self._bridges.get(controller_id, (None, None))
+        if bridge is None or now - loaded > self._ttl():
+            PhilipsHueBridge = apps.get_model('MachineInterface', 'PhilipsHueBridge')
+            bridge = PhilipsHueBridge.objects.get(pk=controller_id)
+            with self._lock:
+                self._bridges[controller_id] = (bridge, now)
+        return bridge
+
+    def invalidate_bridge(self, controller_id):
+        with self._lock:
+            self._bridges.pop(controller_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._bridges.clear()
+
+
+registry = DeviceRegistry()
@@ -0,0 +1,236 @@
+import collections
+import logging
+import threading
+import time
+
+from django.conf import settings
+
+from .models import Light, Scene
+from .registry import registry
+import hue_batch
+import hue_scenes
+
+logger = logging.getLogger(__name__)
+
+
+class ScenePlan(object):
+
+    """ A scene compiled to bridge writes: (kind, target, data) tuples for
+    the bridge command queue, plus the Light fields each light ends up with """
+    def __init__(self, scene, writes, light_fields):
+        self.scene = scene
+        self.writes = writes
+        self.light_fields = light_fields   # light pk -> {field: value}
+
+
+class SceneEngine(object):
+
+    """ Activates Scenes with as few bridge requests as possible.
+    Scenes are indexed by (controller pk, group index, name) and each is
+    compiled once into a ScenePlan: a single scene recall when the scene is
+    stored on the bridge as it is now (see sync_scenes), otherwise one group
+    action per set of lights that share a payload and exactly match a bridge
+    group, and one light PUT for the rest. Index and plans are dropped by invalidate(), which the Scene
+    and group membership signals call, and once they are ttl seconds old,
+    since those signals do not reach this process when another one saves.
+    """
+    def __init__(self, samples=200, ttl=None):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._index = None   # (controller pk, group index, name) -> Scene
+        self._plans = {}     # scene pk -> ScenePlan
+        self._loaded = time.time()
+        self._latencies = collections.deque(maxlen=samples)
+        self.activations = 0
+        self.failures = 0
+
+    def invalidate(self, scene_id=None):
+        with self._lock:
+            if scene_id is None:
+                self._plans.clear()
+            else:
+                self._plans.pop(scene_id, None)
+            self._index = None
+
+    def _expire(self):
+        """ Drop index and plans once they are older than the ttl, call with the lock held """
+        ttl = self.ttl if self.ttl is not None else getattr(settings, 'SCENE_CACHE_TTL', 60)
+        if time.time() - self._loaded > ttl:
+            self._plans.clear()
+            self._index = None
+            self._loaded = time.time()
+
+    def _load_index(self):
+        index = {}
+        for scene in Scene.objects.filter(controller__isnull=False).order_by('pk'):
+            index.setdefault((scene.controller_id, scene.group_index, scene.name), scene)
+        return index
+
+    def find(self, controller_id, group_index, name):
+        """ The Scene called name in a bridge group, or None """
+        with self._lock:
+            self._expire()
+            index = self._index
+        if index is None:
+            index = self._load_index()
+            with self._lock:
+                self._index = index
+        return index.get((controller_id, int(group_index), name))
+
+    def compile(self, scene):
+        """ Build the ScenePlan of a scene """
+        bridge = registry.bridge(scene.controller_id)
+        memberships = bridge.get_light_memberships()
+        states = list(scene.light_states.select_related('light'))
+        light_fields = dict((state.light_id, state.light_fields()) for state in states)
+        if scene.bridge_scene_id and scene.bridge_digest == hue_scenes.body_digest(bridge_body(scene, states, memberships)):
+            # recall through group 0: the scene's lights need not all be in its group,
+            # and a recall through a group only sets the lights that are
+            writes = [('group', '0', {'scene': scene.bridge_scene_id})]
+        elif not states:
+            writes = [('group', str(scene.group_index), scene.group_payload())]
+        else:
+            pairs = [(str(state.light.controller_index), state.payload()) for state in states]
+            # stale groups may hold lights the scene does not, so only consolidate while fresh;
+            # temporary groups cost two extra requests per activation, never use them here
+            plan = hue_batch.plan_light_writes(pairs, *(memberships if bridge.memberships_fresh() else ()),
+                                               min_adhoc=len(pairs) + 1)
+            writes = [(kind, target, data) for kind, target, data, lights in plan]
+        return ScenePlan(scene, writes, light_fields)
+
+    def plan(self, scene):
+        with self._lock:
+            self._expire()
+            plan = self._plans.get(scene.pk)
+        if plan is None:
+            plan = self.compile(scene)
+            with self._lock:
+                self._plans[scene.pk] = plan
+        return plan
+
+    def activate(self, scene, transition_time=None):
+        """ Send a scene's writes through its bridge's command queue.
+        Returns True if every write succeeded. """
+        started = time.time()
+        plan = self.plan(scene)
+        queue = registry.bridge(scene.controller_id).command_queue()
+        futures = []
+        for kind, target, data in plan.writes:
+            if transition_time is not None:
+                data = dict(data, transitiontime=int(round(transition_time)))
+            futures.append(queue.submit(kind, target, data))
+        ok = True
+        for future in futures:
+            try:
+                result = future.result()
+                ok = isinstance(result, list) and not any('error' in line for line in result) and ok
+            except Exception:
+                logger.exception("Scene {0} write failed".format(scene.pk))
+                ok = False
+        latency = time.time() - started
+        with self._lock:
+            self._latencies.append(latency)
+            self.activations += 1
+            if not ok:
+                self.failures += 1
+        logger.debug("Scene {0} activated in {1:.3f} s with {2} writes".format(scene.pk, latency, len(plan.writes)))
+
+        if ok and plan.light_fields:
+            for light in Light.objects.filter(pk__in=list(plan.light_fields)):
+                light.remember(**plan.light_fields[light.pk])
+        return ok
+
+    def activate_by_name(self, controller_id, group_index, name, transition_time=None):
+        """ Activate a scene by name, returns None if there is no such scene """
+        scene = self.find(controller_id, group_index, name)
+        if scene is None:
+            return None
+        return self.activate(scene, transition_time)
+
+    def stats(self):
+        with self._lock:
+            latencies = sorted(self._latencies)
+            activations = self.activations
+            failures = self.failures
+        stats = {'activations': activations, 'failures': failures}
+        if latencies:
+            stats.update({
+                'latency_last': self._latencies[-1],
+                'latency_mean': sum(latencies) / len(latencies),
+                'latency_p95': latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+                'latency_max': latencies[-1],
+            })
+        return stats
+
+
+engine = SceneEngine()
+
+
+def bridge_body(scene, states, memberships):
+    """ The body storing a scene on its bridge. Scenes without light states
+    set every light of their group; memberships is (all lights, groups)
+    from PhilipsHueBridge.get_light_memberships() """
+    if states:
+        lightstates = dict((state.light.controller_index, state.payload()) for state in states)
+    else:
+        all_lights, groups = memberships
+        members = all_lights if scene.group_index == 0 else groups.get(scene.group_index, ())
+        lightstates = dict((light, scene.group_payload()) for light in members)
+    return hue_scenes.scene_body(scene.name, lightstates)
+
+
+def sync_scenes(bridge):
+    """ Store a bridge's Scenes on it so each activates with one group action.
+    Costs one GET /scenes when nothing changed, plus a write per created,
+    rewritten or orphaned scene and a second GET to record lastupdated.
+    Returns counts of what was done.
+    """
+    remote = bridge.get_scene()
+    if not isinstance(remote, dict):
+        raise ValueError('Unexpected /scenes response: {0!r}'.format(remote))
+    memberships = bridge.get_light_memberships()
+    scenes = dict((scene.pk, scene) for scene in
+                  Scene.objects.filter(controller_id=bridge.pk).prefetch_related('light_states__light'))
+    wanted = {}
+    for pk, scene in scenes.items():
+        body = bridge_body(scene, list(scene.light_states.all()), memberships)
+        if body['lights']:
+            wanted[pk] = (scene.bridge_scene_id, body, scene.bridge_digest, scene.bridge_last_updated)
+
+    counts = {'created': 0, 'updated': 0, 'deleted': 0, 'failed': 0}
+    stored = {}  # scene pk -> (bridge scene id, digest)
+    for action in hue_scenes.plan_sync(wanted, remote, bridge.bridge_user):
+        if action[0] == 'delete':
+            bridge.delete_scene(action[1])
+            counts['deleted'] += 1
+            continue
+        if action[0] == 'create':
+            kind, pk, body = action
+            scene_id = bridge.create_scene(body)
+        else:
+            kind, pk, scene_id, body = action
+            result = bridge.update_scene(scene_id, body)
+            if not isinstance(result, list) or any('error' in line for line in result):
+                scene_id = None
+        if scene_id is None:
+            counts['failed'] += 1
+            logger.warning("Storing scene {0} on bridge {1} failed".format(pk, bridge.pk))
+            continue
+        counts['created' if kind == 'create' else 'updated'] += 1
+        stored[pk] = (scene_id, hue_scenes.body_digest(body))
+
+    if stored:
+        remote = bridge.get_scene()
+        remote = remote if isinstance(remote, dict) else {}
+    for pk, scene in scenes.items():
+        if pk in stored:
+            scene_id, digest = stored[pk]
+            fields = (scene_id, digest, remote.get(scene_id, {}).get('lastupdated'))
+        elif pk in wanted:
+            continue
+        else:
+            fields = (None, None, None)   # nothing to store, its bridge scene was collected
+        if fields != (scene.bridge_scene_id, scene.bridge_digest, scene.bridge_last_updated):
+            scene.bridge_scene_id, scene.bridge_digest, scene.bridge_last_updated = fields
+            scene.save(update_fields=['bridge_scene_id', 'bridge_digest', 'bridge_last_updated'])
+    return counts
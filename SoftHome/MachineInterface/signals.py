@@ -0,0 +1,51 @@
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from Portal.models import Device
+from analytics import ingest
+from .models import Light, PhilipsHueBridge, Scene, SceneLightState, Sensor
+from .registry import registry
+from . import scenes
+
+
+@receiver(post_save, sender=PhilipsHueBridge)
+@receiver(post_delete, sender=PhilipsHueBridge)
+@receiver(post_save, sender=Device)
+@receiver(post_delete, sender=Device)
+def bridge_changed(sender, instance, **kwargs):
+    registry.invalidate_bridge(instance.pk)
+
+
+def _state_changed(fields, created, update_fields):
+    return created or update_fields is None or not fields.isdisjoint(update_fields)
+
+
+def _record_on_commit(model_name, fields):
+    # the row is taken now, but only recorded if the save is not rolled back
+    transaction.on_commit(lambda: ingest.record(model_name, **fields))
+
+
+@receiver(post_save, sender=Light)
+def light_saved(sender, instance, created=False, update_fields=None, **kwargs):
+    if _state_changed(set(Light.STATE_FIELDS.values()), created, update_fields):
+        _record_on_commit('LightHistory', {'light_id': instance.pk, 'state': instance.state,
+                                           'brightness': instance.brightness, 'ct': instance.color_temperature})
+
+
+@receiver(post_save, sender=Sensor)
+def sensor_saved(sender, instance, created=False, update_fields=None, **kwargs):
+    if _state_changed({'state'}, created, update_fields):
+        row = instance.history_row()
+        if row is not None:
+            _record_on_commit(*row)
+
+
+@receiver([post_save, post_delete], sender=Scene)
+def scene_changed(sender, instance, **kwargs):
+    scenes.engine.invalidate(instance.pk)
+
+
+@receiver([post_save, post_delete], sender=SceneLightState)
+def scene_light_state_changed(sender, instance, **kwargs):
+    scenes.engine.invalidate(instance.scene_id)
@@ -0,0 +1,138 @@
+import logging
+import threading
+import time
+
+from django.db import close_old_connections
+from django.utils import timezone
+
+from .models import PhilipsHueBridge
+from . import scenes
+
+logger = logging.getLogger(__name__)
+
+
+def sync_bridge(bridge, incremental=True):
+    """ Import one bridge, store its scenes on it and record when and how long it took.
+    Incremental syncs only write the resources that changed since the last one.
+    """
+    started = time.time()
+    try:
+        if incremental:
+            result = bridge.import_changes()
+        else:
+            result = bridge.import_all()
+        scenes.sync_scenes(bridge)
+        bridge.last_sync_error = None
+    except Exception as e:
+        logger.exception("Sync of bridge {0} failed".format(bridge.pk))
+        result = None
+        bridge.last_sync_error = str(e)[:200]
+    bridge.last_sync = timezone.now()
+    bridge.last_sync_duration = time.time() - started
+    bridge.sync_requested = False
+    bridge.save(update_fields=['last_sync', 'last_sync_duration', 'last_sync_error', 'sync_requested'])
+    return result
+
+
+class BridgeSyncWorker(threading.Thread):
+
+    """ Background thread that keeps every PhilipsHueBridge in sync.
+    Each bridge is synced once its sync_interval has passed since last_sync,
+    or within max_wait seconds of request_sync(bridge pk) from any process.
+    Run one worker per site, with `manage.py sync_bridges --loop`.
+    """
+    def __init__(self, max_wait=10):
+        threading.Thread.__init__(self, name='hue-bridge-sync')
+        self.daemon = True
+        self.max_wait = max_wait
+        self._requested = set()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = False
+
+    def request_sync(self, bridge_pk):
+        with self._lock:
+            self._requested.add(bridge_pk)
+        self._wake.set()
+
+    def is_pending(self, bridge_pk):
+        with self._lock:
+            return bridge_pk in self._requested
+
+    def stop(self):
+        self._stopped = True
+        self._wake.set()
+
+    def run_once(self):
+        """ Sync every due or requested bridge, returns seconds until the next one is due """
+        close_old_connections()
+        with self._lock:
+            requested = set(self._requested)
+        now = timezone.now()
+        wait = self.max_wait
+        for bridge in PhilipsHueBridge.objects.filter(enabled=True):
+            due_in = 0
+            if bridge.last_sync is not None:
+                due_in = bridge.sync_interval - (now - bridge.last_sync).total_seconds()
+            if bridge.pk in requested or bridge.sync_requested or due_in <= 0:
+                sync_bridge(bridge)
+                due_in = bridge.sync_interval
+                with self._lock:
+                    self._requested.discard(bridge.pk)
+            wait = min(wait, due_in)
+        with self._lock:
+            # requests for bridges that no longer exist
+            self._requested -= requested
+        return max(wait, 0)
+
+    def run(self):
+        while not self._stopped:
+            try:
+                wait = self.run_once()
+            except Exception:
+                logger.exception("Bridge sync loop failed")
+                wait = self.max_wait
+            self._wake.wait(wait)
+            self._wake.clear()
+        close_old_connections()
+
+
+_worker = None
+_worker_lock = threading.Lock()
+
+
+def get_worker(start=True):
+    """ Returns the sync worker of this process, starting it if needed.
+    With start=False only a worker already running here is returned. """
+    global _worker
+    with _worker_lock:
+        if _worker is None or not _worker.is_alive():
+            if not start:
+                return None
+            _worker = BridgeSyncWorker()
+            _worker.start()
+        return _worker
+
+
+def request_sync(bridge_pk):
+    """ Ask the sync worker to sync a bridge soon. The request is stored on the
+    bridge, so a worker in another process sees it; one in this process is woken. """
+    PhilipsHueBridge.objects.filter(pk=bridge_pk).update(sync_requested=True)
+    worker = get_worker(start=False)
+    if worker is not None:
+        worker.request_sync(bridge_pk)
+
+
+def sync_status(bridge):
+    """ Freshness of a bridge's stored snapshot, for templates """
+    age = None
+    if bridge.last_sync is not None:
+        age = (timezone.now() - bridge.last_sync).total_seconds()
+    worker = get_worker(start=False)
+    return {
+        'last_sync': bridge.last_sync,
+        'sync_age': age,
+        'sync_duration': bridge.last_sync_duration,
+        'sync_error': bridge.last_sync_error,
+        'sync_pending': bridge.sync_requested or (worker is not None and worker.is_pending(bridge.pk)),
+    }
@@ -9,5 +9,7 @@ urlpatterns = [
     url(r'controllers/new/(?P<api>[\w-]+)/$', views.new_controller_form, name='new_controller_form'),
     url(r'controllers/add/(?P<api>[\w-]+)/$', views.add_controller, name='add_controller'),
     url(r'controllers/update/(?P<device_id>[0-9]+)/$', views.manage_controller, name='update_controller'),
-    url(r'controllers/view/(?P<device_id>[0-9]+)/$', views.manage_controller, name='manage_controller')
+    url(r'controllers/view/(?P<device_id>[0-9]+)/$', views.manage_controller, name='manage_controller'),
+    url(r'wifi/(?P<device>[0-9]+)/(?P<signal_strength>-?[0-9]+)/(?P<speed>[0-9]+)/(?P<gps_dd>[0-9.,-]+)/$',
+        views.update_wifi_location, name='update_wifi_location')
 ]
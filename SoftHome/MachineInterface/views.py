@@ -1,10 +1,14 @@
 import sys
 sys.path.append('/var/www/modules')
 
-from django.shortcuts import render
+from django.contrib.auth.decorators import login_required
+from django.shortcuts import get_object_or_404, render
 from django.http import HttpResponseRedirect, HttpResponse
+from django.views.decorators.http import require_POST
 from .models import PhilipsHueBridge
+from . import sync
 from Portal.models import Device
+from analytics import ingest
 from django.urls import reverse
 import ssdp
 
@@ -23,9 +27,9 @@ def third_party_controllers(request):
 
 
 def new_controller_form(request, api='philips'):
-    discovered = ssdp.discover('Philips Hue')
-    ip_addresses = [ssdp.parse_ip_address(discovery.location) for discovery in discovered]
-    context = {'api': api, 'ip_addresses': ip_addresses, 'error': 0}
+    discovery = ssdp.get_service('Philips Hue')
+    context = {'api': api, 'ip_addresses': discovery.ip_addresses(), 'error': 0,
+               'discovering': discovery.last_run is None}
     return render(request, 'MachineInterface/add_controller.html', context)
 
 
@@ -43,11 +47,24 @@ def manage_controller(request, device_id):
     device = Device.objects.filter(pk=device_id)[0]
     context = {'device': device}
     if device.api == 'philips':
-            context.update(device.philips_device.import_all())
+        bridge = device.philips_device
+        # render the stored snapshot, the bridge itself is read by the sync worker
+        if request.resolver_match.url_name == 'update_controller' or bridge.last_sync is None:
+            sync.request_sync(bridge.pk)
+            bridge.sync_requested = True
+        context.update(bridge.synced_devices())
+        context.update(sync.sync_status(bridge))
     return render(request, 'MachineInterface/view_controller.html', context)
 
 
+@login_required
+@require_POST
 def update_wifi_location(request, device, signal_strength, speed, gps_dd):
+    # only the owner of a device may add to its history
+    device = get_object_or_404(Device, pk=device, user=request.user)
+    ingest.record('WIFIHistory', device_id=device.pk, ip_address=request.META.get('REMOTE_ADDR'),
+                  signal_strength=int(signal_strength), speed=int(speed), gps_dd=gps_dd,
+                  ssid=request.POST.get('ssid', ''))
     return HttpResponse("Received.")
 
 
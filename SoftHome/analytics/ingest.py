@@ -0,0 +1,274 @@
+import atexit
+import datetime
+import decimal
+import glob
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from django.apps import apps
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import DataError, IntegrityError, close_old_connections, transaction
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+
+def _encode(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    if isinstance(value, decimal.Decimal):
+        return str(value)
+    raise TypeError(repr(value))
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        return True
+    return True
+
+
+class HistoryBuffer(object):
+
+    """ Collects analytics history rows in memory and writes them with one
+    bulk_create per model once max_rows are waiting or the oldest row is
+    max_age seconds old. Every row is also appended to a spool file owned by
+    this process, so rows that were never flushed are replayed by the next
+    process that starts after a crash or restart. Rows the database rejects
+    are written to dead-letter.jsonl in the spool directory instead of being
+    retried, so one bad row does not hold back the rest.
+    """
+    def __init__(self, spool_dir=None, max_rows=500, max_age=2.0):
+        self.spool_dir = spool_dir
+        self.max_rows = max_rows
+        self.max_age = max_age
+
+        self._rows = []  # (model name, fields)
+        self._oldest = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._spool = None
+        self._worker = None
+
+        self.flushes = 0
+        self.flushed_rows = 0
+        self.failures = 0
+        self.dead_rows = 0
+        self.last_flush_latency = 0.0
+        self.max_flush_latency = 0.0
+
+        if spool_dir is not None:
+            if not os.path.isdir(spool_dir):
+                os.makedirs(spool_dir)
+            self.spool_path = os.path.join(spool_dir, 'history-{0}.spool'.format(os.getpid()))
+            self._replay()
+            self._spool = open(self.spool_path, 'a')
+
+    def _replay(self):
+        """ Load rows spooled by processes that are no longer running,
+        including the rows they were in the middle of flushing """
+        paths = (glob.glob(os.path.join(self.spool_dir, 'history-*.spool')) +
+                 glob.glob(os.path.join(self.spool_dir, 'history-*.spool.flushing')))
+        for path in sorted(paths):
+            name = os.path.basename(path)
+            try:
+                pid = int(name[len('history-'):name.index('.spool')])
+            except ValueError:
+                continue
+            if pid != os.getpid() and _pid_alive(pid):
+                continue
+            claimed = path + '.{0}'.format(os.getpid())
+            try:
+                os.rename(path, claimed)
+            except OSError:
+                continue  # another process claimed it first
+            with open(claimed) as spool:
+                for line in spool:
+                    try:
+                        model_name, fields = json.loads(line)
+                    except ValueError:
+                        continue  # torn final line
+                    self._rows.append((model_name, fields))
+            os.remove(claimed)
+            logger.info("Replayed history spool {0}".format(path))
+        if self._rows:
+            self._oldest = time.time()
+            with open(self.spool_path, 'a') as spool:
+                for row in self._rows:
+                    spool.write(json.dumps(row, default=_encode) + '\n')
+
+    def add(self, model_name, **fields):
+        """ Queue one row of analytics.<model_name>; its timestamp defaults to now """
+        model = apps.get_model('analytics', model_name)
+        fields.setdefault(model.time_field, timezone.now())
+        row = (model_name, fields)
+        with self._lock:
+            self._rows.append(row)
+            if self._oldest is None:
+                self._oldest = time.time()
+            if self._spool is not None:
+                self._spool.write(json.dumps(row, default=_encode) + '\n')
+                self._spool.flush()
+            full = len(self._rows) >= self.max_rows
+        self._ensure_worker()
+        if full:
+            self._wake.set()
+
+    def _ensure_worker(self):
+        if self._worker is None or not self._worker.is_alive():
+            self._worker = threading.Thread(target=self._run, name='history-buffer')
+            self._worker.daemon = True
+            self._worker.start()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.max_age)
+            self._wake.clear()
+            with self._lock:
+                due = self._rows and (len(self._rows) >= self.max_rows or
+                                      time.time() - self._oldest >= self.max_age)
+            if due:
+                try:
+                    self.flush()
+                except Exception:
+                    logger.exception("History flush failed")
+                finally:
+                    close_old_connections()
+
+    def flush(self):
+        """ Write every queued row, returns the number of rows written """
+        with self._flush_lock:
+            with self._lock:
+                rows, self._rows = self._rows, []
+                self._oldest = None
+                if self._spool is not None:
+                    # rows added from now on go to a fresh spool
+                    self._spool.close()
+                    flushing = self.spool_path + '.flushing'
+                    os.rename(self.spool_path, flushing)
+                    self._spool = open(self.spool_path, 'a')
+            if not rows:
+                if self._spool is not None:
+                    os.remove(flushing)
+                return 0
+
+            started = time.time()
+            try:
+                written = self._write(rows)
+            except Exception:
+                self.failures += 1
+                with self._lock:
+                    self._rows = rows + self._rows
+                    self._oldest = time.time()
+                    if self._spool is not None:
+                        for row in rows:
+                            self._spool.write(json.dumps(row, default=_encode) + '\n')
+                        self._spool.flush()
+                raise
+            finally:
+                if self._spool is not None:
+                    os.remove(flushing)
+
+            self.last_flush_latency = time.time() - started
+            self.max_flush_latency = max(self.max_flush_latency, self.last_flush_latency)
+            self.flushes += 1
+            self.flushed_rows += written
+            return written
+
+    def _write(self, rows):
+        """ bulk_create rows, falling back to one insert per row when the batch is
+        rejected. Returns the number written; rejected rows are dead-lettered and
+        other errors (e.g. the database being down) are raised. """
+        by_model = {}
+        dead = []
+        for row in rows:
+            model_name, fields = row
+            try:
+                model = apps.get_model('analytics', model_name)
+                obj = model(**dict((name, model._meta.get_field(name).to_python(value))
+                                   for name, value in fields.items()))
+            except (LookupError, ValidationError, TypeError, ValueError) as e:
+                dead.append((row, e))
+                continue
+            by_model.setdefault(model, []).append((row, obj))
+        try:
+            with transaction.atomic():
+                for model, pairs in by_model.items():
+                    model.objects.bulk_create([obj for row, obj in pairs])
+        except (IntegrityError, DataError):
+            for model, pairs in by_model.items():
+                for row, obj in pairs:
+                    obj.pk = None
+                    try:
+                        with transaction.atomic():
+                            model.objects.bulk_create([obj])
+                    except (IntegrityError, DataError) as e:
+                        dead.append((row, e))
+        if dead:
+            self._dead_letter(dead)
+        return len(rows) - len(dead)
+
+    def _dead_letter(self, dead):
+        self.dead_rows += len(dead)
+        for row, error in dead:
+            logger.error("History row {0} rejected: {1}".format(row[0], error))
+        if self.spool_dir is None:
+            return
+        with open(os.path.join(self.spool_dir, 'dead-letter.jsonl'), 'a') as dead_letters:
+            for row, error in dead:
+                dead_letters.write(json.dumps({'row': row, 'error': str(error)}, default=_encode) + '\n')
+
+    def stats(self):
+        with self._lock:
+            backlog = len(self._rows)
+            oldest = self._oldest
+        return {
+            'backlog': backlog,
+            'oldest_age': time.time() - oldest if oldest is not None else 0.0,
+            'flushes': self.flushes,
+            'flushed_rows': self.flushed_rows,
+            'failures': self.failures,
+            'dead_rows': self.dead_rows,
+            'last_flush_latency': self.last_flush_latency,
+            'max_flush_latency': self.max_flush_latency,
+        }
+
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+
+def get_buffer():
+    """ The process-wide history buffer, configured by ANALYTICS_SPOOL_DIR,
+    ANALYTICS_FLUSH_ROWS and ANALYTICS_FLUSH_SECONDS """
+    global _buffer
+    with _buffer_lock:
+        if _buffer is None:
+            spool_dir = getattr(settings, 'ANALYTICS_SPOOL_DIR',
+                                os.path.join(tempfile.gettempdir(), 'softhome-history'))
+            _buffer = HistoryBuffer(spool_dir,
+                                    getattr(settings, 'ANALYTICS_FLUSH_ROWS', 500),
+                                    getattr(settings, 'ANALYTICS_FLUSH_SECONDS', 2.0))
+            atexit.register(_flush_at_exit)
+        return _buffer
+
+
+def _flush_at_exit():
+    try:
+        _buffer.flush()
+    except Exception:
+        logger.exception("History flush at exit failed, rows stay in the spool")
+
+
+def record(model_name, **fields):
+    """ Queue a history row, e.g. record('LightHistory', light_id=1, state=True) """
+    get_buffer().add(model_name, **fields)
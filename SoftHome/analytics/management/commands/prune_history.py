@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from analytics.timeseries import apply_retention
+
+
+class Command(BaseCommand):
+    help = 'Delete history rows older than their retention period (ANALYTICS_RETENTION_DAYS)'
+
+    def handle(self, *args, **options):
+        for name, deleted in sorted(apply_retention().items()):
+            self.stdout.write('{0}: {1} rows deleted'.format(name, deleted))
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from analytics import rollups
+
+
+class Command(BaseCommand):
+    help = 'Fold new sensor history rows into the minute, hour and day rollups'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=10000)
+        parser.add_argument('--settle', type=float, default=None,
+                            help='Seconds new rows wait before they are rolled up (default ANALYTICS_ROLLUP_SETTLE)')
+
+    def handle(self, *args, **options):
+        for source, count in sorted(rollups.run(options['batch_size'], options['settle']).items()):
+            self.stdout.write('{0}: {1} rows rolled up'.format(source, count))
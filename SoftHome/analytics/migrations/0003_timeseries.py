@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.3 on 2026-10-18 11:05
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.utils.timezone
+
+
+def fill_buckets(apps, schema_editor):
+    times = {
+        'wifihistory': 'connection_time',
+        'lighthistory': 'update_time',
+        'outlethistory': 'update_time',
+        'motionsensorhistory': 'update_time',
+        'soundsensorhistory': 'update_time',
+        'lightsensorhistory': 'update_time',
+        'temperaturesensorhistory': 'update_time',
+    }
+    # same UTC months as analytics.timeseries.bucket_for
+    tzinfo = django.utils.timezone.utc if settings.USE_TZ else None
+    for model_name, time_field in times.items():
+        model = apps.get_model('analytics', model_name)
+        for month in model.objects.datetimes(time_field, 'month', tzinfo=tzinfo):
+            if month.month == 12:
+                following = month.replace(year=month.year + 1, month=1)
+            else:
+                following = month.replace(month=month.month + 1)
+            model.objects.filter(**{
+                time_field + '__gte': month,
+                time_field + '__lt': following,
+            }).update(bucket=month.year * 100 + month.month)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analytics', '0002_auto_20170122_0220'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='wifihistory',
+            name='bucket',
+            field=models.PositiveIntegerField(db_index=True, default=0),
+        ),
+        migrations.AlterField(
+            model_name='wifihistory',
+            name='connection_time',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AlterIndexTogether(
+            name='wifihistory',
+            index_together=set([('device', 'connection_time'), ('device', 'bucket', 'connection_time')]),
+        ),
+        migrations.AddField(
+            model_name='lighthistory',
+            name='bucket',
+            field=models.PositiveIntegerField(db_index=True, default=0),
+        ),
+        migrations.AlterField(
+            model_name='lighthistory',
+            name='update_time',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AlterIndexTogether(
+            name='lighthistory',
+            index_together=set([('light', 'update_time'), ('light', 'bucket', 'update_time')]),
+        ),
+        migrations.AddField(
+            model_name='outlethistory',
+            name='bucket',
+            field=models.PositiveIntegerField(db_index=True, default=0),
+        ),
+        migrations.AlterField(
+            model_name='outlethistory',
+            name='update_time',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AlterIndexTogether(
+            name='outlethistory',
+            index_together=set([('outlet', 'update_time'), ('outlet', 'bucket', 'update_time')]),
+        ),
+        migrations.AddField(
+            model_name='motionsensorhistory',
+            name='bucket',
+            field=models.PositiveIntegerField(db_index=True, default=0),
+        ),
+        migrations.AlterField(
+            model_name='motionsensorhistory',
+            name='update_time',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AlterIndexTogether(
+            name='motionsensorhistory',
+            index_together=set([('sensor', 'update_time'), ('sensor', 'bucket', 'update_time')]),
+        ),
+        migrations.AddField(
+            model_name='soundsensorhistory',
+            name='bucket',
+            field=models.PositiveIntegerField(db_index=True, default=0),
+        ),
+        migrations.AlterField(
+            model_name='soundsensorhistory',
+            name='update_time',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AlterIndexTogether(
+            name='soundsensorhistory',
+            index_together=set([('sensor', 'update_time'), ('sensor', 'bucket', 'update_time')]),
+        ),
+        migrations.AddField(
+            model_name='lightsensorhistory',
+            name='bucket',
+            field=models.PositiveIntegerField(db_index=True, default=0),
+        ),
+        migrations.AlterField(
+            model_name='lightsensorhistory',
+            name='update_time',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AlterIndexTogether(
+            name='lightsensorhistory',
+            index_together=set([('sensor', 'update_time'), ('sensor', 'bucket', 'update_time')]),
+        ),
+        migrations.AddField(
+            model_name='temperaturesensorhistory',
+            name='bucket',
+            field=models.PositiveIntegerField(db_index=True, default=0),
+        ),
+        migrations.AlterField(
+            model_name='temperaturesensorhistory',
+            name='update_time',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AlterIndexTogether(
+            name='temperaturesensorhistory',
+            index_together=set([('sensor', 'update_time'), ('sensor', 'bucket', 'update_time')]),
+        ),
+        migrations.RunPython(fill_buckets, migrations.RunPython.noop),
+    ]
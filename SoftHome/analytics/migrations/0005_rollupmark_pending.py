@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.3 on 2026-10-18 16:20
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analytics', '0004_sensorrollup'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='rollupmark',
+            name='pending_id',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='rollupmark',
+            name='pending_since',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
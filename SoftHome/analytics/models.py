@@ -1,72 +1,151 @@
 from django.db import models
 from django.apps import apps
+from django.utils import timezone
+from .timeseries import TimeSeriesModel
 
 
-class WIFIHistory(models.Model):
+class WIFIHistory(TimeSeriesModel):
     device = models.ForeignKey("Portal.Device")
     ip_address = models.GenericIPAddressField(protocol='both')
     signal_strength = models.IntegerField(default=0)
     speed = models.IntegerField(default=0)
     ssid = models.CharField(max_length=200)
-    connection_time = models.DateTimeField(auto_now=True)
+    connection_time = models.DateTimeField(default=timezone.now)
     gps_dd = models.CharField(max_length=30)
 
+    series_field = 'device'
+    time_field = 'connection_time'
+
+    class Meta:
+        index_together = [('device', 'connection_time'), ('device', 'bucket', 'connection_time')]
+
     def __str__(self):
         return self.device.device_name
 
 
-class LightHistory(models.Model):
+class LightHistory(TimeSeriesModel):
     light = models.ForeignKey("MachineInterface.Light")
     state = models.BooleanField(default=False)
     brightness = models.PositiveSmallIntegerField(default=0)
     ct = models.PositiveSmallIntegerField(default=0)
-    update_time = models.DateTimeField(auto_now=True)
+    update_time = models.DateTimeField(default=timezone.now)
+
+    series_field = 'light'
+    time_field = 'update_time'
+
+    class Meta:
+        index_together = [('light', 'update_time'), ('light', 'bucket', 'update_time')]
 
     def __str__(self):
         return self.light.name
 
 
-class OutletHistory(models.Model):
+class OutletHistory(TimeSeriesModel):
     outlet = models.ForeignKey("MachineInterface.Outlet")
     power = models.IntegerField(default=0)
-    update_time = models.DateTimeField(auto_now=True)
+    update_time = models.DateTimeField(default=timezone.now)
+
+    series_field = 'outlet'
+    time_field = 'update_time'
+
+    class Meta:
+        index_together = [('outlet', 'update_time'), ('outlet', 'bucket', 'update_time')]
 
     def __str__(self):
         return self.outlet.name
 
 
-class MotionSensorHistory(models.Model):
+class MotionSensorHistory(TimeSeriesModel):
     sensor = models.ForeignKey("MachineInterface.Sensor")
     state = models.BooleanField(default=True)
-    update_time = models.DateTimeField(auto_now=True)
+    update_time = models.DateTimeField(default=timezone.now)
+
+    series_field = 'sensor'
+    time_field = 'update_time'
+
+    class Meta:
+        index_together = [('sensor', 'update_time'), ('sensor', 'bucket', 'update_time')]
 
     def __str__(self):
         return self.sensor.name
 
 
-class SoundSensorHistory(models.Model):
+class SoundSensorHistory(TimeSeriesModel):
     sensor = models.ForeignKey("MachineInterface.Sensor")
     level = models.PositiveSmallIntegerField(default=0)
     recording = models.FileField(max_length=200)
-    update_time = models.DateTimeField(auto_now=True)
+    update_time = models.DateTimeField(default=timezone.now)
+
+    series_field = 'sensor'
+    time_field = 'update_time'
+
+    class Meta:
+        index_together = [('sensor', 'update_time'), ('sensor', 'bucket', 'update_time')]
 
     def __str__(self):
         return self.sensor.name
 
 
-class LightSensorHistory(models.Model):
+class LightSensorHistory(TimeSeriesModel):
     sensor = models.ForeignKey("MachineInterface.Sensor")
     level = models.PositiveSmallIntegerField(default=0)
-    update_time = models.DateTimeField(auto_now=True)
+    update_time = models.DateTimeField(default=timezone.now)
+
+    series_field = 'sensor'
+    time_field = 'update_time'
+
+    class Meta:
+        index_together = [('sensor', 'update_time'), ('sensor', 'bucket', 'update_time')]
 
     def __str__(self):
         return self.sensor.name
 
 
-class TemperatureSensorHistory(models.Model):
+class TemperatureSensorHistory(TimeSeriesModel):
     sensor = models.ForeignKey("MachineInterface.Sensor")
     temperature = models.DecimalField(max_digits=5, decimal_places=2)
-    update_time = models.DateTimeField(auto_now=True)
+    update_time = models.DateTimeField(default=timezone.now)
+
+    series_field = 'sensor'
+    time_field = 'update_time'
+
+    class Meta:
+        index_together = [('sensor', 'update_time'), ('sensor', 'bucket', 'update_time')]
 
     def __str__(self):
         return self.sensor.name
+
+
+ROLLUP_RESOLUTIONS = ((60, '1 minute'), (3600, '1 hour'), (86400, '1 day'))
+
+
+class SensorRollup(models.Model):
+    sensor = models.ForeignKey("MachineInterface.Sensor")
+    metric = models.CharField(max_length=30)
+    resolution = models.PositiveIntegerField(choices=ROLLUP_RESOLUTIONS)   # #seconds per bucket
+    bucket_start = models.DateTimeField()
+    minimum = models.FloatField()
+    maximum = models.FloatField()
+    total = models.FloatField()
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('sensor', 'metric', 'resolution', 'bucket_start')
+
+    def __str__(self):
+        return self.sensor.name
+
+    @property
+    def average(self):
+        return self.total / self.count if self.count else None
+
+
+class RollupMark(models.Model):
+    source = models.CharField(max_length=100, unique=True)
+    last_id = models.PositiveIntegerField(default=0)   # #highest history pk already rolled up
+    pending_id = models.PositiveIntegerField(default=0)   # #highest history pk when pending_since was taken
+    pending_since = models.DateTimeField(null=True, blank=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return self.source
@@ -0,0 +1,140 @@
+import calendar
+import datetime
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .models import (SensorRollup, RollupMark, ROLLUP_RESOLUTIONS, TemperatureSensorHistory,
+                     LightSensorHistory)
+
+# history model -> metric column rolled up from it
+SOURCES = (
+    (TemperatureSensorHistory, 'temperature'),
+    (LightSensorHistory, 'level'),
+)
+RESOLUTIONS = [resolution for resolution, name in ROLLUP_RESOLUTIONS]
+
+
+def bucket_start(time, resolution):
+    """ Start of the resolution-second bucket holding time, aligned to UTC """
+    epoch = calendar.timegm(time.utctimetuple())
+    start = datetime.datetime.utcfromtimestamp(epoch - epoch % resolution)
+    if timezone.is_aware(time):
+        start = start.replace(tzinfo=timezone.utc)
+    return start
+
+
+def aggregate(rows):
+    """ Fold (sensor pk, time, value) rows into {(sensor, resolution, bucket start): [min, max, total, count]} """
+    aggregates = {}
+    for sensor, time, value in rows:
+        value = float(value)
+        for resolution in RESOLUTIONS:
+            key = (sensor, resolution, bucket_start(time, resolution))
+            current = aggregates.get(key)
+            if current is None:
+                aggregates[key] = [value, value, value, 1]
+            else:
+                current[0] = min(current[0], value)
+                current[1] = max(current[1], value)
+                current[2] += value
+                current[3] += 1
+    return aggregates
+
+
+def merge(metric, aggregates):
+    """ Add aggregates into the stored rollups: one select per resolution,
+    updates for buckets that exist and one bulk_create for the new ones """
+    new_rollups = []
+    for resolution in RESOLUTIONS:
+        keys = [key for key in aggregates if key[1] == resolution]
+        if not keys:
+            continue
+        existing = SensorRollup.objects.filter(
+            metric=metric,
+            resolution=resolution,
+            sensor_id__in=set(key[0] for key in keys),
+            bucket_start__gte=min(key[2] for key in keys),
+            bucket_start__lte=max(key[2] for key in keys),
+        )
+        existing = dict(((rollup.sensor_id, resolution, rollup.bucket_start), rollup) for rollup in existing)
+        for key in keys:
+            minimum, maximum, total, count = aggregates[key]
+            rollup = existing.get(key)
+            if rollup is None:
+                new_rollups.append(SensorRollup(sensor_id=key[0], metric=metric, resolution=resolution,
+                                                bucket_start=key[2], minimum=minimum, maximum=maximum,
+                                                total=total, count=count))
+                continue
+            rollup.minimum = min(rollup.minimum, minimum)
+            rollup.maximum = max(rollup.maximum, maximum)
+            rollup.total += total
+            rollup.count += count
+            rollup.save(update_fields=['minimum', 'maximum', 'total', 'count'])
+    SensorRollup.objects.bulk_create(new_rollups)
+
+
+def run(batch_size=10000, settle=None):
+    """ Roll up history rows added since the last run, returns {source: rows processed}.
+    Each source keeps a high-water mark of the last history pk it has folded in.
+    A pk can be handed out before a row with a lower pk commits, so each run only
+    reads up to the highest pk seen by a run at least settle seconds ago
+    (ANALYTICS_ROLLUP_SETTLE), by which time the lower rows have committed.
+    """
+    if settle is None:
+        settle = getattr(settings, 'ANALYTICS_ROLLUP_SETTLE', 60)
+    processed = {}
+    for model, metric in SOURCES:
+        mark, created = RollupMark.objects.get_or_create(source=model.__name__)
+        processed[model.__name__] = 0
+        now = timezone.now()
+        if mark.pending_since is not None and (now - mark.pending_since).total_seconds() < settle:
+            continue
+        while True:
+            rows = list(model.objects.filter(pk__gt=mark.last_id, pk__lte=mark.pending_id).order_by('pk').values_list(
+                'pk', 'sensor_id', 'update_time', metric)[:batch_size])
+            if not rows:
+                break
+            with transaction.atomic():
+                merge(metric, aggregate((sensor, time, value) for pk, sensor, time, value in rows))
+                mark.last_id = rows[-1][0]
+                mark.save()
+            processed[model.__name__] += len(rows)
+            if len(rows) < batch_size:
+                break
+        mark.last_id = max(mark.last_id, mark.pending_id)
+        mark.pending_id = model.objects.order_by('-pk').values_list('pk', flat=True).first() or mark.last_id
+        mark.pending_since = now
+        mark.save()
+    return processed
+
+
+def choose_resolution(start, end, points):
+    """ Coarsest rollup resolution giving at least points buckets between start and end,
+    or None when the range is too short and raw rows should be read """
+    span = (end - start).total_seconds()
+    for resolution in sorted(RESOLUTIONS, reverse=True):
+        if span / resolution >= points:
+            return resolution
+    return None
+
+
+def series(sensor, metric, start, end, points=500):
+    """ History of one sensor metric as (time, min, max, average, count) tuples,
+    read from the coarsest resolution that still gives the requested points """
+    resolution = choose_resolution(start, end, points)
+    if resolution is None:
+        model = dict((source_metric, source) for source, source_metric in SOURCES)[metric]
+        rows = model.objects.iterate(sensor, start, end)
+        return [(row.update_time, float(getattr(row, metric)), float(getattr(row, metric)),
+                 float(getattr(row, metric)), 1) for row in rows]
+    rollups = SensorRollup.objects.filter(
+        sensor=sensor,
+        metric=metric,
+        resolution=resolution,
+        bucket_start__gte=bucket_start(start, resolution),
+        bucket_start__lt=end,
+    ).order_by('bucket_start')
+    return [(rollup.bucket_start, rollup.minimum, rollup.maximum, rollup.average, rollup.count)
+            for rollup in rollups]
@@ -0,0 +1,125 @@
+import datetime
+
+from django.conf import settings
+from django.db import models
+from django.utils import timezone
+
+# days of history kept per model, override with ANALYTICS_RETENTION_DAYS
+DEFAULT_RETENTION_DAYS = {
+    'LightHistory': 365,
+    'OutletHistory': 365,
+    'MotionSensorHistory': 90,
+    'SoundSensorHistory': 30,
+    'LightSensorHistory': 90,
+    'TemperatureSensorHistory': 365,
+    'WIFIHistory': 30,
+}
+
+
+def bucket_for(time):
+    """ Month partition key of a timestamp, e.g. 201702. Aware timestamps are
+    bucketed by their UTC month, so a row gets the same bucket whatever zone
+    it was recorded or queried in. """
+    if timezone.is_aware(time):
+        time = time.astimezone(timezone.utc)
+    return time.year * 100 + time.month
+
+
+class TimeSeriesQuerySet(models.QuerySet):
+
+    def for_series(self, series):
+        """ Rows of one device (a model instance or pk) """
+        return self.filter(**{self.model.series_field: series})
+
+    def between(self, start=None, end=None):
+        """ Rows with start <= time < end, restricted to the month buckets in range """
+        queryset = self
+        if start is not None:
+            queryset = queryset.filter(**{'bucket__gte': bucket_for(start), self.model.time_field + '__gte': start})
+        if end is not None:
+            queryset = queryset.filter(**{'bucket__lte': bucket_for(end), self.model.time_field + '__lt': end})
+        return queryset
+
+    def range(self, series, start=None, end=None, limit=1000, after=None):
+        """ Up to limit rows of one device in time order.
+        Pass the (time, pk) of the last row as after to read the next page;
+        this seeks on the (device, time) index instead of using OFFSET.
+        """
+        time_field = self.model.time_field
+        queryset = self.for_series(series).between(start, end)
+        if after is not None:
+            after_time, after_pk = after
+            queryset = queryset.filter(models.Q(**{time_field + '__gt': after_time}) |
+                                       models.Q(**{time_field: after_time, 'pk__gt': after_pk}))
+        return queryset.order_by(time_field, 'pk')[:limit]
+
+    def iterate(self, series, start=None, end=None, page_size=5000):
+        """ Every row of one device in time order, read in pages """
+        after = None
+        while True:
+            page = list(self.range(series, start, end, page_size, after))
+            for row in page:
+                yield row
+            if len(page) < page_size:
+                return
+            after = (getattr(page[-1], self.model.time_field), page[-1].pk)
+
+    def prune(self, before):
+        """ Delete rows older than before: whole expired months by bucket, then the boundary month """
+        deleted = self.filter(bucket__lt=bucket_for(before)).delete()[0]
+        deleted += self.filter(**{'bucket': bucket_for(before), self.model.time_field + '__lt': before}).delete()[0]
+        return deleted
+
+    def bulk_create(self, objs, batch_size=None):
+        for obj in objs:
+            obj.set_bucket()
+        return super(TimeSeriesQuerySet, self).bulk_create(objs, batch_size)
+
+
+class TimeSeriesModel(models.Model):
+
+    """ Base for history tables: rows are partitioned by month in bucket and
+    read through TimeSeriesQuerySet. Subclasses name their device foreign
+    key in series_field and their timestamp in time_field, and should index
+    (series_field, time_field) and (series_field, 'bucket', time_field).
+    """
+    series_field = None
+    time_field = None
+
+    bucket = models.PositiveIntegerField(default=0, db_index=True)
+
+    objects = TimeSeriesQuerySet.as_manager()
+
+    class Meta:
+        abstract = True
+
+    def set_bucket(self):
+        time = getattr(self, self.time_field)
+        if time is None:
+            time = timezone.now()
+            setattr(self, self.time_field, time)
+        self.bucket = bucket_for(time)
+
+    def save(self, *args, **kwargs):
+        self.set_bucket()
+        super(TimeSeriesModel, self).save(*args, **kwargs)
+
+
+def retention_days():
+    days = dict(DEFAULT_RETENTION_DAYS)
+    days.update(getattr(settings, 'ANALYTICS_RETENTION_DAYS', {}))
+    return days
+
+
+def apply_retention(now=None):
+    """ Prune every history model to its retention period, returns {model name: rows deleted} """
+    from django.apps import apps
+    if now is None:
+        now = timezone.now()
+    deleted = {}
+    for name, days in retention_days().items():
+        if days is None:
+            continue
+        model = apps.get_model('analytics', name)
+        deleted[name] = model.objects.prune(now - datetime.timedelta(days=days))
+    return deleted
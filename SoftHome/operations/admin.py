@@ -1,6 +1,6 @@
 from django.contrib import admin
-from .models import Group, LightGroup, Room, RoomConnection, Condition, Rule, Action
+from .models import Group, LightGroup, Room, RoomConnection, Condition, Rule, Action, ScheduledAction
 # Register your models here.
 
 
-admin.site.register([Group, LightGroup, Room, RoomConnection, Condition, Rule, Action])
\ No newline at end of file
+admin.site.register([Group, LightGroup, Room, RoomConnection, Condition, Rule, Action, ScheduledAction])
\ No newline at end of file
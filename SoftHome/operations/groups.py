@@ -0,0 +1,50 @@
+import logging
+
+from MachineInterface.models import Light
+from MachineInterface.registry import registry
+import hue_batch
+
+logger = logging.getLogger(__name__)
+
+
+def plan(group):
+    """ The fewest bridge writes reaching every light under group, as
+    {controller pk: [(kind, target, light indexes)]}. Lights are resolved
+    through GroupClosure in one query, then each bridge's share is covered
+    with its own groups where they fit exactly (hue_batch.cover_lights).
+    A bridge whose stored groups are not fresh gets one write per light. """
+    by_bridge = {}
+    for controller_id, index in group.all_lights().filter(controller__isnull=False).values_list(
+            'controller_id', 'controller_index'):
+        by_bridge.setdefault(controller_id, set()).add(index)
+    plans = {}
+    for controller_id, lights in by_bridge.items():
+        bridge = registry.bridge(controller_id)
+        if bridge.memberships_fresh():
+            plans[controller_id] = hue_batch.cover_lights(lights, *bridge.get_light_memberships())
+        else:
+            plans[controller_id] = hue_batch.cover_lights(lights)
+    return plans
+
+
+def set_state(group, data):
+    """ Send a light state (e.g. {'on': True, 'bri': 200}) to every light under group,
+    across bridges. Returns True if every write succeeded. """
+    futures = []
+    for controller_id, writes in plan(group).items():
+        queue = registry.bridge(controller_id).command_queue()
+        for kind, target, lights in writes:
+            futures.append(queue.submit(kind, target, data))
+    ok = True
+    for future in futures:
+        try:
+            result = future.result()
+            ok = isinstance(result, list) and not any('error' in line for line in result) and ok
+        except Exception:
+            logger.exception("Group {0} write failed".format(group.pk))
+            ok = False
+    if ok:
+        fields = dict((Light.STATE_FIELDS[name], value) for name, value in data.items() if name in Light.STATE_FIELDS)
+        for light in group.all_lights():
+            light.remember(**fields)
+    return ok
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from operations.models import GroupClosure
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the subgroup closure table used to resolve groups to their lights'
+
+    def handle(self, *args, **options):
+        rows = GroupClosure.rebuild()
+        self.stdout.write('{0} closure rows'.format(rows))
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from operations.schedules import ScheduleEngine
+
+
+class Command(BaseCommand):
+    help = 'Run scheduled light and group actions, offloading imminent runs to the bridges'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+                            help='Run the actions that are due once instead of running until stopped')
+
+    def handle(self, *args, **options):
+        engine = ScheduleEngine()
+        if not options['once']:
+            engine.run()
+            return
+        wait = engine.run_once()
+        self.stdout.write('{0} actions, next due in {1:.0f} s'.format(engine.stats()['actions'], wait))
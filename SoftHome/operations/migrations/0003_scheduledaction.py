@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.3 on 2026-10-18 16:10
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Portal', '0003_auto_20170202_0002'),
+        ('operations', '0002_auto_20170202_0002'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ScheduledAction',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100)),
+                ('kind', models.CharField(choices=[('light', 'Light'), ('group', 'Group')], default='light', max_length=10)),
+                ('target', models.PositiveSmallIntegerField(default=0)),
+                ('data', models.TextField(default='{}')),
+                ('next_run', models.DateTimeField(db_index=True)),
+                ('interval', models.PositiveIntegerField(blank=True, null=True)),
+                ('weekdays', models.PositiveSmallIntegerField(default=0)),
+                ('enabled', models.BooleanField(default=True)),
+                ('last_run', models.DateTimeField(blank=True, null=True)),
+                ('last_updated', models.DateTimeField(auto_now=True)),
+                ('bridge_schedule_id', models.CharField(blank=True, max_length=32, null=True)),
+                ('offloaded_run', models.DateTimeField(blank=True, null=True)),
+                ('controller', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='scheduled_actions', to='Portal.Device')),
+            ],
+        ),
+    ]
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.3 on 2026-10-18 17:20
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def build_closure(apps, schema_editor):
+    """ Closure rows of the existing groups, as GroupClosure.rebuild() computes them.
+    Group.subgroups is read from its table, since it is missing from the migration state. """
+    Group = apps.get_model('operations', 'Group')
+    GroupClosure = apps.get_model('operations', 'GroupClosure')
+    connection = schema_editor.connection
+    children = {}
+    if 'operations_group_subgroups' in connection.introspection.table_names():
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT from_group_id, to_group_id FROM operations_group_subgroups')
+            for parent, child in cursor.fetchall():
+                children.setdefault(parent, set()).add(child)
+    rows = []
+    for ancestor in Group.objects.values_list('pk', flat=True):
+        depths = {ancestor: 0}
+        level = [ancestor]
+        while level:
+            following = []
+            for node in level:
+                for other in children.get(node, ()):
+                    if other not in depths:
+                        depths[other] = depths[node] + 1
+                        following.append(other)
+            level = following
+        rows.extend(GroupClosure(ancestor_id=ancestor, descendant_id=descendant, depth=depth)
+                    for descendant, depth in depths.items())
+    GroupClosure.objects.bulk_create(rows)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('operations', '0003_scheduledaction'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GroupClosure',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('depth', models.PositiveSmallIntegerField(default=0)),
+                ('ancestor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='descendant_links', to='operations.Group')),
+                ('descendant', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ancestor_links', to='operations.Group')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='groupclosure',
+            unique_together=set([('ancestor', 'descendant')]),
+        ),
+        migrations.RunPython(build_closure, migrations.RunPython.noop),
+    ]
@@ -1,10 +1,19 @@
-from django.db import models
+import json
+
+from django.conf import settings
+from django.db import models, transaction
 from django.apps import apps
+from django.utils import timezone
 from MachineInterface.models import Light
+from MachineInterface import reconcile
+import hue_schedule
+import pytz
 
 
 CONNECTION_TYPES = ((1, 'Wall'), (2, 'Door'), (3, 'Open Space'), (4, 'Counter/Half-wall'))
 SIDES = ((1, 'Left'), (2, 'Right'), (3, 'Top'), (4, 'Bottom'))
+OPPOSITE_SIDES = {1: 2, 2: 1, 3: 4, 4: 3}
+WALKABLE_CONNECTIONS = (2, 3, 4)   # #every connection type but a wall
 
 
 class Group(models.Model):
@@ -24,6 +33,60 @@ class Group(models.Model):
     def __str__(self):
         return self.name
 
+    def all_lights(self):
+        """ Every Light in this group or its subgroups at any depth, in one query """
+        return Light.objects.filter(device__lights__group__ancestor_links__ancestor=self).distinct()
+
+
+class GroupClosure(models.Model):
+    """ Transitive closure of Group.subgroups: a row for each group and every
+    group below it (itself at depth 0). Kept current by operations.signals """
+    ancestor = models.ForeignKey(Group, related_name='descendant_links')
+    descendant = models.ForeignKey(Group, related_name='ancestor_links')
+    depth = models.PositiveSmallIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('ancestor', 'descendant')
+
+    @classmethod
+    def rebuild(cls, group_ids=None):
+        """ Recompute the rows of group_ids and every group above them, or of all groups """
+        children = {}
+        parents = {}
+        for parent, child in Group.subgroups.through.objects.values_list('from_group_id', 'to_group_id'):
+            children.setdefault(parent, set()).add(child)
+            parents.setdefault(child, set()).add(parent)
+        if group_ids is None:
+            affected = set(Group.objects.values_list('pk', flat=True))
+        else:
+            affected = set(reachable(group_ids, parents))
+            affected &= set(Group.objects.filter(pk__in=affected).values_list('pk', flat=True))
+        rows = [cls(ancestor_id=ancestor, descendant_id=descendant, depth=depth)
+                for ancestor in affected
+                for descendant, depth in reachable([ancestor], children).items()]
+        with transaction.atomic():
+            if group_ids is None:
+                cls.objects.all().delete()
+            else:
+                cls.objects.filter(ancestor_id__in=affected).delete()
+            cls.objects.bulk_create(rows)
+        return len(rows)
+
+
+def reachable(start, edges):
+    """ {node: distance} of every node reachable from start through edges ({node: set of nodes}) """
+    depths = dict((node, 0) for node in start)
+    level = list(depths)
+    while level:
+        following = []
+        for node in level:
+            for other in edges.get(node, ()):
+                if other not in depths:
+                    depths[other] = depths[node] + 1
+                    following.append(other)
+        level = following
+    return depths
+
 
 class LightGroup(Group):
     group = models.OneToOneField(Group, parent_link=True, related_name='light_group')
@@ -38,47 +101,53 @@ class LightGroup(Group):
         return self.name
 
     @classmethod
-    def import_all(cls, api, controller):
-        new_groups = []
-        if api == 'philips':
+    def philips_fields(cls, group):
+        """ Model fields for one group of a bridge /groups payload """
+        color_ct = 153
+        color_cie = '[0.31306, 0.32318]'
+        if 'ct' in group['action']:
+            color_ct = int(group['action']['ct'])
+            color_cie = Light.convert_color(group['action']['ct'])
+        elif 'xy' in group['action']:
+            color_cie = group['action']['xy']
+            color_ct = Light.convert_color(int(group['action']['xy']))
+
+        return {
+            'type': 'DeviceGroup',
+            'name': group['name'],
+            'action_state': group['action']['on'],
+            'all_on': group['state']['all_on'],
+            'any_on': group['state']['any_on'],
+            'brightness': int(group['action']['bri']),
+            'color_temperature': color_ct,
+            'color_cie_xy': color_cie,
+            'colormode': group['action']['colormode'],
+            'alert': group['action']['alert'],
+        }
+
+    @classmethod
+    def import_all(cls, api, controller, groups=None, present=None):
+        """ Reconcile this controller's groups and their members with the bridge,
+        returns a Reconciliation. groups may hold only the changed groups if
+        present lists every index still on the bridge.
+        """
+        if api != 'philips':
+            return reconcile.Reconciliation()
+        if groups is None:
             groups = controller.get_group()
-            for group in groups:
-                color_ct = 153
-                color_cie = '[0.31306, 0.32318]'
-                if 'ct' in groups[group]['action']:
-                    color_ct = int(groups[group]['action']['ct'])
-                    color_cie = Light.convert_color(groups[group]['action']['ct'])
-                elif 'xy' in groups[group]['action']:
-                    color_cie = groups[group]['action']['xy']
-                    color_ct = Light.convert_color(int(groups[group]['action']['xy']))
-
-                new_group, created = cls.objects.update_or_create(
-                    type='DeviceGroup',
-                    controller=controller.philips_device,
-                    controller_index=int(group),
-                    name=groups[group]['name'],
-                    defaults={
-                        'action_state': groups[group]['action']['on'],
-                        'all_on': groups[group]['state']['all_on'],
-                        'any_on': groups[group]['state']['any_on'],
-                        'brightness': int(groups[group]['action']['bri']),
-                        'color_temperature': color_ct,
-                        'color_cie_xy': color_cie,
-                        'colormode': groups[group]['action']['colormode'],
-                        'alert': groups[group]['action']['alert'],
-                    }
-                    )
-
-                new_groups.append(new_group)
-                new_groups[-1].save()
-
-                new_groups[-1].lights.clear()
-                for light in groups[group]['lights']:
-                    new_light = Light.objects.filter(controller_index=int(light), controller=controller.philips_device)
-                    if new_light.count()>0:
-                        new_groups[-1].lights.add(new_light[0].light_device)
-
-        return new_groups
+        rows = dict((int(group), cls.philips_fields(groups[group])) for group in groups)
+        with transaction.atomic():
+            result = reconcile.reconcile(cls, controller, rows, present)
+            light_pks = dict(Light.objects.filter(controller_id=controller.pk).values_list('controller_index', 'pk'))
+            memberships = {}
+            for new_group in result:
+                if str(new_group.controller_index) not in groups:
+                    continue
+                members = groups[str(new_group.controller_index)]['lights']
+                memberships[new_group.pk] = set(light_pks[int(light)] for light in members
+                                                if int(light) in light_pks)
+            reconcile.reconcile_members(cls.lights.through, 'lightgroup', 'device', memberships)
+        return result
 
 
 class Room(Group):
@@ -96,24 +165,23 @@ class Room(Group):
         return self.name
 
     def add_connection(self, room, connection, side, symm=True):
-        connection = RoomConnection(
-            first_room=self,
-            second_room=room,
-            connection=connection,
-            side=side
-        )
-        if symm:
-            # left becomes right, top becomes bottom
-            if side == 1:
-                other_side = 2
-            elif side == 2:
-                other_side = 1
-            elif side == 3:
-                other_side = 4
-            else:
-                other_side = 3
-            room.add_connection(self, connection, other_side, False)
-        return connection
+        """ Connect room on side of this room, and this room on the opposite side of room if symm """
+        with transaction.atomic():
+            first = RoomConnection.objects.create(
+                first_room=self,
+                second_room=room,
+                connection=connection,
+                side=side
+            )
+            if symm:
+                # left becomes right, top becomes bottom
+                RoomConnection.objects.create(
+                    first_room=room,
+                    second_room=self,
+                    connection=connection,
+                    side=OPPOSITE_SIDES.get(side, 3)
+                )
+        return first
 
     def remove_connection(self, room, symm=True):
         RoomConnection.objects.filter(
@@ -124,15 +192,25 @@ class Room(Group):
             room.remove_connection(self, False)
 
     def get_connections(self, side):
-        return self.room_connections.filter(
-            first_room__side=side,
-            first_room=self
-        )
+        return Room.objects.filter(
+            second_room__first_room=self,
+            second_room__side=side
+        ).distinct()
 
     def get_all_connections(self):
-        return self.room_connections.filter(
-            first_room=self
-        )
+        return Room.objects.filter(
+            second_room__first_room=self
+        ).distinct()
+
+    def neighbours(self, connections=None, side=None):
+        """ Pks of the rooms connected to this one, from the cached room graph """
+        from .rooms import graph
+        return graph.neighbours(self.pk, connections, side)
+
+    def nearby(self, hops=1, connections=WALKABLE_CONNECTIONS):
+        """ Pks of the rooms at most hops connections away, from the cached room graph """
+        from .rooms import graph
+        return graph.within(self.pk, hops, connections)
 
 
 class RoomConnection(models.Model):
@@ -176,3 +254,62 @@ class Action(models.Model):
 
     def __str__(self):
         return self.rule.name
+
+
+class ScheduledAction(models.Model):
+    """ A light state or group action run by operations.schedules at next_run,
+    once or repeating every interval seconds or on weekdays (bit 0 = Monday)
+    at next_run's local time of day """
+    KINDS = (('light', 'Light'), ('group', 'Group'))
+
+    name = models.CharField(max_length=100)
+    controller = models.ForeignKey("Portal.Device", related_name='scheduled_actions')
+    kind = models.CharField(max_length=10, choices=KINDS, default='light')
+    target = models.PositiveSmallIntegerField(default=0)   # #controller_index of the light or group
+    data = models.TextField(default='{}')   # #JSON state body
+    next_run = models.DateTimeField(db_index=True)
+    interval = models.PositiveIntegerField(null=True, blank=True)
+    weekdays = models.PositiveSmallIntegerField(default=0)
+    enabled = models.BooleanField(default=True)
+    last_run = models.DateTimeField(null=True, blank=True)
+    last_updated = models.DateTimeField(auto_now=True)
+    bridge_schedule_id = models.CharField(max_length=32, null=True, blank=True)   # #when next_run is offloaded
+    offloaded_run = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return self.name
+
+    def body(self):
+        return json.loads(self.data or '{}')
+
+    def is_offloaded(self):
+        """ True when the bridge holds a schedule for the pending run """
+        return bool(self.bridge_schedule_id) and self.offloaded_run == self.next_run
+
+    def following(self, after):
+        """ The first run later than after, or None if the action is done """
+        if self.weekdays and not self.interval:
+            run = hue_schedule.next_occurrence(local_time(self.next_run), local_time(after), weekdays=self.weekdays)
+            if run is not None and settings.USE_TZ:
+                run = aware_local(run)
+            return run
+        return hue_schedule.next_occurrence(self.next_run, after, self.interval)
+
+
+def local_time(value):
+    """ Local naive datetime of value """
+    if timezone.is_aware(value):
+        return timezone.localtime(value).replace(tzinfo=None)
+    return value
+
+
+def aware_local(value):
+    """ Aware datetime of a local naive one. A time skipped by a DST change
+    moves forward by the gap (02:30 becomes 03:30) and a time that occurs
+    twice resolves to the first occurrence. """
+    try:
+        return timezone.make_aware(value)
+    except pytz.NonExistentTimeError:
+        return timezone.make_aware(value, is_dst=False)
+    except pytz.AmbiguousTimeError:
+        return timezone.make_aware(value, is_dst=True)
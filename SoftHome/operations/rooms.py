@@ -0,0 +1,114 @@
+import collections
+import threading
+import time
+
+from django.conf import settings
+
+from .models import RoomConnection
+
+
+def _pk(room):
+    return getattr(room, 'pk', room)
+
+
+class RoomGraph(object):
+
+    """ Room adjacency held in memory, so following motion from room to room
+    needs no queries. Built from every RoomConnection in one query on first
+    use and dropped by invalidate(), which the RoomConnection save and delete
+    signals call, and rebuilt once it is ttl seconds old so connections saved
+    by other processes are picked up. Connections are directed as stored; add_connection() stores
+    both directions. Methods take Rooms or pks and return pks; connections
+    limits traversal to those connection types, e.g. WALKABLE_CONNECTIONS.
+    """
+    def __init__(self, ttl=None):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._adjacency = None  # room pk -> ((neighbour pk, connection type, side), ...)
+        self._loaded = None
+        self.loads = 0
+
+    def invalidate(self):
+        with self._lock:
+            self._adjacency = None
+
+    def load(self):
+        adjacency = {}
+        for first, second, connection, side in RoomConnection.objects.values_list(
+                'first_room_id', 'second_room_id', 'connection', 'side'):
+            adjacency.setdefault(first, []).append((second, connection, side))
+        adjacency = dict((room, tuple(edges)) for room, edges in adjacency.items())
+        with self._lock:
+            self._adjacency = adjacency
+            self._loaded = time.time()
+            self.loads += 1
+        return adjacency
+
+    def _graph(self):
+        adjacency = self._adjacency
+        ttl = self.ttl if self.ttl is not None else getattr(settings, 'ROOM_GRAPH_TTL', 300)
+        if adjacency is None or time.time() - self._loaded > ttl:
+            adjacency = self.load()
+        return adjacency
+
+    def neighbours(self, room, connections=None, side=None):
+        """ Rooms one connection away, optionally only through connections types or on one side """
+        result = []
+        for neighbour, connection, edge_side in self._graph().get(_pk(room), ()):
+            if (connections is None or connection in connections) and side in (None, edge_side):
+                if neighbour not in result:
+                    result.append(neighbour)
+        return result
+
+    def distances(self, room, connections=None, max_hops=None):
+        """ Breadth-first {room pk: hops} of every room reachable from room, itself at 0 """
+        adjacency = self._graph()
+        start = _pk(room)
+        hops = {start: 0}
+        queue = collections.deque([start])
+        while queue:
+            current = queue.popleft()
+            if max_hops is not None and hops[current] >= max_hops:
+                continue
+            for neighbour, connection, side in adjacency.get(current, ()):
+                if neighbour not in hops and (connections is None or connection in connections):
+                    hops[neighbour] = hops[current] + 1
+                    queue.append(neighbour)
+        return hops
+
+    def within(self, room, hops, connections=None):
+        """ Rooms at most hops connections away, not counting room itself """
+        nearby = self.distances(room, connections, hops)
+        nearby.pop(_pk(room), None)
+        return set(nearby)
+
+    def shortest_path(self, start, end, connections=None):
+        """ Room pks from start to end through the fewest connections, or None """
+        adjacency = self._graph()
+        start, end = _pk(start), _pk(end)
+        previous = {start: None}
+        queue = collections.deque([start])
+        while queue:
+            current = queue.popleft()
+            if current == end:
+                path = []
+                while current is not None:
+                    path.append(current)
+                    current = previous[current]
+                return path[::-1]
+            for neighbour, connection, side in adjacency.get(current, ()):
+                if neighbour not in previous and (connections is None or connection in connections):
+                    previous[neighbour] = current
+                    queue.append(neighbour)
+        return None
+
+    def stats(self):
+        adjacency = self._adjacency or {}
+        return {
+            'rooms': len(adjacency),
+            'connections': sum(len(edges) for edges in adjacency.values()),
+            'loads': self.loads,
+        }
+
+
+graph = RoomGraph()
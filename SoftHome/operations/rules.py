@@ -0,0 +1,312 @@
+import json
+import logging
+import operator
+import queue
+import re
+import threading
+
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+
+from .models import Rule, Condition
+
+logger = logging.getLogger(__name__)
+
+OPERATORS = {
+    '=': operator.eq,
+    '==': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+}
+
+# state names a condition can read from each kind of device
+LIGHT_STATES = {'on': 'state', 'state': 'state', 'bri': 'brightness', 'brightness': 'brightness',
+                'ct': 'color_temperature', 'reachable': 'reachable'}
+SENSOR_STATES = {'state': 'state', 'reachable': 'reachable'}
+
+TOKEN = re.compile(r'\s*(\d+|and|or|not|\(|\)|&&|\|\||!)', re.IGNORECASE)
+
+
+class RuleSyntaxError(Exception):
+    pass
+
+
+def compile_relations(relations, condition_ids):
+    """ Compile Rule.condition_relations into a function of {condition pk: bool}.
+    'and'/'all' (the default) and 'or'/'any' combine every condition, anything
+    else is a boolean expression over condition pks, e.g. '3 and (4 or not 5)'.
+    """
+    text = (relations or '').strip().lower()
+    if text in ('', 'and', 'all', '&&'):
+        return lambda status: all(status.get(pk, False) for pk in condition_ids)
+    if text in ('or', 'any', '||'):
+        return lambda status: any(status.get(pk, False) for pk in condition_ids)
+
+    tokens = []
+    position = 0
+    while position < len(text):
+        match = TOKEN.match(text, position)
+        if match is None:
+            if text[position:].strip():
+                raise RuleSyntaxError('Unexpected input in condition relations: ' + text[position:])
+            break
+        tokens.append({'&&': 'and', '||': 'or', '!': 'not'}.get(match.group(1), match.group(1)))
+        position = match.end()
+
+    def parse_or(i):
+        left, i = parse_and(i)
+        while i < len(tokens) and tokens[i] == 'or':
+            right, i = parse_and(i + 1)
+            left = (lambda a, b: lambda status: a(status) or b(status))(left, right)
+        return left, i
+
+    def parse_and(i):
+        left, i = parse_not(i)
+        while i < len(tokens) and tokens[i] == 'and':
+            right, i = parse_not(i + 1)
+            left = (lambda a, b: lambda status: a(status) and b(status))(left, right)
+        return left, i
+
+    def parse_not(i):
+        if i < len(tokens) and tokens[i] == 'not':
+            inner, i = parse_not(i + 1)
+            return (lambda a: lambda status: not a(status))(inner), i
+        return parse_atom(i)
+
+    def parse_atom(i):
+        if i >= len(tokens):
+            raise RuleSyntaxError('Condition relations end unexpectedly: ' + text)
+        if tokens[i] == '(':
+            inner, i = parse_or(i + 1)
+            if i >= len(tokens) or tokens[i] != ')':
+                raise RuleSyntaxError('Unbalanced parenthesis in condition relations: ' + text)
+            return inner, i + 1
+        if tokens[i].isdigit():
+            pk = int(tokens[i])
+            return (lambda status: status.get(pk, False)), i + 1
+        raise RuleSyntaxError('Unexpected token in condition relations: ' + tokens[i])
+
+    expression, end = parse_or(0)
+    if end != len(tokens):
+        raise RuleSyntaxError('Unexpected input in condition relations: ' + text)
+    return expression
+
+
+def device_states(device):
+    """ Current readable states of a Light or Sensor instance as {state name: value} """
+    names = LIGHT_STATES if device._meta.model_name == 'light' else SENSOR_STATES
+    return dict((name, getattr(device, field)) for name, field in names.items())
+
+
+def parse_action_value(value):
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+class RuleEngine(object):
+
+    """ Evaluates operations Rules when device state changes.
+    Conditions are indexed by device, so an event only re-evaluates the rules
+    that reference the device it came from. A rule fires its Actions when its
+    combined conditions become true; rules with recycle=False are disabled
+    after firing once. The index is built lazily and rebuilt after invalidate().
+    """
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._local = threading.local()
+        self._loaded = False
+        self._rules = {}        # rule pk -> Rule with conditions and actions attached
+        self._by_device = {}    # device pk -> set of rule pks
+        self._status = {}       # condition pk -> last evaluated result
+        self._relations = {}    # rule pk -> compiled condition_relations
+
+    def invalidate(self):
+        with self._lock:
+            self._loaded = False
+
+    def load(self):
+        rules = Rule.objects.filter(enabled=True).prefetch_related('conditions', 'action_set__device')
+        with self._lock:
+            self._rules = {}
+            self._by_device = {}
+            self._relations = {}
+            self._status = {}
+            for rule in rules:
+                rule.condition_list = [c for c in rule.conditions.all() if c.enabled]
+                rule.action_list = list(rule.action_set.all())
+                try:
+                    self._relations[rule.pk] = compile_relations(rule.condition_relations,
+                                                                 [c.pk for c in rule.condition_list])
+                except RuleSyntaxError as e:
+                    logger.warning("Rule {0} skipped: {1}".format(rule.pk, e))
+                    continue
+                self._rules[rule.pk] = rule
+                for condition in rule.condition_list:
+                    self._status[condition.pk] = condition.status
+                    self._by_device.setdefault(condition.device_id, set()).add(rule.pk)
+            self._loaded = True
+
+    def handle_event(self, device_id, states):
+        """ Re-evaluate the rules that depend on device_id given its new states
+        ({state name: value}). Returns the rules that fired. Events raised by
+        the actions of a firing rule are queued and handled afterwards.
+        """
+        queue = getattr(self._local, 'queue', None)
+        if queue is not None:
+            queue.append((device_id, states))
+            return []
+
+        self._local.queue = [(device_id, states)]
+        fired = []
+        try:
+            while self._local.queue:
+                fired.extend(self._evaluate(*self._local.queue.pop(0)))
+        finally:
+            self._local.queue = None
+        return fired
+
+    def _evaluate(self, device_id, states):
+        with self._lock:
+            if not self._loaded:
+                self.load()
+            changed_conditions = {}
+            changed_rules = {}
+            to_fire = []
+            for rule_pk in list(self._by_device.get(device_id, ())):
+                rule = self._rules[rule_pk]
+                for condition in rule.condition_list:
+                    if condition.device_id != device_id or condition.get_state not in states:
+                        continue
+                    compare = OPERATORS.get(condition.operator.strip())
+                    if compare is None:
+                        continue
+                    try:
+                        result = bool(compare(states[condition.get_state], condition.value))
+                    except TypeError:
+                        result = False
+                    if result != self._status.get(condition.pk):
+                        self._status[condition.pk] = result
+                        changed_conditions[condition.pk] = result
+
+                result = self._relations[rule_pk](self._status)
+                if result != rule.status:
+                    rule.status = result
+                    changed_rules[rule_pk] = result
+                    if result:
+                        to_fire.append(rule)
+                        if not rule.recycle:
+                            self._disable(rule)
+
+        self._persist(changed_conditions, changed_rules, to_fire)
+        for rule in to_fire:
+            self.fire(rule)
+        return to_fire
+
+    def _disable(self, rule):
+        rule.enabled = False
+        del self._rules[rule.pk]
+        for condition in rule.condition_list:
+            rules = self._by_device.get(condition.device_id)
+            if rules is not None:
+                rules.discard(rule.pk)
+
+    def _persist(self, changed_conditions, changed_rules, fired):
+        with transaction.atomic():
+            for status in (True, False):
+                pks = [pk for pk, value in changed_conditions.items() if value is status]
+                if pks:
+                    Condition.objects.filter(pk__in=pks).update(status=status)
+                pks = [pk for pk, value in changed_rules.items() if value is status]
+                if pks:
+                    Rule.objects.filter(pk__in=pks).update(status=status)
+            for rule in fired:
+                Rule.objects.filter(pk=rule.pk).update(last_triggered=timezone.now(), enabled=rule.enabled)
+
+    def fire(self, rule):
+        """ Run a rule's actions through the light and bridge control paths """
+        for action in rule.action_list:
+            try:
+                self.run_action(action)
+            except Exception:
+                logger.exception("Action {0} of rule {1} failed".format(action.pk, rule.pk))
+
+    def run_action(self, action):
+        device = action.device
+        value = parse_action_value(action.action)
+        if device.device_type == 'light bulb':
+            light = device.light_device
+            if action.set_state in ('on', 'state'):
+                if value in (True, 1, 'on', 'true'):
+                    return light.on()
+                return light.off()
+            if action.set_state in ('bri', 'brightness'):
+                return light.set_brightness(int(value))
+            if action.set_state in ('ct', 'color_temperature'):
+                return light.set_color(int(value))
+        elif device.device_type == 'controller' and device.api == 'philips':
+            # an action on a bridge applies to all of its lights (group 0)
+            return device.philips_device.set_group(0, action.set_state, value)
+        logger.warning("Action {0}: cannot set {1} on {2}".format(action.pk, action.set_state, device))
+
+
+engine = RuleEngine()
+
+
+class RuleDispatcher(threading.Thread):
+
+    """ Feeds device state changes to the rule engine from a background thread,
+    in the order they were committed, so rule actions (bridge requests) never
+    run inside the save that raised the event.
+    """
+    def __init__(self, engine):
+        threading.Thread.__init__(self, name='rule-dispatcher')
+        self.daemon = True
+        self.engine = engine
+        self.events = queue.Queue()
+        self.handled = 0
+        self.errors = 0
+
+    def put(self, device_id, states):
+        self.events.put((device_id, states))
+
+    def run(self):
+        while True:
+            device_id, states = self.events.get()
+            close_old_connections()
+            try:
+                self.engine.handle_event(device_id, states)
+                self.handled += 1
+            except Exception:
+                self.errors += 1
+                logger.exception("Rules for device {0} failed".format(device_id))
+            finally:
+                self.events.task_done()
+
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+
+def get_dispatcher(start=True):
+    """ Returns the rule dispatcher of this process, starting it if needed.
+    With start=False only a dispatcher already running here is returned. """
+    global _dispatcher
+    with _dispatcher_lock:
+        if _dispatcher is None or not _dispatcher.is_alive():
+            if not start:
+                return None
+            _dispatcher = RuleDispatcher(engine)
+            _dispatcher.start()
+        return _dispatcher
+
+
+def dispatch(device):
+    """ Queue the new state of a Light or Sensor for the rule engine once the
+    transaction that saved it commits; nothing is queued if it rolls back. """
+    device_id, states = device.pk, device_states(device)
+    transaction.on_commit(lambda: get_dispatcher().put(device_id, states))
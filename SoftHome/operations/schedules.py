@@ -0,0 +1,331 @@
+import datetime
+import json
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+
+from MachineInterface.registry import registry
+from .models import ScheduledAction, local_time
+import hue_schedule
+
+logger = logging.getLogger(__name__)
+
+
+class SendFailed(Exception):
+    """ The bridge did not accept a scheduled action's write """
+
+
+class ScheduleEngine(threading.Thread):
+
+    """ Runs ScheduledActions on time from a Timeline of next runs, so any
+    number of one-shot and repeating actions cost one sleeping thread.
+    Actions go out through their bridge's command queue.
+
+    Runs missed while the engine was down are caught up once, if they are
+    no more than misfire_grace seconds late, and repeating actions then
+    continue from their next future run. Runs due within offload_horizon
+    seconds are handed to the bridge as one-shot schedules, at most
+    bridge_slots per bridge, so they fire on time without depending on this
+    process; the engine then skips them when they come due. Bridge
+    schedules use local time, so the bridge must share TIME_ZONE.
+
+    Rows are reloaded when notify() is called (the save/delete signals do)
+    and every reload seconds, which picks up changes made by other processes.
+    In between, rows changed elsewhere that come due before the next reload
+    are looked up every poll seconds. A run whose bridge write fails is
+    retried after retry seconds instead of being dropped; an action only
+    moves on to its next run once its write succeeded, and if storing that
+    fails the new run is kept in memory and stored again on the next loop.
+    """
+    def __init__(self, reload=60.0, misfire_grace=3600, offload_horizon=60, bridge_slots=10, min_lead=2,
+                 poll=5.0, retry=30.0):
+        threading.Thread.__init__(self, name='schedule-engine')
+        self.daemon = True
+        self.reload = reload
+        self.misfire_grace = misfire_grace
+        self.offload_horizon = offload_horizon
+        self.bridge_slots = bridge_slots
+        self.min_lead = min_lead
+        self.poll = poll
+        self.retry = retry
+        self.timeline = hue_schedule.Timeline()
+        self.actions = {}       # pk -> ScheduledAction
+        self.offloaded = {}     # controller pk -> pks with a bridge schedule
+        self.unsaved = {}       # pk -> fields run but not stored yet
+        self._changed = set()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._loaded = None     # time.time() of the last reload
+        self._polled = None     # time.time() of the last load_due()
+        self._seen = None       # newest last_updated loaded
+        self.runs = 0
+        self.offloads = 0
+        self.missed = 0
+        self.errors = 0
+
+    def notify(self, pk):
+        """ Reload one action, e.g. after it was saved or deleted """
+        with self._lock:
+            self._changed.add(pk)
+        self._wake.set()
+
+    def stop(self):
+        self._stopped.set()
+        self._wake.set()
+
+    # Loading #####
+
+    def load(self, pks=None):
+        """ Reload the given actions, or every action changed since the last reload """
+        rows = ScheduledAction.objects.filter(enabled=True)
+        if pks is not None:
+            rows = rows.filter(pk__in=list(pks))
+        elif self._seen is not None:
+            rows = rows.filter(last_updated__gt=self._seen)
+        fresh = dict((row.pk, row) for row in rows)
+        for row in fresh.values():
+            if self._seen is None or row.last_updated > self._seen:
+                self._seen = row.last_updated
+        if pks is None:
+            present = set(ScheduledAction.objects.filter(enabled=True).values_list('pk', flat=True))
+            gone = set(self.actions) - present
+            self._loaded = self._polled = time.time()
+        else:
+            gone = set(pks) - set(fresh)
+        for pk in gone:
+            self.untrack(pk)
+        for row in fresh.values():
+            self.track(row)
+
+    def load_due(self, until):
+        """ Track rows changed since the last reload that are due by until.
+        _seen is left alone, so the next reload still finds every row changed
+        since the previous one. """
+        rows = ScheduledAction.objects.filter(enabled=True, next_run__lte=until)
+        if self._seen is not None:
+            rows = rows.filter(last_updated__gt=self._seen)
+        for row in rows:
+            old = self.actions.get(row.pk)
+            if old is None or old.last_updated != row.last_updated:
+                self.track(row)
+        self._polled = time.time()
+
+    @staticmethod
+    def _run_key(action):
+        return (action.controller_id, action.kind, action.target, action.data, action.next_run)
+
+    def track(self, action):
+        for name, value in self.unsaved.get(action.pk, {}).items():
+            # the row is behind this engine, do not run it again
+            setattr(action, name, value)
+        if not action.enabled:
+            self.actions.pop(action.pk, None)
+            self.timeline.remove(action.pk)
+            return
+        old = self.actions.get(action.pk)
+        if old is not None and old.is_offloaded():
+            if self._run_key(old) == self._run_key(action):
+                action.bridge_schedule_id, action.offloaded_run = old.bridge_schedule_id, old.offloaded_run
+            else:
+                self.cancel_offload(old)
+                action.bridge_schedule_id, action.offloaded_run = None, None
+        elif action.bridge_schedule_id and not action.is_offloaded():
+            # left over from a run that was moved while we were not looking
+            self.cancel_offload(action)
+        self.actions[action.pk] = action
+        if action.is_offloaded():
+            self.offloaded.setdefault(action.controller_id, set()).add(action.pk)
+        self.timeline.add(action.pk, action.next_run.timestamp())
+
+    def untrack(self, pk):
+        action = self.actions.pop(pk, None)
+        self.timeline.remove(pk)
+        if action is not None and action.is_offloaded():
+            self.cancel_offload(action)
+
+    # Running #####
+
+    def run_once(self, now=None):
+        """ Run or skip every due action and offload the imminent ones,
+        returns seconds until something is next due """
+        close_old_connections()
+        for pk, fields in list(self.unsaved.items()):
+            self.save(pk, fields)
+        with self._lock:
+            changed = self._changed
+            self._changed = set()
+        if self._loaded is None or time.time() - self._loaded >= self.reload:
+            self.load()
+        else:
+            if changed:
+                self.load(changed)
+            if time.time() - self._polled >= self.poll:
+                self.load_due(timezone.now() + datetime.timedelta(seconds=self._loaded + self.reload - time.time()))
+
+        now = now or timezone.now()
+        for pk, due in self.timeline.pop_due(now.timestamp()):
+            action = self.actions.get(pk)
+            if action is None:
+                continue
+            try:
+                self.fire(action, now)
+            except Exception:
+                self.errors += 1
+                logger.exception("Scheduled action {0} failed, retrying in {1} s".format(pk, self.retry))
+                # fire() changes nothing before the write succeeded, so this sends it once more at most
+                # pop_due dropped it and reloads only pick up rows whose last_updated moved
+                self.timeline.add(pk, now.timestamp() + self.retry)
+        self.offload(now)
+
+        wait = min(self._loaded + self.reload, self._polled + self.poll) - time.time()
+        next_due = self.timeline.next_due()
+        if next_due is not None:
+            wait = min(wait, next_due - time.time())
+            # wake up when the next run not yet offloaded enters the horizon
+            for pk, due in self.timeline.upcoming(next_due + self.offload_horizon):
+                if not self.actions[pk].is_offloaded() and due - self.offload_horizon > time.time():
+                    wait = min(wait, due - self.offload_horizon - time.time())
+                    break
+        return max(wait, 0)
+
+    def fire(self, action, now):
+        """ Run, skip or account for the due run of action and move it to its next run.
+        Raises, leaving the action as it was, when the bridge write fails. """
+        late = (now - action.next_run).total_seconds()
+        fields = {'bridge_schedule_id': None, 'offloaded_run': None}
+        if action.is_offloaded():
+            self.offloaded.get(action.controller_id, set()).discard(action.pk)
+            fields['last_run'] = action.next_run
+        elif late > self.misfire_grace:
+            self.missed += 1
+            logger.warning("Scheduled action {0} missed its run at {1}".format(action.pk, action.next_run))
+        else:
+            self.send(action)
+            fields['last_run'] = now
+
+        following = action.following(now)
+        if following is None:
+            fields['enabled'] = False
+        else:
+            fields['next_run'] = following
+        for name, value in fields.items():
+            setattr(action, name, value)
+        if following is None:
+            self.actions.pop(action.pk, None)
+        else:
+            self.timeline.add(action.pk, following.timestamp())
+        self.save(action.pk, fields)
+
+    def save(self, pk, fields):
+        """ Store fields of a run on its row, or keep them in unsaved to store later """
+        fields = dict(self.unsaved.pop(pk, {}), **fields)
+        try:
+            # update() leaves last_updated alone, so the next reload does not pick the row up again
+            ScheduledAction.objects.filter(pk=pk).update(**fields)
+        except Exception:
+            logger.exception("Storing the run of scheduled action {0} failed".format(pk))
+            self.unsaved[pk] = fields
+
+    def send(self, action):
+        """ Write action to its bridge through the command queue and wait for the answer.
+        Raises SendFailed, or what the queue raised, when the write was not accepted. """
+        future = registry.bridge(action.controller_id).command_queue().submit(
+            action.kind, str(action.target), action.body())
+        result = future.result()
+        if not isinstance(result, list) or any('error' in line for line in result):
+            raise SendFailed('Bridge answered {0!r}'.format(result))
+        self.runs += 1
+
+    # Bridge schedules #####
+
+    def offload(self, now):
+        """ Hand the runs due within offload_horizon to their bridges while slots are free """
+        until = now.timestamp() + self.offload_horizon
+        for pk, due in self.timeline.upcoming(until):
+            action = self.actions[pk]
+            if action.is_offloaded() or action.next_run <= now or due - now.timestamp() < self.min_lead:
+                continue
+            slots = self.offloaded.setdefault(action.controller_id, set())
+            if len(slots) >= self.bridge_slots:
+                continue
+            try:
+                bridge = registry.bridge(action.controller_id)
+                create = bridge.create_schedule if action.kind == 'light' else bridge.create_group_schedule
+                result = create('SoftHome {0}'.format(action.pk), hue_schedule.bridge_time(local_time(action.next_run)),
+                                action.target, action.body())
+                schedule_id = str(result[0]['success']['id'])
+            except Exception:
+                self.errors += 1
+                logger.exception("Offloading scheduled action {0} failed".format(action.pk))
+                continue
+            action.bridge_schedule_id = schedule_id
+            action.offloaded_run = action.next_run
+            ScheduledAction.objects.filter(pk=pk).update(bridge_schedule_id=schedule_id,
+                                                         offloaded_run=action.next_run)
+            slots.add(pk)
+            self.offloads += 1
+
+    def cancel_offload(self, action):
+        self.offloaded.get(action.controller_id, set()).discard(action.pk)
+        try:
+            registry.bridge(action.controller_id).delete_schedule(action.bridge_schedule_id)
+        except Exception:
+            logger.exception("Removing the bridge schedule of action {0} failed".format(action.pk))
+        ScheduledAction.objects.filter(pk=action.pk).update(bridge_schedule_id=None, offloaded_run=None)
+        action.bridge_schedule_id, action.offloaded_run = None, None
+
+    def run(self):
+        while not self._stopped.is_set():
+            try:
+                wait = self.run_once()
+            except Exception:
+                logger.exception("Schedule loop failed")
+                wait = self.reload
+            self._wake.wait(wait)
+            self._wake.clear()
+        close_old_connections()
+
+    def stats(self):
+        return {
+            'actions': len(self.timeline),
+            'offloaded': sum(len(pks) for pks in self.offloaded.values()),
+            'unsaved': len(self.unsaved),
+            'runs': self.runs,
+            'offloads': self.offloads,
+            'missed': self.missed,
+            'errors': self.errors,
+        }
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_engine(start=True):
+    """ Returns the process-wide schedule engine, starting it if needed.
+    With start=False only an engine already running in this process is returned. """
+    global _engine
+    with _engine_lock:
+        if _engine is None or not _engine.is_alive():
+            if not start:
+                return None
+            _engine = ScheduleEngine(reload=getattr(settings, 'SCHEDULE_RELOAD', 60.0),
+                                     misfire_grace=getattr(settings, 'SCHEDULE_MISFIRE_GRACE', 3600),
+                                     offload_horizon=getattr(settings, 'SCHEDULE_OFFLOAD_SECONDS', 60),
+                                     bridge_slots=getattr(settings, 'SCHEDULE_BRIDGE_SLOTS', 10),
+                                     poll=getattr(settings, 'SCHEDULE_POLL', 5.0),
+                                     retry=getattr(settings, 'SCHEDULE_RETRY', 30.0))
+            _engine.start()
+        return _engine
+
+
+def schedule(controller, kind, target, data, when, interval=None, weekdays=0, name=''):
+    """ Create a ScheduledAction, e.g. schedule(bridge, 'group', 1, {'on': False}, at, weekdays=hue_schedule.EVERY_DAY) """
+    return ScheduledAction.objects.create(name=name or '{0} {1}'.format(kind, target), controller=controller,
+                                          kind=kind, target=target, data=json.dumps(data), next_run=when,
+                                          interval=interval, weekdays=weekdays)
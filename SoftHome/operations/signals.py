@@ -0,0 +1,69 @@
+from django.db.models.signals import post_save, pre_delete, post_delete, m2m_changed
+from django.dispatch import receiver
+
+from MachineInterface.models import Light, Sensor
+from MachineInterface import scenes
+from .models import Rule, Condition, Action, Group, GroupClosure, LightGroup, Room, RoomConnection, ScheduledAction
+from . import rooms, rules, schedules
+
+
+@receiver(post_save, sender=Light)
+@receiver(post_save, sender=Sensor)
+def device_state_changed(sender, instance, **kwargs):
+    rules.dispatch(instance)
+
+
+@receiver([post_save, post_delete], sender=Rule)
+@receiver([post_save, post_delete], sender=Condition)
+@receiver([post_save, post_delete], sender=Action)
+@receiver(m2m_changed, sender=Rule.conditions.through)
+def rules_changed(sender, **kwargs):
+    rules.engine.invalidate()
+
+
+@receiver(m2m_changed, sender=LightGroup.lights.through)
+def light_group_changed(sender, **kwargs):
+    # scene plans target groups by their members
+    scenes.engine.invalidate()
+
+
+@receiver([post_save, post_delete], sender=ScheduledAction)
+def scheduled_action_changed(sender, instance, **kwargs):
+    engine = schedules.get_engine(start=False)
+    if engine is not None:
+        engine.notify(instance.pk)
+
+
+@receiver(post_save, sender=Group)
+@receiver(post_save, sender=LightGroup)
+@receiver(post_save, sender=Room)
+def group_saved(sender, instance, created=False, **kwargs):
+    if created:
+        GroupClosure.objects.get_or_create(ancestor_id=instance.pk, descendant_id=instance.pk)
+
+
+@receiver(m2m_changed, sender=Group.subgroups.through)
+def subgroups_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'post_clear':
+        GroupClosure.rebuild()
+    elif action in ('post_add', 'post_remove'):
+        # forward: instance gained or lost children, reverse: pk_set did
+        GroupClosure.rebuild(pk_set if reverse else [instance.pk])
+
+
+@receiver(pre_delete, sender=Group)
+def group_deleting(sender, instance, **kwargs):
+    instance._closure_ancestors = list(GroupClosure.objects.filter(
+        descendant_id=instance.pk).exclude(ancestor_id=instance.pk).values_list('ancestor_id', flat=True))
+
+
+@receiver(post_delete, sender=Group)
+def group_deleted(sender, instance, **kwargs):
+    # deleting a group drops its subgroup links without an m2m_changed signal
+    if getattr(instance, '_closure_ancestors', None):
+        GroupClosure.rebuild(instance._closure_ancestors)
+
+
+@receiver([post_save, post_delete], sender=RoomConnection)
+def room_connections_changed(sender, **kwargs):
+    rooms.graph.invalidate()
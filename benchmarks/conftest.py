@@ -0,0 +1,89 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(ROOT, 'modules'), os.path.join(ROOT, 'SoftHome')]
+
+import hue_fakes  # noqa: E402
+import hue_pool  # noqa: E402
+
+LIGHTS = 50
+SENSORS = 12
+GROUPS = 5
+SCENES = 10
+
+
+@pytest.fixture
+def fake_bridge():
+    """ A fresh fake bridge per benchmark; set FAKE_HUE_LATENCY (seconds) to model a real bridge """
+    bridge = hue_fakes.FakeBridge(lights=LIGHTS, sensors=SENSORS, groups=GROUPS, scenes=SCENES,
+                                  latency=float(os.environ.get('FAKE_HUE_LATENCY', 0)))
+    yield bridge
+    hue_pool.close_all()
+    bridge.stop()
+
+
+_django_ready = False
+
+
+def setup_django():
+    """ Minimal settings with a throwaway SQLite file, created once per session.
+    The file is shared with background threads (rule dispatcher, command
+    queues), which an in-memory database is not; history is never flushed in
+    the background and writers wait on each other's locks instead of failing
+    with 'database is locked'. Tables are built from the models, since the
+    operations migrations lag behind them. """
+    global _django_ready
+    if _django_ready:
+        return
+    try:
+        import django
+    except ImportError:
+        pytest.skip('Django is not installed; the Django benchmarks need Django 1.10 or 1.11')
+    from django.conf import settings
+    apps = ['Portal', 'MachineInterface', 'operations', 'analytics']
+    settings.configure(
+        SECRET_KEY='benchmarks',
+        USE_TZ=True,
+        DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3',
+                               'NAME': os.path.join(tempfile.mkdtemp(), 'benchmarks.sqlite3'),
+                               'OPTIONS': {'timeout': 30}}},
+        INSTALLED_APPS=['django.contrib.auth', 'django.contrib.contenttypes'] + apps,
+        MIGRATION_MODULES=dict((app, None) for app in apps),
+        ANALYTICS_SPOOL_DIR=None,
+        ANALYTICS_FLUSH_ROWS=10 ** 6,
+        ANALYTICS_FLUSH_SECONDS=10 ** 6,
+        HUE_COMMAND_RATE=10 ** 6,
+    )
+    django.setup()
+    from django.core.management import call_command
+    call_command('migrate', run_syncdb=True, verbosity=0)
+    _django_ready = True
+
+
+def drain_rules():
+    """ Wait until the rule dispatcher has handled every queued device event """
+    from operations import rules
+    dispatcher = rules.get_dispatcher(start=False)
+    if dispatcher is not None:
+        dispatcher.events.join()
+
+
+@pytest.fixture
+def hue_bridge(fake_bridge):
+    """ A PhilipsHueBridge row pointing at fake_bridge """
+    setup_django()
+    from django.contrib.auth.models import User
+    from MachineInterface.models import PhilipsHueBridge
+    user, created = User.objects.get_or_create(username='benchmarks')
+    bridge = PhilipsHueBridge.objects.create(user=user, name='Fake bridge', ip_address=fake_bridge.host,
+                                             port=fake_bridge.port,
+                                             device_type='controller', api='philips',
+                                             bridge_user=fake_bridge.username)
+    drain_rules()
+    yield bridge
+    drain_rules()
+    bridge.delete()
@@ -0,0 +1,51 @@
+""" Cost of the PhilipsHueBridge import, sync and control paths against the fake bridge """
+from conftest import LIGHTS
+
+
+def test_import_all(benchmark, hue_bridge):
+    benchmark(hue_bridge.import_all)
+
+
+def test_import_changes_unchanged(benchmark, hue_bridge):
+    hue_bridge.import_changes()
+    benchmark(hue_bridge.import_changes)
+
+
+def test_import_changes_after_motion(benchmark, hue_bridge, fake_bridge):
+    hue_bridge.import_changes()
+    presence = [False]
+
+    def run():
+        presence[0] = not presence[0]
+        fake_bridge.trigger_motion(1, presence[0])
+        return hue_bridge.import_changes()
+    benchmark(run)
+
+
+def test_sync_bridge(benchmark, hue_bridge):
+    from MachineInterface.sync import sync_bridge
+    benchmark(sync_bridge, hue_bridge)
+
+
+def test_set_light_per_light(benchmark, hue_bridge):
+    lights = list(range(1, LIGHTS + 1))
+
+    def run():
+        for light in lights:
+            hue_bridge.set_light(light, 'bri', 100)
+    benchmark(run)
+
+
+def test_set_light_batched(benchmark, hue_bridge, fake_bridge):
+    benchmark(hue_bridge.set_light, list(range(1, LIGHTS + 1)), 'bri', 100)
+
+
+def test_set_light_states_mixed(benchmark, hue_bridge):
+    states = [(light, {'bri': light % 254 + 1}) for light in range(1, LIGHTS + 1)]
+    benchmark(hue_bridge.set_light_states, states)
+
+
+def test_activate_scene(benchmark, hue_bridge, fake_bridge):
+    scene_id = sorted(fake_bridge.state['scenes'])[0]
+    group_id = fake_bridge.state['scenes'][scene_id]['group']
+    benchmark(hue_bridge.activate_scene, group_id, scene_id)
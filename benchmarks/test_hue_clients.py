@@ -0,0 +1,48 @@
+""" Request cost of the phue and asyncio clients against the fake bridge """
+import hue_async
+import phue
+
+from conftest import LIGHTS
+
+
+def client(fake_bridge):
+    return phue.Bridge(fake_bridge.address, fake_bridge.username)
+
+
+def test_get_api(benchmark, fake_bridge):
+    bridge = client(fake_bridge)
+    benchmark(bridge.get_api)
+
+
+def test_set_light_per_light(benchmark, fake_bridge):
+    bridge = client(fake_bridge)
+    lights = list(range(1, LIGHTS + 1))
+
+    def run():
+        for light in lights:
+            bridge.set_light(light, 'bri', 100)
+    benchmark(run)
+
+
+def test_set_light_list(benchmark, fake_bridge):
+    bridge = client(fake_bridge)
+    benchmark(bridge.set_light, list(range(1, LIGHTS + 1)), 'bri', 100)
+
+
+def test_set_group_all_lights(benchmark, fake_bridge):
+    bridge = client(fake_bridge)
+    benchmark(bridge.set_group, 0, 'bri', 100)
+
+
+def test_run_scene(benchmark, fake_bridge):
+    bridge = client(fake_bridge)
+    benchmark(bridge.run_scene, 'Room 1', 'Scene 1')
+    assert fake_bridge.request_count('PUT', 'groups') >= 1
+
+
+def test_async_fan_out(benchmark, fake_bridge):
+    bridge = hue_async.BlockingBridge(hue_async.AsyncBridge(fake_bridge.address, fake_bridge.username))
+    try:
+        benchmark(bridge.set_light, list(range(1, LIGHTS + 1)), 'bri', 100)
+    finally:
+        bridge.close()
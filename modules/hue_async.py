@@ -0,0 +1,363 @@
+import asyncio
+import json
+import logging
+
+import hue_pool
+
+logger = logging.getLogger('hue_async')
+
+
+class AsyncHueException(Exception):
+
+    def __init__(self, new_id, new_message):
+        self.id = new_id
+        self.message = new_message
+
+
+def split_host(address, default_port=80):
+    """ (host, port) of 'host', 'host:port', an IPv6 address or '[IPv6]:port' """
+    if address.startswith('['):
+        host, _, rest = address[1:].partition(']')
+        port = rest[1:] if rest.startswith(':') else ''
+    elif address.count(':') == 1:
+        host, _, port = address.partition(':')
+    else:
+        host, port = address, ''   # a bare IPv6 address or plain host
+    return host, int(port) if port else default_port
+
+
+class AsyncBridge(object):
+
+    """ asyncio client for the Hue bridge with the same surface as PhilipsHueBridge.
+    Each bridge allows max_concurrency requests in flight at once over
+    keep-alive connections; calls on lists of lights fan out concurrently.
+        >>> bridge = AsyncBridge('192.168.1.100', 'username')
+        >>> await bridge.set_light([1, 2, 3], 'on', True)
+    Coroutines must all run on the same event loop as the first request.
+    """
+    def __init__(self, ip, username, max_concurrency=4, timeout=10):
+        self.ip = ip
+        self.username = username
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+
+        self._host, self._port = split_host(ip)
+        self._host_header = '[{0}]'.format(self._host) if ':' in self._host else self._host
+        if self._port != 80:
+            self._host_header += ':{0}'.format(self._port)
+        self._semaphore = None
+        self._idle = []
+
+    def __repr__(self):
+        return '<{0}.{1} {2}>'.format(
+            self.__class__.__module__,
+            self.__class__.__name__,
+            self.ip)
+
+    @property
+    def base(self):
+        return '/api/' + self.username
+
+    # Transport #####
+    async def _open(self):
+        while self._idle:
+            reader, writer = self._idle.pop()
+            if not reader.at_eof() and not writer.transport.is_closing():
+                return reader, writer, True
+            writer.close()
+        reader, writer = await asyncio.open_connection(self._host, self._port)
+        return reader, writer, False
+
+    async def _roundtrip(self, reader, writer, mode, address, body):
+        lines = ['{0} {1} HTTP/1.1'.format(mode, address),
+                 'Host: {0}'.format(self._host_header),
+                 'Connection: keep-alive',
+                 'Content-Length: {0}'.format(len(body))]
+        if body:
+            lines.append('Content-Type: application/json')
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body)
+        await writer.drain()
+
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionResetError('Connection closed by bridge')
+        status = int(status_line.split()[1])
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            key, _, value = line.decode('latin-1').partition(':')
+            headers[key.strip().lower()] = value.strip()
+
+        keep = headers.get('connection', '').lower() != 'close'
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if size == 0:
+                    await reader.readline()
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readline()
+            data = b''.join(chunks)
+        elif 'content-length' in headers:
+            data = await reader.readexactly(int(headers['content-length']))
+        else:
+            data = await reader.read()
+            keep = False
+        return status, data, keep
+
+    async def request(self, mode='GET', address=None, data=None):
+        """ Utility coroutine for HTTP GET/PUT requests for the API"""
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        body = b''
+        if mode == 'PUT' or mode == 'POST':
+            body = json.dumps(data).encode('utf-8')
+
+        async with self._semaphore:
+            reader, writer, reused = await self._open()
+            keep = False
+            try:
+                try:
+                    status, result, keep = await asyncio.wait_for(
+                        self._roundtrip(reader, writer, mode, address, body), self.timeout)
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    if not reused or mode not in hue_pool.IDEMPOTENT_METHODS:
+                        raise
+                    # kept-alive socket was dropped by the bridge, retry once; never a POST,
+                    # which may already have created a group, scene or schedule
+                    writer.close()
+                    reader, writer = await asyncio.open_connection(self._host, self._port)
+                    status, result, keep = await asyncio.wait_for(
+                        self._roundtrip(reader, writer, mode, address, body), self.timeout)
+            except asyncio.TimeoutError:
+                error = "{} Request to {}{} timed out.".format(mode, self.ip, address)
+                raise AsyncHueException(None, error)
+            finally:
+                if keep:
+                    self._idle.append((reader, writer))
+                else:
+                    writer.close()
+
+        logger.debug("{0} {1} {2}".format(mode, address, str(data)))
+        return json.loads(str(result, encoding='utf-8'))
+
+    def close(self):
+        while self._idle:
+            reader, writer = self._idle.pop()
+            writer.close()
+
+    # Lights #####
+    async def get_light(self, light_id=None, parameter=None):
+        """ Gets state by light_id and parameter"""
+        if isinstance(light_id, str):
+            light_id = await self.get_light_id_by_name(light_id)
+        if light_id is None:
+            return await self.request('GET', self.base + '/lights/')
+        state = await self.request('GET', self.base + '/lights/' + str(light_id))
+        if parameter is None:
+            return state
+        if parameter in ['name', 'type', 'uniqueid', 'swversion']:
+            return state[parameter]
+        try:
+            return state['state'][parameter]
+        except KeyError:
+            return False
+
+    async def get_light_id_by_name(self, name):
+        """ Lookup a light id based on string name. Case-sensitive. """
+        lights = await self.get_light()
+        for light_id in lights:
+            if name == lights[light_id]['name']:
+                return light_id
+        return False
+
+    async def set_light(self, light_id, parameter, value=None, transitiontime=None):
+        """ Adjust properties of one or more lights, lists of lights are sent concurrently.
+        Returns one response per light like PhilipsHueBridge.set_light.
+        """
+        if isinstance(parameter, dict):
+            data = parameter
+        else:
+            data = {parameter: value}
+        if transitiontime is not None:
+            data['transitiontime'] = int(round(transitiontime))  # must be int for request format
+
+        light_id_array = light_id
+        if isinstance(light_id, int) or isinstance(light_id, str):
+            light_id_array = [light_id]
+
+        async def put(light):
+            if parameter == 'name':
+                return await self.request('PUT', self.base + '/lights/' + str(light), data)
+            if isinstance(light, str):
+                light = await self.get_light_id_by_name(light)
+            return await self.request('PUT', self.base + '/lights/' + str(light) + '/state', data)
+
+        return list(await asyncio.gather(*[put(light) for light in light_id_array]))
+
+    # Sensors #####
+    async def get_sensor(self, sensor_id=None, parameter=None):
+        """ Gets state by sensor_id and parameter"""
+        if isinstance(sensor_id, str):
+            sensor_id = await self.get_sensor_id_by_name(sensor_id)
+        if sensor_id is None:
+            return await self.request('GET', self.base + '/sensors/')
+        data = await self.request('GET', self.base + '/sensors/' + str(sensor_id))
+        if isinstance(data, list):
+            return None
+        if parameter is None:
+            return data
+        return data[parameter]
+
+    async def get_sensor_id_by_name(self, name):
+        """ Lookup a sensor id based on string name. Case-sensitive. """
+        sensors = await self.get_sensor()
+        for sensor_id in sensors:
+            if name == sensors[sensor_id]['name']:
+                return sensor_id
+        return False
+
+    async def set_sensor(self, sensor_id, parameter, value=None):
+        if isinstance(parameter, dict):
+            data = parameter
+        else:
+            data = {parameter: value}
+        return await self.request('PUT', self.base + '/sensors/' + str(sensor_id), data)
+
+    # Groups #####
+    async def get_group(self, group_id=None, parameter=None):
+        if isinstance(group_id, str):
+            group_id = await self.get_group_id_by_name(group_id)
+        if group_id is False:
+            return
+        if group_id is None:
+            return await self.request('GET', self.base + '/groups/')
+        group = await self.request('GET', self.base + '/groups/' + str(group_id))
+        if parameter is None:
+            return group
+        elif parameter == 'name' or parameter == 'lights':
+            return group[parameter]
+        return group['action'][parameter]
+
+    async def get_group_id_by_name(self, name):
+        """ Lookup a group id based on string name. Case-sensitive. """
+        groups = await self.get_group()
+        for group_id in groups:
+            if name == groups[group_id]['name']:
+                return group_id
+        return False
+
+    async def set_group(self, group_id, parameter, value=None, transitiontime=None):
+        """ Change light settings for one or more groups, sent concurrently """
+        if isinstance(parameter, dict):
+            data = parameter
+        elif parameter == 'lights' and (isinstance(value, list) or isinstance(value, int)):
+            if isinstance(value, int):
+                value = [value]
+            data = {parameter: [str(x) for x in value]}
+        else:
+            data = {parameter: value}
+        if transitiontime is not None:
+            data['transitiontime'] = int(round(transitiontime))
+
+        group_id_array = group_id
+        if isinstance(group_id, int) or isinstance(group_id, str):
+            group_id_array = [group_id]
+
+        async def put(group):
+            if isinstance(group, str):
+                group = await self.get_group_id_by_name(group)
+            if parameter == 'name' or parameter == 'lights':
+                return await self.request('PUT', self.base + '/groups/' + str(group), data)
+            return await self.request('PUT', self.base + '/groups/' + str(group) + '/action', data)
+
+        return list(await asyncio.gather(*[put(group) for group in group_id_array]))
+
+    # Scenes #####
+    async def get_scene(self):
+        return await self.request('GET', self.base + '/scenes')
+
+    async def activate_scene(self, group_id, scene_id):
+        return await self.request('PUT', self.base + '/groups/' + str(group_id) + '/action',
+                                  {"scene": scene_id})
+
+    # Schedules #####
+    async def get_schedule(self, schedule_id=None):
+        if schedule_id is None:
+            return await self.request('GET', self.base + '/schedules')
+        return await self.request('GET', self.base + '/schedules/' + str(schedule_id))
+
+    async def create_schedule(self, name, time, light_id, data, description=' '):
+        schedule = {
+            'name': name,
+            'localtime': time,
+            'description': description,
+            'command': {
+                'method': 'PUT',
+                'address': self.base + '/lights/' + str(light_id) + '/state',
+                'body': data
+            }
+        }
+        return await self.request('POST', self.base + '/schedules', schedule)
+
+    async def create_group_schedule(self, name, time, group_id, data, description=' '):
+        schedule = {
+            'name': name,
+            'localtime': time,
+            'description': description,
+            'command': {
+                'method': 'PUT',
+                'address': self.base + '/groups/' + str(group_id) + '/action',
+                'body': data
+            }
+        }
+        return await self.request('POST', self.base + '/schedules', schedule)
+
+    async def delete_schedule(self, schedule_id):
+        return await self.request('DELETE', self.base + '/schedules/' + str(schedule_id))
+
+
+async def fan_out(calls):
+    """ Run (bridge, method name, args) calls concurrently across bridges.
+    Results come back in the order of calls; failures are returned as exceptions.
+    """
+    return await asyncio.gather(*[getattr(bridge, method)(*args) for bridge, method, args in calls],
+                                return_exceptions=True)
+
+
+def run(coroutine):
+    """ Run a coroutine to completion on a private event loop """
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+class BlockingBridge(object):
+
+    """ Synchronous facade over AsyncBridge for code that is not async,
+    e.g. Django views and model methods. Owns its event loop, so an instance
+    must only be used from one thread.
+        >>> bridge = BlockingBridge(AsyncBridge('192.168.1.100', 'username'))
+        >>> bridge.set_light([1, 2, 3], 'on', True)
+    """
+    def __init__(self, bridge):
+        self.bridge = bridge
+        self._loop = asyncio.new_event_loop()
+
+    def __getattr__(self, name):
+        method = getattr(self.bridge, name)
+        if not asyncio.iscoroutinefunction(method):
+            return method
+
+        def call(*nargs, **kwargs):
+            return self._loop.run_until_complete(method(*nargs, **kwargs))
+        return call
+
+    def close(self):
+        self.bridge.close()
+        self._loop.close()
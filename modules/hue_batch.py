@@ -0,0 +1,101 @@
+import json
+
+ALL_LIGHTS_GROUP = '0'
+
+
+def payload_key(data):
+    """ Hashable key for a light state payload """
+    return json.dumps(data, sort_keys=True)
+
+
+def plan_light_writes(states, all_lights=None, groups=None, min_adhoc=4):
+    """ Plan the fewest bridge writes for a list of (light_id, data) pairs.
+    Lights receiving an identical payload are sent as one group action, using
+    group 0 when they are every light on the bridge, an existing group with
+    exactly the same members, or a temporary group when there are at least
+    min_adhoc of them (creating and deleting a group costs two requests).
+    Returns a list of (kind, target, data, light_ids) tuples where kind is
+    'group', 'adhoc' or 'light', in the order the payloads were first seen.
+    """
+    all_lights = frozenset(str(x) for x in all_lights or [])
+    groups_by_members = {}
+    for group_id, members in (groups or {}).items():
+        groups_by_members.setdefault(frozenset(str(x) for x in members), str(group_id))
+
+    buckets = []
+    by_key = {}
+    for light, data in states:
+        key = payload_key(data)
+        if key not in by_key:
+            by_key[key] = (data, [])
+            buckets.append(by_key[key])
+        if str(light) not in by_key[key][1]:
+            by_key[key][1].append(str(light))
+
+    plan = []
+    for data, lights in buckets:
+        members = frozenset(lights)
+        if len(lights) > 1 and members == all_lights:
+            plan.append(('group', ALL_LIGHTS_GROUP, data, lights))
+        elif len(lights) > 1 and members in groups_by_members:
+            plan.append(('group', groups_by_members[members], data, lights))
+        elif len(lights) >= min_adhoc:
+            plan.append(('adhoc', None, data, lights))
+        else:
+            for light in lights:
+                plan.append(('light', light, data, [light]))
+    return plan
+
+
+def cover_lights(lights, all_lights=None, groups=None):
+    """ Cover a set of lights of one bridge with the fewest writes that touch no other light.
+    Group 0 is used when lights are every light on the bridge; otherwise groups
+    whose members all belong to the set are picked greedily, largest gain of
+    uncovered lights first, while a group still covers at least two of them,
+    and the rest get one light write each.
+    Returns a list of (kind, target, light_ids) tuples, kind 'group' or 'light'.
+    """
+    wanted = frozenset(str(x) for x in lights)
+    if not wanted:
+        return []
+    if len(wanted) > 1 and wanted == frozenset(str(x) for x in all_lights or []):
+        return [('group', ALL_LIGHTS_GROUP, sorted(wanted, key=int))]
+    candidates = []
+    for group_id, members in (groups or {}).items():
+        members = frozenset(str(x) for x in members)
+        if len(members) > 1 and members <= wanted:
+            candidates.append((str(group_id), members))
+
+    plan = []
+    uncovered = set(wanted)
+    while candidates:
+        group_id, members = max(candidates, key=lambda item: (len(item[1] & uncovered), -int(item[0])))
+        if len(members & uncovered) < 2:
+            break
+        plan.append(('group', group_id, sorted(members, key=int)))
+        uncovered -= members
+        candidates.remove((group_id, members))
+    for light in sorted(uncovered, key=int):
+        plan.append(('light', light, [light]))
+    return plan
+
+
+def expand_group_result(response, group_id, light_ids):
+    """ Rewrite a group action response into the per-light response shape
+    returned by PUT /lights/<id>/state, keyed by light id """
+    prefix = '/groups/{0}/action'.format(group_id)
+    results = {}
+    for light in light_ids:
+        light_result = []
+        for line in response:
+            if 'success' in line:
+                success = {}
+                for address, value in line['success'].items():
+                    if address.startswith(prefix):
+                        address = '/lights/{0}/state'.format(light) + address[len(prefix):]
+                    success[address] = value
+                light_result.append({'success': success})
+            else:
+                light_result.append(line)
+        results[light] = light_result
+    return results
@@ -5,6 +5,8 @@ import logging
 import os
 import platform
 
+import hue_pool
+
 PY3K = True
 logger = logging.getLogger('phue')
 USER_HOME = 'HOME'
@@ -85,31 +87,18 @@ class Bridge(object):
             'PUT', '/api/' + self.username + '/config', data)
 
     def request(self, mode='GET', address=None, data=None):
-        """ Utility function for HTTP GET/PUT requests for the API"""
-        connection = httplib.HTTPConnection(self.ip, timeout=10)
-
+        """ Utility function for HTTP GET/PUT requests for the API.
+        Requests share a keep-alive connection pool per bridge ip. """
         try:
-            if mode == 'GET' or mode == 'DELETE':
-                connection.request(mode, address)
-            if mode == 'PUT' or mode == 'POST':
-                connection.request(mode, address, json.dumps(data))
-
+            result = hue_pool.request(self.ip, mode, address, data)
             logger.debug("{0} {1} {2}".format(mode, address, str(data)))
-
         except socket.timeout:
             error = "{} Request to {}{} timed out.".format(mode, self.ip, address)
 
             logger.exception(error)
             raise PhueRequestTimeout(None, error)
 
-        result = connection.getresponse()
-        connection.close()
-        if PY3K:
-            return json.loads(str(result.read(), encoding='utf-8'))
-        else:
-            result_str = result.read()
-            logger.debug(result_str)
-            return json.loads(result_str)
+        return result
 
     def get_ip_address(self, set_result=False):
 
@@ -0,0 +1,291 @@
+import http.client
+import http.server
+import json
+import logging
+import queue
+import socket
+import ssl
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+EVENT_PATH = '/eventstream/clip/v2'
+
+
+class EventStream(threading.Thread):
+
+    """ Reads the server-sent event stream newer bridges publish resource
+    updates on and calls callback(updates) with the updates of every event.
+    Dropped streams are reopened with exponential backoff, resuming from the
+    last event id seen. Use healthy() to decide whether the stream can be
+    trusted instead of polling.
+    """
+    def __init__(self, host, username, callback, port=None, scheme='https', path=EVENT_PATH,
+                 backoff=1.0, max_backoff=60.0, idle_timeout=120.0):
+        threading.Thread.__init__(self, name='hue-events-{0}'.format(host))
+        self.daemon = True
+        self.host = host
+        self.port = port
+        self.username = username
+        self.callback = callback
+        self.scheme = scheme
+        self.path = path
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.idle_timeout = idle_timeout
+
+        self.last_event_id = None
+        self.last_read = None
+        self.connected = False
+        self.connects = 0
+        self.events = 0
+        self.errors = 0
+        self._connection = None
+        self._stopped = threading.Event()
+
+    def healthy(self):
+        """ True while connected and the bridge was heard from within idle_timeout """
+        return (self.connected and self.last_read is not None and
+                time.time() - self.last_read < self.idle_timeout)
+
+    def stop(self):
+        self._stopped.set()
+        connection = self._connection
+        if connection is not None and connection.sock is not None:
+            # unblock the reader
+            try:
+                connection.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def _connect(self):
+        if self.scheme == 'https':
+            # bridges use a self-signed certificate
+            context = ssl.create_default_context()
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+            connection = http.client.HTTPSConnection(self.host, self.port, timeout=self.idle_timeout,
+                                                     context=context)
+        else:
+            connection = http.client.HTTPConnection(self.host, self.port, timeout=self.idle_timeout)
+        headers = {'Accept': 'text/event-stream', 'hue-application-key': self.username}
+        if self.last_event_id is not None:
+            headers['Last-Event-ID'] = self.last_event_id
+        connection.request('GET', self.path, headers=headers)
+        response = connection.getresponse()
+        if response.status != 200:
+            connection.close()
+            raise http.client.HTTPException('Event stream returned {0}'.format(response.status))
+        self._connection = connection
+        return response
+
+    def run(self):
+        delay = self.backoff
+        while not self._stopped.is_set():
+            try:
+                response = self._connect()
+                self.connected = True
+                self.connects += 1
+                self.last_read = time.time()
+                delay = self.backoff
+                self.read(response)
+            except (OSError, http.client.HTTPException) as e:
+                if not self._stopped.is_set():
+                    self.errors += 1
+                    logger.warning("Event stream from {0} dropped: {1}".format(self.host, e))
+            finally:
+                self.connected = False
+                if self._connection is not None:
+                    self._connection.close()
+                    self._connection = None
+            self._stopped.wait(delay)
+            delay = min(delay * 2, self.max_backoff)
+
+    def read(self, response):
+        """ Dispatch events from response until the stream ends """
+        event_id = None
+        data = []
+        while not self._stopped.is_set():
+            line = response.readline()
+            if not line:
+                return
+            self.last_read = time.time()
+            line = line.decode('utf-8').rstrip('\r\n')
+            if not line:
+                if data:
+                    self.dispatch(event_id, '\n'.join(data))
+                event_id = None
+                data = []
+                continue
+            if line.startswith(':'):
+                continue  # keep-alive comment
+            field, _, value = line.partition(':')
+            if value.startswith(' '):
+                value = value[1:]
+            if field == 'id':
+                event_id = value
+            elif field == 'data':
+                data.append(value)
+
+    def dispatch(self, event_id, data):
+        try:
+            containers = json.loads(data)
+        except ValueError:
+            logger.warning("Event stream from {0} sent invalid JSON".format(self.host))
+            return
+        if not isinstance(containers, list):
+            containers = [containers]
+        updates = []
+        for container in containers:
+            if container.get('type') in ('update', 'add'):
+                updates.extend(container.get('data', []))
+        if event_id is not None:
+            self.last_event_id = event_id
+        self.events += 1
+        if updates:
+            try:
+                self.callback(updates)
+            except Exception:
+                logger.exception("Event stream callback failed")
+
+    def stats(self):
+        return {
+            'connected': self.connected,
+            'healthy': self.healthy(),
+            'connects': self.connects,
+            'events': self.events,
+            'errors': self.errors,
+            'last_event_id': self.last_event_id,
+        }
+
+
+def v1_updates(updates):
+    """ Map v2 resource updates to (resource, index, v1 state) for resources with a v1 id,
+    e.g. ('sensors', 5, {'presence': True}) or ('lights', 3, {'on': True, 'bri': 127}) """
+    for update in updates:
+        resource, _, index = (update.get('id_v1') or '').strip('/').partition('/')
+        if not index.isdigit():
+            continue
+        state = {}
+        kind = update.get('type')
+        if kind == 'motion' and 'motion' in update:
+            state['presence'] = update['motion'].get('motion')
+        elif kind == 'temperature' and 'temperature' in update:
+            state['temperature'] = int(round(update['temperature']['temperature'] * 100))
+        elif kind == 'light_level' and 'light' in update:
+            state['lightlevel'] = update['light']['light_level']
+        elif kind == 'light':
+            if 'on' in update:
+                state['on'] = update['on']['on']
+            if 'dimming' in update:
+                state['bri'] = int(round(update['dimming']['brightness'] * 254 / 100))
+            if update.get('color_temperature', {}).get('mirek') is not None:
+                state['ct'] = update['color_temperature']['mirek']
+        if state:
+            yield resource, int(index), state
+
+
+class EventServer(object):
+
+    """ Local stand-in for a bridge event stream, for tests and development:
+        >>> server = EventServer()
+        >>> stream = EventStream('127.0.0.1', 'user', print, port=server.port, scheme='http')
+        >>> stream.start()
+        >>> server.publish([{'type': 'update', 'data': [...]}])
+    Published events are kept, so clients reconnecting with Last-Event-ID
+    are sent what they missed. drop_clients() cuts every open stream.
+    Streams are sent with chunked transfer encoding, as bridges do.
+    """
+    def __init__(self, host='127.0.0.1', port=0, keepalive=10.0):
+        self.keepalive = keepalive
+        self.history = []       # (event id, data)
+        self.resume_ids = []    # Last-Event-ID of every request that sent one
+        self.requests = 0
+        self._clients = []
+        self._lock = threading.Lock()
+        self._next_id = 1
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def write_chunk(self, data):
+                self.wfile.write('{0:x}\r\n'.format(len(data)).encode('ascii') + data + b'\r\n')
+                self.wfile.flush()
+
+            def do_GET(self):
+                if self.path != EVENT_PATH:
+                    self.send_error(404)
+                    return
+                client = queue.Queue()
+                with server._lock:
+                    server.requests += 1
+                    last_id = self.headers.get('Last-Event-ID')
+                    if last_id is not None:
+                        server.resume_ids.append(last_id)
+                        for event_id, data in server.history:
+                            if int(event_id.split(':')[0]) > int(last_id.split(':')[0]):
+                                client.put((event_id, data))
+                    server._clients.append(client)
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream')
+                self.send_header('Cache-Control', 'no-cache')
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+                self.close_connection = True
+                try:
+                    self.write_chunk(b': hi\n\n')
+                    while True:
+                        try:
+                            item = client.get(timeout=server.keepalive)
+                        except queue.Empty:
+                            self.write_chunk(b': keep-alive\n\n')
+                            continue
+                        if item is None:
+                            self.write_chunk(b'')
+                            return
+                        self.write_chunk('id: {0}\ndata: {1}\n\n'.format(*item).encode('utf-8'))
+                except OSError:
+                    pass
+                finally:
+                    with server._lock:
+                        if client in server._clients:
+                            server._clients.remove(client)
+
+        self.httpd = http.server.ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.port = self.httpd.server_address[1]
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name='hue-event-server')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def publish(self, containers):
+        """ Send one event holding containers, returns its id """
+        with self._lock:
+            event_id = '{0}:0'.format(self._next_id)
+            self._next_id += 1
+            data = json.dumps(containers)
+            self.history.append((event_id, data))
+            for client in self._clients:
+                client.put((event_id, data))
+        return event_id
+
+    def clients(self):
+        with self._lock:
+            return len(self._clients)
+
+    def drop_clients(self):
+        with self._lock:
+            for client in self._clients:
+                client.put(None)
+            self._clients = []
+
+    def stop(self):
+        self.drop_clients()
+        self.httpd.shutdown()
+        self.httpd.server_close()
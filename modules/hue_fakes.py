@@ -0,0 +1,327 @@
+import copy
+import datetime
+import http.server
+import json
+import threading
+import time
+
+import hue_throttle
+
+SENSOR_TYPES = ('ZLLPresence', 'ZLLTemperature', 'ZLLLightLevel')
+
+
+def _now():
+    return datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S')
+
+
+class FakeBridge(object):
+
+    """ In-process stand-in for a Hue bridge's v1 REST API, for tests and
+    benchmarks without hardware:
+        >>> bridge = FakeBridge(lights=50, sensors=10, groups=5, latency=0.005)
+        >>> phue.Bridge(bridge.address, bridge.username).get_api()
+    Serves the full state, lights, sensors, groups, scenes, schedules and
+    config over HTTP/1.1 keep-alive on bridge.address (host:port, also
+    bridge.host and bridge.port). latency delays every response; rate_limit
+    and group_rate_limit cap writes per second the way a real bridge does,
+    answering the excess with a 503 and a type 901 error. requests counts
+    requests by (method, resource).
+    """
+    def __init__(self, lights=10, sensors=3, groups=2, scenes=0, username='softhome',
+                 latency=0.0, rate_limit=None, group_rate_limit=None, host='127.0.0.1', port=0):
+        self.username = username
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.group_rate_limit = group_rate_limit
+        self.requests = {}
+        self.rejected = 0
+        self._lock = threading.Lock()
+        self.reset_limits()
+
+        self.state = {
+            'lights': {},
+            'sensors': {},
+            'groups': {},
+            'scenes': {},
+            'schedules': {},
+            'rules': {},
+            'resourcelinks': {},
+            'config': {
+                'name': 'Fake bridge',
+                'bridgeid': 'FAKE0000000000',
+                'apiversion': '1.16.0',
+                'whitelist': {username: {'name': 'softhome'}},
+            },
+        }
+        for index in range(1, lights + 1):
+            self.state['lights'][str(index)] = {
+                'state': {'on': False, 'bri': 254, 'ct': 366, 'alert': 'none',
+                          'colormode': 'ct', 'reachable': True},
+                'type': 'Color temperature light',
+                'name': 'Light {0}'.format(index),
+                'modelid': 'LTW001',
+                'manufacturername': 'Philips',
+                'uniqueid': '00:17:88:01:00:{0:02x}:{1:02x}-0b'.format(index // 256, index % 256),
+                'swversion': '5.50.1.19085',
+            }
+        for index in range(1, sensors + 1):
+            sensor_type = SENSOR_TYPES[(index - 1) % len(SENSOR_TYPES)]
+            state = {
+                'ZLLPresence': {'presence': False},
+                'ZLLTemperature': {'temperature': 2100},
+                'ZLLLightLevel': {'lightlevel': 12000, 'dark': False, 'daylight': False},
+            }[sensor_type]
+            state['lastupdated'] = _now()
+            self.state['sensors'][str(index)] = {
+                'state': state,
+                'config': {'on': True, 'reachable': True, 'battery': 100},
+                'type': sensor_type,
+                'name': '{0} {1}'.format(sensor_type, index),
+                'modelid': 'SML001',
+                'manufacturername': 'Philips',
+                'uniqueid': '00:17:88:01:02:{0:02x}:{1:02x}-02-0406'.format(index // 256, index % 256),
+                'swversion': '6.1.0.18912',
+            }
+        light_ids = sorted(self.state['lights'], key=int)
+        for index in range(1, groups + 1):
+            members = light_ids[index - 1::groups]
+            self.state['groups'][str(index)] = {
+                'name': 'Room {0}'.format(index),
+                'lights': members,
+                'type': 'Room',
+                'class': 'Other',
+                'action': {'on': False, 'bri': 254, 'ct': 366, 'alert': 'none', 'colormode': 'ct'},
+                'state': {'all_on': False, 'any_on': False},
+            }
+        group_ids = sorted(self.state['groups'], key=int)
+        for index in range(1, scenes + 1):
+            group = group_ids[(index - 1) % len(group_ids)] if group_ids else None
+            members = self.state['groups'][group]['lights'] if group else light_ids
+            self.create('scenes', {
+                'name': 'Scene {0}'.format(index),
+                'type': 'GroupScene' if group else 'LightScene',
+                'group': group,
+                'lights': list(members),
+                'lightstates': dict((light, {'on': True, 'bri': (index * 37) % 254 + 1})
+                                    for light in members),
+            })
+
+        owner = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def _handle(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = json.loads(self.rfile.read(length).decode('utf-8')) if length else None
+                status, result = owner.handle(self.command, self.path, body)
+                if owner.latency:
+                    time.sleep(owner.latency)
+                data = json.dumps(result).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_PUT = do_POST = do_DELETE = _handle
+
+        self.httpd = http.server.ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.host, self.port = self.httpd.server_address[:2]
+        self.address = '{0}:{1}'.format(self.host, self.port)
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name='fake-hue-bridge')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def reset_limits(self):
+        self._bucket = hue_throttle.TokenBucket(self.rate_limit) if self.rate_limit else None
+        self._group_bucket = hue_throttle.TokenBucket(self.group_rate_limit) if self.group_rate_limit else None
+
+    def reset_stats(self):
+        with self._lock:
+            self.requests = {}
+            self.rejected = 0
+
+    def request_count(self, method=None, resource=None):
+        with self._lock:
+            return sum(count for (m, r), count in self.requests.items()
+                       if method in (None, m) and resource in (None, r))
+
+    # API #####
+
+    def handle(self, method, path, body):
+        """ Returns (HTTP status, JSON result) for one request """
+        parts = path.split('?')[0].strip('/').split('/')
+        resource = parts[2] if len(parts) > 2 else None
+        with self._lock:
+            self.requests[(method, resource)] = self.requests.get((method, resource), 0) + 1
+            if parts[0] != 'api':
+                return 404, [self.error(4, path, 'method, {0}, not available for resource, {1}'.format(method, path))]
+            if len(parts) == 1:
+                if method == 'POST':
+                    return 200, [{'success': {'username': self.username}}]
+                return 200, [self.error(4, path, 'method not available')]
+            if parts[1] != self.username:
+                return 200, [self.error(1, path, 'unauthorized user')]
+            if method != 'GET':
+                bucket = self._group_bucket if resource == 'groups' else self._bucket
+                if bucket is not None and bucket.consume():
+                    self.rejected += 1
+                    return 503, [self.error(901, path, 'Internal error, 503')]
+            return 200, self.route(method, path, parts[2:], body)
+
+    @staticmethod
+    def error(kind, address, description):
+        return {'error': {'type': kind, 'address': address, 'description': description}}
+
+    def route(self, method, path, parts, body):
+        if not parts:
+            full = copy.deepcopy(self.state)
+            for scene in full['scenes'].values():
+                scene.pop('lightstates', None)
+            return full
+        resource = parts[0]
+        if resource not in self.state:
+            return [self.error(3, path, 'resource, {0}, not available'.format(path))]
+        if resource == 'config':
+            if method == 'PUT':
+                return self.update(self.state['config'], '/config', body)
+            return copy.deepcopy(self.state['config'])
+
+        collection = self.state[resource]
+        if len(parts) == 1:
+            if method == 'POST':
+                return [{'success': {'id': self.create(resource, body)}}]
+            result = copy.deepcopy(collection)
+            if resource == 'scenes':
+                for scene in result.values():
+                    scene.pop('lightstates', None)
+            return result
+
+        index = parts[1]
+        if resource == 'groups' and index == '0':
+            item = {'name': 'All lights', 'lights': sorted(self.state['lights'], key=int),
+                    'type': 'LightGroup', 'action': {}}
+        elif index in collection:
+            item = collection[index]
+        else:
+            return [self.error(3, path, 'resource, /{0}/{1}, not available'.format(resource, index))]
+
+        if len(parts) == 2:
+            if method == 'GET':
+                return copy.deepcopy(item)
+            if method == 'DELETE':
+                del collection[index]
+                for group in self.state['groups'].values():
+                    if resource == 'lights' and index in group['lights']:
+                        group['lights'].remove(index)
+                return [{'success': '/{0}/{1} deleted'.format(resource, index)}]
+            if method == 'PUT':
+                if resource == 'scenes':
+                    item['lastupdated'] = _now()
+                return self.update(item, '/{0}/{1}'.format(resource, index), body)
+
+        if len(parts) == 3 and method == 'PUT':
+            sub = parts[2]
+            address = '/{0}/{1}/{2}'.format(resource, index, sub)
+            if resource == 'lights' and sub == 'state':
+                return self.set_light(index, body, address)
+            if resource == 'groups' and sub == 'action':
+                return self.set_group(index, item, body, address)
+            if resource == 'sensors' and sub in ('state', 'config'):
+                result = self.update(item[sub], address, body)
+                if sub == 'state':
+                    item['state']['lastupdated'] = _now()
+                return result
+        return [self.error(4, path, 'method, {0}, not available for resource, {1}'.format(method, path))]
+
+    def update(self, target, address, body):
+        result = []
+        for key, value in (body or {}).items():
+            target[key] = value
+            result.append({'success': {'{0}/{1}'.format(address, key): value}})
+        return result
+
+    def set_light(self, index, body, address):
+        state = self.state['lights'][index]['state']
+        result = []
+        for key, value in (body or {}).items():
+            if key == 'transitiontime':
+                continue
+            if key == 'bri':
+                value = max(1, min(254, int(value)))
+            elif key == 'ct':
+                value = max(153, min(500, int(value)))
+                state['colormode'] = 'ct'
+            state[key] = value
+            result.append({'success': {'{0}/{1}'.format(address, key): value}})
+        return result
+
+    def set_group(self, index, group, body, address):
+        body = dict(body or {})
+        result = []
+        scene_id = body.pop('scene', None)
+        if scene_id is not None:
+            scene = self.state['scenes'].get(scene_id)
+            if scene is None:
+                return [self.error(7, address + '/scene', 'invalid value, {0}, for parameter, scene'.format(scene_id))]
+            for light, lightstate in scene.get('lightstates', {}).items():
+                if light in self.state['lights']:
+                    self.set_light(light, lightstate, '/lights/{0}/state'.format(light))
+            result.append({'success': {address + '/scene': scene_id}})
+        for light in group['lights']:
+            if light in self.state['lights']:
+                self.set_light(light, body, '/lights/{0}/state'.format(light))
+        for key, value in body.items():
+            if key != 'transitiontime':
+                group['action'][key] = value
+                result.append({'success': {'{0}/{1}'.format(address, key): value}})
+        if 'state' in group:
+            states = [self.state['lights'][light]['state']['on'] for light in group['lights']
+                      if light in self.state['lights']]
+            group['state'] = {'all_on': bool(states) and all(states), 'any_on': any(states)}
+        return result
+
+    def create(self, resource, body):
+        collection = self.state[resource]
+        if resource == 'scenes':
+            new_id = 'fake{0:04d}'.format(len(collection) + 1)
+            while new_id in collection:
+                new_id += 'x'
+        else:
+            new_id = str(max([int(key) for key in collection] or [0]) + 1)
+        item = copy.deepcopy(body or {})
+        if resource == 'scenes':
+            item.setdefault('owner', self.username)
+            item.setdefault('recycle', False)
+            item.setdefault('locked', False)
+            item.setdefault('version', 2)
+            item.setdefault('lightstates', {})
+            item['lastupdated'] = _now()
+        elif resource == 'groups':
+            item.setdefault('type', 'LightGroup')
+            item.setdefault('action', {})
+            item.setdefault('lights', [])
+        elif resource == 'schedules':
+            item.setdefault('status', 'enabled')
+            item['created'] = _now()
+        collection[new_id] = item
+        return new_id
+
+    # Helpers for tests #####
+
+    def trigger_motion(self, index, presence=True):
+        """ Simulate a motion sensor firing """
+        with self._lock:
+            state = self.state['sensors'][str(index)]['state']
+            state['presence'] = presence
+            state['lastupdated'] = _now()
@@ -0,0 +1,122 @@
+import threading
+import time
+
+RESOURCES = ('lights', 'sensors', 'groups')
+
+
+class NameIndex(object):
+
+    """ Name <-> id index of one bridge's lights, sensors and groups.
+    A resource is loaded from a collection GET (or a full state snapshot
+    passed to load_state) and trusted for ttl seconds. Clients keep it
+    current with rename/add/remove when they change names themselves, so
+    resolving a name normally costs no request. A name that is not found
+    reloads its resource at most once per miss_refresh seconds, to pick up
+    devices created behind our back without a GET per unknown name.
+    Ids are the bridge's string ids; like the old lookups, the first id
+    found wins when names repeat.
+    """
+    def __init__(self, ttl=300, miss_refresh=5):
+        self.ttl = ttl
+        self.miss_refresh = miss_refresh
+        self._lock = threading.Lock()
+        self._names = {}    # resource -> {id: name}
+        self._ids = {}      # resource -> {name: id}
+        self._loaded = {}   # resource -> time of the last load
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+
+    def load(self, resource, collection):
+        """ Replace a resource's entries with a {id: {'name': ...}} collection """
+        if not isinstance(collection, dict):
+            return  # an error response
+        names = dict((str(item_id), item['name']) for item_id, item in collection.items()
+                     if isinstance(item, dict) and 'name' in item)
+        with self._lock:
+            self._names[resource] = names
+            self._ids[resource] = self._invert(names)
+            self._loaded[resource] = time.time()
+            self.loads += 1
+
+    def load_state(self, state):
+        """ Load every resource from a full /api/<username> snapshot """
+        for resource in RESOURCES:
+            if isinstance(state.get(resource), dict):
+                self.load(resource, state[resource])
+
+    @staticmethod
+    def _invert(names):
+        ids = {}
+        for item_id in sorted(names, key=lambda item_id: (len(item_id), item_id)):
+            ids.setdefault(names[item_id], item_id)
+        return ids
+
+    def _fresh(self, resource):
+        loaded = self._loaded.get(resource)
+        return loaded is not None and time.time() - loaded < self.ttl
+
+    def id_for(self, resource, name, fetch):
+        """ The id of name, or False. fetch() returns the resource's collection on a reload """
+        with self._lock:
+            fresh = self._fresh(resource)
+            item_id = self._ids.get(resource, {}).get(name) if fresh else None
+            loaded = self._loaded.get(resource)
+        if item_id is not None:
+            self.hits += 1
+            return item_id
+        self.misses += 1
+        if fresh and time.time() - loaded < self.miss_refresh:
+            return False
+        self.load(resource, fetch())
+        with self._lock:
+            return self._ids.get(resource, {}).get(name, False)
+
+    def name_for(self, resource, item_id, fetch):
+        """ The name of item_id, or None """
+        with self._lock:
+            fresh = self._fresh(resource)
+            name = self._names.get(resource, {}).get(str(item_id)) if fresh else None
+        if name is not None:
+            self.hits += 1
+            return name
+        self.misses += 1
+        self.load(resource, fetch())
+        with self._lock:
+            return self._names.get(resource, {}).get(str(item_id))
+
+    def rename(self, resource, item_id, name):
+        with self._lock:
+            if resource in self._names:
+                self._names[resource][str(item_id)] = name
+                self._ids[resource] = self._invert(self._names[resource])
+
+    add = rename
+
+    def remove(self, resource, item_id):
+        with self._lock:
+            if resource in self._names:
+                self._names[resource].pop(str(item_id), None)
+                self._ids[resource] = self._invert(self._names[resource])
+
+    def invalidate(self, resource=None):
+        with self._lock:
+            for name in ([resource] if resource else list(self._loaded)):
+                self._loaded.pop(name, None)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'loads': self.loads}
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_index(host, username, ttl=300):
+    """ The shared NameIndex of the bridge at host, as seen by username """
+    key = (host, username)
+    with _indexes_lock:
+        index = _indexes.get(key)
+        if index is None:
+            index = _indexes[key] = NameIndex(ttl)
+        return index
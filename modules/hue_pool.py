@@ -0,0 +1,201 @@
+import http.client as httplib
+import json
+import logging
+import threading
+import time
+
+logger = logging.getLogger('hue_pool')
+
+# Errors raised when the bridge has silently dropped a kept-alive socket.
+RESET_ERRORS = (ConnectionResetError, ConnectionAbortedError, BrokenPipeError,
+                httplib.RemoteDisconnected, httplib.BadStatusLine)
+
+# Methods that are safe to send twice. A reset POST may already have created
+# a group, scene or schedule on the bridge, so it is not retried.
+IDEMPOTENT_METHODS = ('GET', 'PUT', 'DELETE', 'HEAD')
+
+
+class ConnectionPool(object):
+
+    """ Thread-safe pool of HTTP/1.1 keep-alive connections to a single bridge.
+    At most max_size sockets are open at once; callers block until one is free.
+    Idle sockets older than idle_timeout seconds are closed instead of reused,
+    and an idempotent request on a reused socket that was reset by the bridge
+    is retried once on a fresh connection.
+    """
+    def __init__(self, host, max_size=4, idle_timeout=30, timeout=10):
+        self.host = host
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+
+        self._idle = []  # (connection, last_used) pairs, most recently used last
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._open = 0
+
+        self.requests = 0
+        self.reused = 0
+        self.created = 0
+        self.resets = 0
+        self.evicted = 0
+
+    def __repr__(self):
+        return '<{0}.{1} {2} open={3} idle={4}>'.format(
+            self.__class__.__module__,
+            self.__class__.__name__,
+            self.host,
+            self._open,
+            len(self._idle))
+
+    def _new_connection(self):
+        with self._lock:
+            self._open += 1
+            self.created += 1
+        return httplib.HTTPConnection(self.host, timeout=self.timeout)
+
+    def _discard(self, connection):
+        connection.close()
+        with self._lock:
+            self._open -= 1
+
+    def _acquire(self):
+        """ Returns (connection, reused) """
+        self._slots.acquire()
+        stale = []
+        connection = None
+        now = time.time()
+        with self._lock:
+            fresh = []
+            for candidate, last_used in self._idle:
+                if now - last_used > self.idle_timeout:
+                    stale.append(candidate)
+                else:
+                    fresh.append((candidate, last_used))
+            if fresh:
+                connection = fresh.pop()[0]
+            self._idle = fresh
+            self.evicted += len(stale)
+        for candidate in stale:
+            self._discard(candidate)
+        if connection is not None:
+            return connection, True
+        return self._new_connection(), False
+
+    def _release(self, connection, keep):
+        try:
+            if keep:
+                with self._lock:
+                    self._idle.append((connection, time.time()))
+            else:
+                self._discard(connection)
+        finally:
+            self._slots.release()
+
+    def urlopen(self, mode, address, body=None):
+        """ Send a single request and return (status, body bytes).
+        Raises socket.timeout if the bridge does not answer in time.
+        """
+        headers = {'Connection': 'keep-alive'}
+        if body is not None:
+            headers['Content-Type'] = 'application/json'
+
+        connection, reused = self._acquire()
+        keep = False
+        try:
+            with self._lock:
+                self.requests += 1
+                if reused:
+                    self.reused += 1
+            try:
+                connection.request(mode, address, body, headers)
+                response = connection.getresponse()
+            except RESET_ERRORS:
+                if not reused or mode not in IDEMPOTENT_METHODS:
+                    raise
+                # the bridge closed the idle socket, try again on a fresh one
+                logger.debug("Connection to {0} was reset, reconnecting".format(self.host))
+                with self._lock:
+                    self.resets += 1
+                    self.created += 1
+                connection.close()
+                connection.connect()
+                connection.request(mode, address, body, headers)
+                response = connection.getresponse()
+            data = response.read()
+            keep = not response.will_close
+            return response.status, data
+        finally:
+            self._release(connection, keep)
+
+    def request(self, mode='GET', address=None, data=None):
+        """ JSON convenience wrapper around urlopen, used by the Hue clients """
+        body = None
+        if mode == 'PUT' or mode == 'POST':
+            body = json.dumps(data)
+        status, result = self.urlopen(mode, address, body)
+        return json.loads(str(result, encoding='utf-8'))
+
+    def close(self):
+        """ Close all idle connections """
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection, _ in idle:
+            self._discard(connection)
+
+    @property
+    def open_sockets(self):
+        return self._open
+
+    @property
+    def reuse_ratio(self):
+        if self.requests == 0:
+            return 0.0
+        return float(self.reused) / self.requests
+
+    def stats(self):
+        with self._lock:
+            return {
+                'host': self.host,
+                'requests': self.requests,
+                'reused': self.reused,
+                'created': self.created,
+                'resets': self.resets,
+                'evicted': self.evicted,
+                'idle': len(self._idle),
+                'open_sockets': self._open,
+                'reuse_ratio': self.reuse_ratio,
+            }
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(host, max_size=4, idle_timeout=30, timeout=10):
+    """ Returns the shared pool for a bridge, creating it on first use """
+    with _pools_lock:
+        pool = _pools.get(host)
+        if pool is None:
+            pool = ConnectionPool(host, max_size, idle_timeout, timeout)
+            _pools[host] = pool
+        return pool
+
+
+def request(host, mode='GET', address=None, data=None):
+    """ Perform a JSON request against a bridge through its shared pool """
+    return get_pool(host).request(mode, address, data)
+
+
+def pool_stats():
+    """ Stats for every bridge pool in this process, keyed by host """
+    with _pools_lock:
+        pools = list(_pools.values())
+    return dict((pool.host, pool.stats()) for pool in pools)
+
+
+def close_all():
+    with _pools_lock:
+        pools = list(_pools.values())
+    for pool in pools:
+        pool.close()
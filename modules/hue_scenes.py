@@ -0,0 +1,52 @@
+import hashlib
+import json
+
+# Marks scenes we store on a bridge, so scenes other apps made with the same user are left alone
+APPDATA = {'version': 1, 'data': 'softhome'}
+
+
+def scene_body(name, lightstates):
+    """ Body of a POST /scenes or PUT /scenes/<id> storing {light id: state} on the bridge.
+    Light scenes can be recalled through any group containing their lights, so
+    group actions on the scene's own group and on group 0 both work. """
+    lightstates = dict((str(light), dict(state)) for light, state in lightstates.items())
+    return {
+        'name': name[:32],
+        'type': 'LightScene',
+        'lights': sorted(lightstates, key=int),
+        'lightstates': lightstates,
+        'recycle': False,
+        'appdata': dict(APPDATA),
+    }
+
+
+def body_digest(body):
+    return hashlib.sha1(json.dumps(body, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def is_ours(scene, username):
+    return scene.get('owner') == username and scene.get('appdata', {}).get('data') == APPDATA['data']
+
+
+def plan_sync(wanted, remote, username):
+    """ Plan the writes that make a bridge's scenes match ours.
+    wanted maps a local key to (bridge scene id or None, body, digest of the
+    body last pushed, bridge lastupdated seen after that push); remote is the
+    bridge's /scenes collection. A scene is created when the bridge does not
+    have it, and rewritten when our body changed or its lastupdated moved
+    (someone edited it on the bridge). Scenes we own that no local scene
+    points at are deleted, bridges only hold around 200.
+    Returns a list of ('delete', scene id), ('create', key, body) and
+    ('update', key, scene id, body) tuples, deletes first to make room.
+    """
+    actions = []
+    kept = set(scene_id for scene_id, body, digest, last_updated in wanted.values())
+    for key, (scene_id, body, digest, last_updated) in wanted.items():
+        if scene_id is None or scene_id not in remote:
+            actions.append(('create', key, body))
+            continue
+        if digest != body_digest(body) or remote[scene_id].get('lastupdated') != last_updated:
+            actions.append(('update', key, scene_id, body))
+    deletes = [('delete', scene_id) for scene_id, scene in sorted(remote.items())
+               if scene_id not in kept and is_ours(scene, username)]
+    return deletes + actions
@@ -0,0 +1,106 @@
+import datetime
+import heapq
+
+# ScheduledAction.weekdays bits, datetime.weekday() order
+MONDAY, TUESDAY, WEDNESDAY, THURSDAY, FRIDAY, SATURDAY, SUNDAY = (1 << day for day in range(7))
+EVERY_DAY = (1 << 7) - 1
+
+
+def next_occurrence(start, after, interval=None, weekdays=0):
+    """ First run of a series later than after, or None when there is none.
+    The series starts at start and then repeats every interval seconds, or
+    on each day in the weekdays mask at start's time of day (pass local
+    naive datetimes for that, so runs keep their wall clock time across DST).
+    Without either it is a single run. Missed runs are skipped, not replayed.
+    """
+    if interval:
+        if start > after:
+            return start
+        periods = int((after - start).total_seconds() // interval) + 1
+        return start + datetime.timedelta(seconds=periods * interval)
+    if not weekdays & EVERY_DAY:
+        return start if start > after else None
+    day = datetime.datetime.combine(max(start.date(), after.date()), start.time())
+    if start.tzinfo is not None:
+        day = day.replace(tzinfo=start.tzinfo)
+    for offset in range(8):
+        candidate = day + datetime.timedelta(days=offset)
+        if candidate > after and candidate >= start and weekdays & (1 << candidate.weekday()):
+            return candidate
+    return None
+
+
+def bridge_time(local):
+    """ Absolute bridge schedule time for a local naive datetime """
+    return local.strftime('%Y-%m-%dT%H:%M:%S')
+
+
+class Timeline(object):
+
+    """ Keys ordered by due time (any comparable, e.g. epoch seconds).
+    A binary heap with lazy removal: add() and remove() are O(log n) and
+    O(1), so tens of thousands of schedules cost nothing to keep, and
+    pop_due() and upcoming() only touch the entries they return. Re-adding
+    a key moves it.
+    """
+    def __init__(self):
+        self._heap = []
+        self._due = {}   # key -> due, the live entry of each key
+
+    def __len__(self):
+        return len(self._due)
+
+    def __contains__(self, key):
+        return key in self._due
+
+    def add(self, key, due):
+        self._due[key] = due
+        heapq.heappush(self._heap, (due, key))
+        if len(self._heap) > 2 * len(self._due) + 64:
+            self._compact()
+
+    def remove(self, key):
+        self._due.pop(key, None)
+
+    def due(self, key):
+        return self._due.get(key)
+
+    def clear(self):
+        self._heap = []
+        self._due = {}
+
+    def _compact(self):
+        self._heap = [(due, key) for key, due in self._due.items()]
+        heapq.heapify(self._heap)
+
+    def _live(self, entry):
+        return self._due.get(entry[1], entry) == entry[0]
+
+    def next_due(self):
+        """ Due time of the first key, or None """
+        while self._heap and not self._live(self._heap[0]):
+            heapq.heappop(self._heap)
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now):
+        """ Remove and return (key, due) of every key due at or before now, earliest first """
+        result = []
+        while self._heap and self._heap[0][0] <= now:
+            due, key = heapq.heappop(self._heap)
+            if self._due.get(key, (due, key)) == due:
+                del self._due[key]
+                result.append((key, due))
+        return result
+
+    def upcoming(self, until):
+        """ (key, due) of the keys due at or before until, earliest first, without removing them """
+        result = {}
+        stack = [0]
+        while stack:
+            index = stack.pop()
+            if index >= len(self._heap) or self._heap[index][0] > until:
+                continue
+            if self._live(self._heap[index]):
+                result[self._heap[index][1]] = self._heap[index][0]
+            stack.extend((2 * index + 1, 2 * index + 2))
+        return sorted(result.items(), key=lambda item: item[1])
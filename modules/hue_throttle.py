@@ -0,0 +1,167 @@
+import collections
+import logging
+import threading
+import time
+from concurrent.futures import Future
+
+logger = logging.getLogger('hue_throttle')
+
+
+class CommandDropped(Exception):
+    pass
+
+
+def dropped_response(address):
+    """ The error response a bridge gives when it sheds load, for a command the queue dropped """
+    return [{'error': {'type': 901, 'address': address, 'description': 'Command queue is full'}}]
+
+
+class TokenBucket(object):
+
+    """ Token bucket refilled at rate tokens per second, holding at most capacity """
+    def __init__(self, rate, capacity=None, clock=time.monotonic):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else rate)
+        self.clock = clock
+        self._tokens = self.capacity
+        self._stamp = clock()
+
+    def consume(self, tokens=1):
+        """ Take tokens if available and return 0, otherwise return the seconds to wait """
+        now = self.clock()
+        self._tokens = min(self.capacity, self._tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+        if self._tokens >= tokens:
+            self._tokens -= tokens
+            return 0
+        return (tokens - self._tokens) / self.rate
+
+
+class CommandQueue(object):
+
+    """ Paced outbound command queue for one bridge.
+    Commands are ('light' | 'group', target id, state dict) and are sent by
+    calling send(kind, target, data) from a worker thread, no faster than the
+    token bucket allows. A command for a light or group that is still waiting
+    is merged into the waiting one (later attributes win) and keeps its place,
+    so a burst of slider updates becomes one request without reordering.
+    Group commands are sent before light commands and cost group_cost tokens.
+    """
+    def __init__(self, send, rate=10, burst=None, group_cost=1, max_depth=100, name=None):
+        self.send = send
+        self.bucket = TokenBucket(rate, burst)
+        self.group_cost = group_cost
+        self.max_depth = max_depth
+        self.name = name
+
+        self._pending = {}  # (kind, target) -> [data, future]
+        self._order = {'group': collections.deque(), 'light': collections.deque()}
+        self._condition = threading.Condition()
+        self._worker = None
+
+        self.sent = 0
+        self.merged = 0
+        self.dropped = 0
+        self.failed = 0
+
+    def __repr__(self):
+        return '<{0}.{1} {2} depth={3}>'.format(
+            self.__class__.__module__,
+            self.__class__.__name__,
+            self.name,
+            self.depth)
+
+    def submit(self, kind, target, data):
+        """ Queue a command and return a Future for the bridge response """
+        key = (kind, str(target))
+        with self._condition:
+            if key in self._pending:
+                self._pending[key][0].update(data)
+                self.merged += 1
+                return self._pending[key][1]
+
+            future = Future()
+            if len(self._pending) >= self.max_depth:
+                self.dropped += 1
+                future.set_exception(CommandDropped('Command queue for {0} is full'.format(self.name)))
+                return future
+            self._pending[key] = [dict(data), future]
+            self._order[kind].append(key)
+            self._ensure_worker()
+            self._condition.notify()
+            return future
+
+    def _ensure_worker(self):
+        if self._worker is None or not self._worker.is_alive():
+            self._worker = threading.Thread(target=self._run, name='hue-throttle-{0}'.format(self.name))
+            self._worker.daemon = True
+            self._worker.start()
+
+    def _next_key(self):
+        for kind in ('group', 'light'):
+            if self._order[kind]:
+                return self._order[kind][0]
+        return None
+
+    def _run(self):
+        while True:
+            with self._condition:
+                key = self._next_key()
+                while key is None:
+                    self._condition.wait()
+                    key = self._next_key()
+                wait = self.bucket.consume(self.group_cost if key[0] == 'group' else 1)
+                if wait == 0:
+                    self._order[key[0]].popleft()
+                    data, future = self._pending.pop(key)
+            if wait:
+                # the command stays queued while we wait, so it can still absorb merges
+                time.sleep(wait)
+                continue
+
+            try:
+                result = self.send(key[0], key[1], data)
+            except Exception as e:
+                self.failed += 1
+                logger.warning("{0} {1} command failed: {2}".format(key[0], key[1], e))
+                future.set_exception(e)
+            else:
+                self.sent += 1
+                future.set_result(result)
+
+    @property
+    def depth(self):
+        return len(self._pending)
+
+    def stats(self):
+        with self._condition:
+            return {
+                'name': self.name,
+                'depth': len(self._pending),
+                'group_depth': len(self._order['group']),
+                'light_depth': len(self._order['light']),
+                'sent': self.sent,
+                'merged': self.merged,
+                'dropped': self.dropped,
+                'failed': self.failed,
+            }
+
+
+_queues = {}
+_queues_lock = threading.Lock()
+
+
+def get_queue(name, send, **options):
+    """ Returns the shared command queue registered under name, creating it on first use """
+    with _queues_lock:
+        queue = _queues.get(name)
+        if queue is None:
+            queue = CommandQueue(send, name=name, **options)
+            _queues[name] = queue
+        return queue
+
+
+def queue_stats():
+    with _queues_lock:
+        queues = list(_queues.values())
+    return dict((queue.name, queue.stats()) for queue in queues)
@@ -1,10 +1,15 @@
+import contextlib
 import json
 import logging
 import os
 import platform
 import socket
+import time
 import http.client as httplib
 
+import hue_names
+import hue_pool
+
 PY3K = True
 logger = logging.getLogger('phue')
 
@@ -32,14 +37,35 @@ class PhueRequestTimeout(PhueException):
     pass
 
 
+# the color mode a bridge switches a light to when one of these is set
+COLORMODES = {'hue': 'hs', 'sat': 'hs', 'xy': 'xy', 'ct': 'ct'}
+
+
 class Light(object):
 
     """ Hue Light object
     Light settings can be accessed or set via the properties of this object.
+    Getters read a snapshot of the light fetched with one GET and shared by
+    every property until it is max_age seconds old (Bridge.state_max_age by
+    default); refresh() fetches it again. Successful setters update the
+    snapshot in place.
+    Several attributes can be changed with one request inside batch():
+        >>> with light.batch(transitiontime=20):
+        ...     light.on = True
+        ...     light.brightness = 200
+        ...     light.colortemp = 300
     """
-    def __init__(self, bridge, light_id):
+    # fields read from the top level of the resource instead of its state
+    _TOP_LEVEL = ('name', 'type', 'uniqueid', 'swversion', 'modelid', 'manufacturername')
+    _state_key = 'state'
+
+    def __init__(self, bridge, light_id, max_age=None):
         self.bridge = bridge
         self.light_id = light_id
+        self.max_age = max_age if max_age is not None else getattr(bridge, 'state_max_age', 1.0)
+        self._snapshot = None
+        self._fetched = 0
+        self._pending = None
 
         self._name = None
         self._on = None
@@ -64,22 +90,107 @@ class Light(object):
             self.name,
             hex(id(self)))
 
+    # Snapshot of the light's resource, shared by the property getters
+    def _fetch(self):
+        return self.bridge.get_light(self.light_id)
+
+    def _load(self, resource):
+        """ Replace the snapshot with a resource read elsewhere, e.g. a bulk GET """
+        if isinstance(resource, dict):
+            self._snapshot = resource
+            self._fetched = time.time()
+
+    def stale(self):
+        return self._snapshot is None or time.time() - self._fetched >= self.max_age
+
+    def refresh(self):
+        """ Fetch the snapshot again, returns self """
+        self._load(self._fetch())
+        return self
+
+    def _remember(self, data, result):
+        """ Apply data written by a setter to the snapshot, or drop the snapshot if the write failed """
+        if self._snapshot is None:
+            return
+        entries = [entry for response in (result or []) if isinstance(response, list) for entry in response]
+        if not entries or any('error' in entry for entry in entries):
+            self._fetched = 0
+            return
+        for key, value in data.items():
+            if key == 'transitiontime':
+                continue
+            if key in self._TOP_LEVEL or key == 'lights':
+                self._snapshot[key] = value
+            else:
+                state = self._snapshot.setdefault(self._state_key, {})
+                state[key] = value
+                if key in COLORMODES:
+                    state['colormode'] = COLORMODES[key]
+
+    @contextlib.contextmanager
+    def batch(self, transitiontime=None):
+        """ Collect the attributes set inside the block and send them as one state PUT
+        when it ends, with transitiontime (or the light's own) for the whole change.
+        Nothing is sent if the block raises. """
+        if self._pending is not None:
+            raise RuntimeError('{0} is already in a batch'.format(self))
+        saved = self.transitiontime
+        if transitiontime is not None:
+            # the on setter's brightness workaround looks at transitiontime
+            self.transitiontime = transitiontime
+        self._pending = {}
+        try:
+            try:
+                yield self
+            except BaseException:
+                self._pending = None
+                raise
+            data, self._pending = self._pending, None
+            if data:
+                self._set(data)
+        finally:
+            self.transitiontime = saved
+
+    def _queue(self, nargs):
+        """ Hold a setter's change while a batch is open; later values win """
+        if isinstance(nargs[0], dict):
+            self._pending.update(nargs[0])
+        else:
+            self._pending[nargs[0]] = nargs[1]
+
+    def _turning_off(self, nargs, kwargs):
+        if isinstance(nargs[0], dict):
+            return nargs[0].get('on', True) is False
+        return (nargs[0] == 'on' and nargs[1] is False) or kwargs.get('on', True) is False
+
     # Wrapper functions for get/set through the bridge, adding support for
     # remembering the transitiontime parameter if the user has set it
-    def _get(self, *nargs, **kwargs):
-        return self.bridge.get_light(self.light_id, *nargs, **kwargs)
+    def _get(self, parameter):
+        if self.stale():
+            self.refresh()
+        resource = self._snapshot or {}
+        if parameter in self._TOP_LEVEL or parameter == 'lights':
+            return resource[parameter]
+        try:
+            return resource[self._state_key][parameter]
+        except KeyError:
+            raise KeyError(
+                'Not a valid key, parameter %s is not associated with %s)' % (parameter, self))
 
     def _set(self, *nargs, **kwargs):
+        if self._pending is not None and nargs[0] != 'name':
+            return self._queue(nargs)
 
         if self.transitiontime is not None:
             kwargs['transitiontime'] = self.transitiontime
             logger.debug("Setting with transitiontime = {0} ds = {1} s".format(
                 self.transitiontime, float(self.transitiontime) / 10))
 
-            if (nargs[0] == 'on' and nargs[1] is False) or (
-                    kwargs.get('on', True) is False):
+            if self._turning_off(nargs, kwargs):
                 self._reset_bri_after_on = True
-        return self.bridge.set_light(self.light_id, *nargs, **kwargs)
+        result = self.bridge.set_light(self.light_id, *nargs, **kwargs)
+        self._remember(nargs[0] if isinstance(nargs[0], dict) else {nargs[0]: nargs[1]}, result)
+        return result
 
     @property
     def name(self):
@@ -416,26 +527,21 @@ class Group(Light):
         try:
             self.group_id = int(group_id)
         except:
-            name = group_id
-            groups = bridge.get_group()
-            for idnumber, info in groups.items():
-                if PY3K:
-                    if info['name'] == name:
-                        self.group_id = int(idnumber)
-                        break
-                else:
-                    if info['name'] == name.decode('utf-8'):
-                        self.group_id = int(idnumber)
-                        break
-            else:
+            group_id = bridge.get_group_id_by_name(group_id)
+            if group_id is False:
                 raise LookupError("Could not find a group by that name.")
+            self.group_id = int(group_id)
 
-    # Wrapper functions for get/set through the bridge, adding support for
-    # remembering the transitiontime parameter if the user has set it
-    def _get(self, *nargs, **kwargs):
-        return self.bridge.get_group(self.group_id, *nargs, **kwargs)
+    _TOP_LEVEL = ('name', 'type', 'class')
+    _state_key = 'action'
+
+    def _fetch(self):
+        return self.bridge.get_group(self.group_id)
 
     def _set(self, *nargs, **kwargs):
+        if self._pending is not None and nargs[0] not in ('name', 'lights'):
+            return self._queue(nargs)
+
         # let's get basic group functionality working first before adding
         # transition time...
         if self.transitiontime is not None:
@@ -443,10 +549,11 @@ class Group(Light):
             logger.debug("Setting with transitiontime = {0} ds = {1} s".format(
                 self.transitiontime, float(self.transitiontime) / 10))
 
-            if (nargs[0] == 'on' and nargs[1] is False) or (
-                    kwargs.get('on', True) is False):
+            if self._turning_off(nargs, kwargs):
                 self._reset_bri_after_on = True
-        return self.bridge.set_group(self.group_id, *nargs, **kwargs)
+        result = self.bridge.set_group(self.group_id, *nargs, **kwargs)
+        self._remember(nargs[0] if isinstance(nargs[0], dict) else {nargs[0]: nargs[1]}, result)
+        return result
 
     @property
     def name(self):
@@ -500,8 +607,10 @@ class Scene(object):
 
     def __init__(self, sid, appdata=None, lastupdated=None,
                  lights=None, locked=False, name="", owner="",
-                 picture="", recycle=False, version=0):
+                 picture="", recycle=False, version=0, type="LightScene", group=None, **kwargs):
         self.scene_id = sid
+        self.type = type
+        self.group = group
         self.appdata = appdata or {}
         self.lastupdated = lastupdated
         if lights is not None:
@@ -539,6 +648,9 @@ class Bridge(object):
         >>> b['Kitchen']
         <phue.Light at 0x10473d750>
     """
+    # seconds a Light or Group snapshot is trusted before its getters fetch it again
+    state_max_age = 1.0
+
     def __init__(self, ip=None, username=None, config_file_path=None):
         """ Initialization function.
         Parameters:
@@ -585,31 +697,18 @@ class Bridge(object):
             'PUT', '/api/' + self.username + '/config', data)
 
     def request(self, mode='GET', address=None, data=None):
-        """ Utility function for HTTP GET/PUT requests for the API"""
-        connection = httplib.HTTPConnection(self.ip, timeout=10)
-
+        """ Utility function for HTTP GET/PUT requests for the API.
+        Requests share a keep-alive connection pool per bridge ip. """
         try:
-            if mode == 'GET' or mode == 'DELETE':
-                connection.request(mode, address)
-            if mode == 'PUT' or mode == 'POST':
-                connection.request(mode, address, json.dumps(data))
-
+            result = hue_pool.request(self.ip, mode, address, data)
             logger.debug("{0} {1} {2}".format(mode, address, str(data)))
-
         except socket.timeout:
             error = "{} Request to {}{} timed out.".format(mode, self.ip, address)
 
             logger.exception(error)
             raise PhueRequestTimeout(None, error)
 
-        result = connection.getresponse()
-        connection.close()
-        if PY3K:
-            return json.loads(str(result.read(), encoding='utf-8'))
-        else:
-            result_str = result.read()
-            logger.debug(result_str)
-            return json.loads(result_str)
+        return result
 
     def get_ip_address(self, set_result=False):
 
@@ -693,28 +792,33 @@ class Bridge(object):
                     'Error opening config file, will attempt bridge registration')
                 self.register_app()
 
+    @property
+    def names(self):
+        """ Name <-> id index of this bridge, shared with every client of the same bridge and user """
+        return hue_names.get_index(self.ip, self.username)
+
     def get_light_id_by_name(self, name):
         """ Lookup a light id based on string name. Case-sensitive. """
-        lights = self.get_light()
-        for light_id in lights:
-            if PY3K:
-                if name == lights[light_id]['name']:
-                    return light_id
-            else:
-                if name.decode('utf-8') == lights[light_id]['name']:
-                    return light_id
-        return False
+        if not PY3K:
+            name = name.decode('utf-8')
+        return self.names.id_for('lights', name, self.get_light)
 
     def get_light_objects(self, mode='list'):
         """Returns a collection containing the lights, either by name or id (use 'id' or 'name' as the mode)
         The returned collection can be either a list (default), or a dict.
-        Set mode='id' for a dict by light ID, or mode='name' for a dict by light name.   """
-        if self.lights_by_id == {}:
-            lights = self.request('GET', '/api/' + self.username + '/lights/')
+        Set mode='id' for a dict by light ID, or mode='name' for a dict by light name.
+        Stale light snapshots are refreshed together with one GET of all lights. """
+        if self.lights_by_id == {} or any(light.stale() for light in self.lights_by_id.values()):
+            lights = self.get_light()
             for light in lights:
-                self.lights_by_id[int(light)] = Light(self, int(light))
-                self.lights_by_name[lights[light][
-                    'name']] = self.lights_by_id[int(light)]
+                if int(light) not in self.lights_by_id:
+                    self.lights_by_id[int(light)] = Light(self, int(light))
+                self.lights_by_id[int(light)]._load(lights[light])
+            for light_id in list(self.lights_by_id):
+                if str(light_id) not in lights:
+                    del self.lights_by_id[light_id]
+            self.lights_by_name = dict((lights[str(light_id)]['name'], light)
+                                       for light_id, light in self.lights_by_id.items())
         if mode == 'id':
             return self.lights_by_id
         if mode == 'name':
@@ -725,22 +829,16 @@ class Bridge(object):
 
     def get_sensor_id_by_name(self, name):
         """ Lookup a sensor id based on string name. Case-sensitive. """
-        sensors = self.get_sensor()
-        for sensor_id in sensors:
-            if PY3K:
-                if name == sensors[sensor_id]['name']:
-                    return sensor_id
-            else:
-                if name.decode('utf-8') == sensors[sensor_id]['name']:
-                    return sensor_id
-        return False
+        if not PY3K:
+            name = name.decode('utf-8')
+        return self.names.id_for('sensors', name, self.get_sensor)
 
     def get_sensor_objects(self, mode='list'):
         """Returns a collection containing the sensors, either by name or id (use 'id' or 'name' as the mode)
         The returned collection can be either a list (default), or a dict.
         Set mode='id' for a dict by sensor ID, or mode='name' for a dict by sensor name.   """
         if self.sensors_by_id == {}:
-            sensors = self.request('GET', '/api/' + self.username + '/sensors/')
+            sensors = self.get_sensor()
             for sensor in sensors:
                 self.sensors_by_id[int(sensor)] = Sensor(self, int(sensor))
                 self.sensors_by_name[sensors[sensor][
@@ -777,7 +875,9 @@ class Bridge(object):
 
     def get_api(self):
         """ Returns the full api dictionary """
-        return self.request('GET', '/api/' + self.username)
+        state = self.request('GET', '/api/' + self.username)
+        self.names.load_state(state)
+        return state
 
     def get_light(self, light_id=None, parameter=None):
         """ Gets state by light_id and parameter"""
@@ -785,7 +885,9 @@ class Bridge(object):
         if isinstance(light_id, str):
             light_id = self.get_light_id_by_name(light_id)
         if light_id is None:
-            return self.request('GET', '/api/' + self.username + '/lights/')
+            lights = self.request('GET', '/api/' + self.username + '/lights/')
+            self.names.load('lights', lights)
+            return lights
         state = self.request(
             'GET', '/api/' + self.username + '/lights/' + str(light_id))
         if parameter is None:
@@ -828,6 +930,8 @@ class Bridge(object):
             if parameter == 'name':
                 result.append(self.request('PUT', '/api/' + self.username + '/lights/' + str(
                     light_id), data))
+                if 'success' in result[-1][0]:
+                    self.names.rename('lights', light_id, value)
             else:
                 if isinstance(light, str):
                     converted_light = self.get_light_id_by_name(light)
@@ -874,6 +978,7 @@ class Bridge(object):
             new_sensor = Sensor(self, int(new_id))
             self.sensors_by_id[new_id] = new_sensor
             self.sensors_by_name[name] = new_sensor
+            self.names.add('sensors', new_id, name)
             return new_id, None
         else:
             logger.debug("Failed to create sensor:" + repr(result[0]))
@@ -885,7 +990,9 @@ class Bridge(object):
         if isinstance(sensor_id, str):
             sensor_id = self.get_sensor_id_by_name(sensor_id)
         if sensor_id is None:
-            return self.request('GET', '/api/' + self.username + '/sensors/')
+            sensors = self.request('GET', '/api/' + self.username + '/sensors/')
+            self.names.load('sensors', sensors)
+            return sensors
         data = self.request(
             'GET', '/api/' + self.username + '/sensors/' + str(sensor_id))
 
@@ -913,6 +1020,8 @@ class Bridge(object):
         if 'error' in list(result[0].keys()):
             logger.warn("ERROR: {0} for sensor {1}".format(
                 result[0]['error']['description'], sensor_id))
+        elif 'name' in data:
+            self.names.rename('sensors', sensor_id, data['name'])
 
         logger.debug(result)
         return result
@@ -961,6 +1070,7 @@ class Bridge(object):
             name = self.sensors_by_id[sensor_id].name
             del self.sensors_by_name[name]
             del self.sensors_by_id[sensor_id]
+            self.names.remove('sensors', sensor_id)
             return self.request('DELETE', '/api/' + self.username + '/sensors/' + str(sensor_id))
         except:
             logger.debug("Unable to delete nonexistent sensor with ID {0}".format(sensor_id))
@@ -973,15 +1083,9 @@ class Bridge(object):
 
     def get_group_id_by_name(self, name):
         """ Lookup a group id based on string name. Case-sensitive. """
-        groups = self.get_group()
-        for group_id in groups:
-            if PY3K:
-                if name == groups[group_id]['name']:
-                    return group_id
-            else:
-                if name.decode('utf-8') == groups[group_id]['name']:
-                    return group_id
-        return False
+        if not PY3K:
+            name = name.decode('utf-8')
+        return self.names.id_for('groups', name, self.get_group)
 
     def get_group(self, group_id=None, parameter=None):
         if isinstance(group_id, str):
@@ -990,7 +1094,9 @@ class Bridge(object):
             logger.error('Group name does not exit')
             return
         if group_id is None:
-            return self.request('GET', '/api/' + self.username + '/groups/')
+            groups = self.request('GET', '/api/' + self.username + '/groups/')
+            self.names.load('groups', groups)
+            return groups
         if parameter is None:
             return self.request('GET', '/api/' + self.username + '/groups/' + str(group_id))
         elif parameter == 'name' or parameter == 'lights':
@@ -1033,6 +1139,8 @@ class Bridge(object):
                 return
             if parameter == 'name' or parameter == 'lights':
                 result.append(self.request('PUT', '/api/' + self.username + '/groups/' + str(converted_group), data))
+                if parameter == 'name' and 'success' in result[-1][0]:
+                    self.names.rename('groups', converted_group, value)
             else:
                 result.append(self.request('PUT', '/api/' + self.username + '/groups/' + str(converted_group) + '/action', data))
 
@@ -1053,9 +1161,13 @@ class Bridge(object):
             List of lights to be in the group.
         """
         data = {'lights': [str(x) for x in lights], 'name': name}
-        return self.request('POST', '/api/' + self.username + '/groups/', data)
+        result = self.request('POST', '/api/' + self.username + '/groups/', data)
+        if 'success' in result[0]:
+            self.names.add('groups', result[0]['success']['id'], name)
+        return result
 
     def delete_group(self, group_id):
+        self.names.remove('groups', group_id)
         return self.request('DELETE', '/api/' + self.username + '/groups/' + str(group_id))
 
     # Scenes #####
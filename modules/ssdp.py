@@ -12,10 +12,20 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License..
 
+import io
+import selectors
 import socket
+import struct
+import threading
+import time
 from http.client import HTTPResponse
 import os
 
+# UPnP says devices must announce at least every 1800 seconds
+DEFAULT_MAX_AGE = 1800
+SSDP_GROUP = ("239.255.255.250", 1900)
+SIOCGIFADDR = 0x8915
+
 
 class SSDPResponse(object):
 
@@ -25,11 +35,36 @@ class SSDPResponse(object):
         self.location = r.getheader("location")
         self.usn = r.getheader("usn")
         self.st = r.getheader("st")
-        self.cache = r.getheader("cache-control").split("=")[1]
+        self.cache = (r.getheader("cache-control") or "").partition("=")[2]
+        try:
+            self.max_age = int(self.cache)
+        except ValueError:
+            self.max_age = DEFAULT_MAX_AGE
 
     def __repr__(self):
         return "<SSDPResponse({location}, {st}, {usn})>".format(**self.__dict__)
 
+    @classmethod
+    def from_bytes(cls, data):
+        return cls(_Datagram(data))
+
+
+class _Datagram(object):
+    """ Lets HTTPResponse parse a datagram that has already been received """
+    def __init__(self, data):
+        self.data = data
+
+    def makefile(self, mode):
+        return io.BytesIO(self.data)
+
+
+def search_message(service, mx, group=SSDP_GROUP):
+    return "\r\n".join([
+        'M-SEARCH * HTTP/1.1',
+        'HOST: {0}:{1}'.format(*group),
+        'MAN: "ssdp:discover"',
+        'ST: {0}'.format(service), 'MX: {0}'.format(mx), '', '']).encode()
+
 
 def discover(service, timeout=2, retries=1, mx=3):
     group = ("239.255.255.250", 1900)
@@ -38,10 +73,10 @@ def discover(service, timeout=2, retries=1, mx=3):
         'HOST: {0}:{1}',
         'MAN: "ssdp:discover"',
         'ST: {st}', 'MX: {mx}', '', ''])
-    socket.setdefaulttimeout(max(timeout, mx))
     responses = {}
     for _ in range(retries):
         sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        sock.settimeout(max(timeout, mx))
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 2)
         sock.sendto(message.format(*group, st=service, mx=mx).encode(), group)
@@ -51,9 +86,224 @@ def discover(service, timeout=2, retries=1, mx=3):
                 responses[response.location] = response
             except socket.timeout:
                 break
+        sock.close()
     return list(responses.values())
 
 
+def ipv4_interfaces():
+    """ IPv4 addresses of the local interfaces, loopback excluded """
+    addresses = set()
+    try:
+        import fcntl
+        for index, name in socket.if_nameindex():
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            try:
+                packed = fcntl.ioctl(sock.fileno(), SIOCGIFADDR, struct.pack('256s', name[:15].encode()))
+                addresses.add(socket.inet_ntoa(packed[20:24]))
+            except OSError:
+                pass  # interface without an IPv4 address
+            finally:
+                sock.close()
+    except (ImportError, AttributeError, OSError):
+        pass
+    if not addresses:
+        try:
+            addresses.update(socket.gethostbyname_ex(socket.gethostname())[2])
+        except OSError:
+            pass
+    addresses = sorted(address for address in addresses if not address.startswith('127.'))
+    return addresses or ['0.0.0.0']
+
+
+def scan(service, expected=None, quiet=0.5, timeout=3, mx=1, group=SSDP_GROUP, interfaces=None):
+    """ Send M-SEARCH on every IPv4 interface at once and yield responses as they arrive.
+    Responses are de-duplicated by USN. Stops after expected devices have
+    answered, when nothing new arrived for quiet seconds since the last
+    device, or after timeout seconds, whichever comes first.
+    """
+    if interfaces is None:
+        interfaces = ipv4_interfaces()
+    message = search_message(service, mx, group)
+    selector = selectors.DefaultSelector()
+    sockets = []
+    try:
+        for interface in interfaces:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+            sockets.append(sock)
+            try:
+                sock.setblocking(False)
+                sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 2)
+                sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(interface))
+                sock.bind((interface, 0))
+                sock.sendto(message, group)
+            except OSError:
+                continue  # interface went away or cannot multicast
+            selector.register(sock, selectors.EVENT_READ)
+
+        seen = set()
+        started = time.time()
+        deadline = started + timeout
+        last_new = None
+        while selector.get_map():
+            now = time.time()
+            wait = deadline - now
+            if last_new is not None:
+                wait = min(wait, last_new + quiet - now)
+            if wait <= 0:
+                break
+            for key, events in selector.select(wait):
+                try:
+                    data, address = key.fileobj.recvfrom(65507)
+                    response = SSDPResponse.from_bytes(data)
+                except (OSError, ValueError, AttributeError):
+                    continue  # not an HTTP response
+                response.address = address[0]
+                usn = response.usn or response.location
+                if usn in seen:
+                    continue
+                seen.add(usn)
+                last_new = time.time()
+                yield response
+                if expected is not None and len(seen) >= expected:
+                    return
+    finally:
+        selector.close()
+        for sock in sockets:
+            sock.close()
+
+
+def scan_all(service, callback=None, **options):
+    """ Run scan to completion, calling callback(response) for each device as it arrives """
+    responses = []
+    for response in scan(service, **options):
+        if callback is not None:
+            callback(response)
+        responses.append(response)
+    return responses
+
+
+class Responder(threading.Thread):
+
+    """ Minimal SSDP responder answering M-SEARCH for one device, for tests
+    and local development without a bridge on the network:
+        >>> responder = Responder('http://127.0.0.1:8080/description.xml', 'Philips Hue')
+        >>> responder.start()
+        >>> scan_all('Philips Hue', group=('127.0.0.1', responder.port), interfaces=['127.0.0.1'])
+    """
+    def __init__(self, location, st, usn=None, host='127.0.0.1', port=0, max_age=100, delay=0):
+        threading.Thread.__init__(self, name='ssdp-responder')
+        self.daemon = True
+        self.location = location
+        self.st = st
+        self.usn = usn or 'uuid:softhome-{0}::{1}'.format(id(self), st)
+        self.max_age = max_age
+        self.delay = delay
+        self.requests = 0
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((host, port))
+        self.port = self.sock.getsockname()[1]
+        self._stopped = False
+
+    def run(self):
+        self.sock.settimeout(0.1)
+        while not self._stopped:
+            try:
+                data, address = self.sock.recvfrom(65507)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            if not data.startswith(b'M-SEARCH'):
+                continue
+            self.requests += 1
+            st = ''
+            for line in data.decode('utf-8', 'replace').split('\r\n'):
+                key, _, value = line.partition(':')
+                if key.strip().upper() == 'ST':
+                    st = value.strip()
+            if st not in (self.st, 'ssdp:all'):
+                continue
+            if self.delay:
+                time.sleep(self.delay)
+            reply = "\r\n".join([
+                'HTTP/1.1 200 OK',
+                'CACHE-CONTROL: max-age={0}'.format(self.max_age),
+                'LOCATION: {0}'.format(self.location),
+                'ST: {0}'.format(self.st),
+                'USN: {0}'.format(self.usn), '', ''])
+            self.sock.sendto(reply.encode(), address)
+
+    def stop(self):
+        self._stopped = True
+        self.join()
+        self.sock.close()
+
+
+class DiscoveryService(threading.Thread):
+
+    """ Runs discovery for a service in the background every interval seconds
+    and keeps each device until its cache-control max-age runs out, so callers
+    can read the discovered devices without waiting on the network.
+    """
+    def __init__(self, service, interval=60, timeout=2, mx=3):
+        threading.Thread.__init__(self, name='ssdp-{0}'.format(service))
+        self.daemon = True
+        self.service = service
+        self.interval = interval
+        self.timeout = timeout
+        self.mx = mx
+        self.last_run = None
+        self._devices = {}  # location -> (response, expires)
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+
+    def run(self):
+        while True:
+            try:
+                # devices spread their answers over up to mx seconds, so a shorter
+                # quiet period would stop listening before the slower ones reply
+                found = scan_all(self.service, quiet=self.mx, timeout=max(self.timeout, self.mx), mx=self.mx)
+            except OSError:
+                found = []
+            now = time.time()
+            with self._lock:
+                for response in found:
+                    self._devices[response.location] = (response, now + response.max_age)
+                self.last_run = now
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    def refresh(self):
+        """ Run discovery again now instead of waiting for the interval """
+        self._wake.set()
+
+    def devices(self):
+        """ Responses from devices whose announcement has not expired """
+        now = time.time()
+        with self._lock:
+            for location in [l for l, (r, expires) in self._devices.items() if expires <= now]:
+                del self._devices[location]
+            return [response for response, expires in self._devices.values()]
+
+    def ip_addresses(self):
+        return [parse_ip_address(response.location) for response in self.devices()]
+
+
+_services = {}
+_services_lock = threading.Lock()
+
+
+def get_service(service, interval=60):
+    """ Returns the background discovery service for service, starting it on first use """
+    with _services_lock:
+        discovery = _services.get(service)
+        if discovery is None or not discovery.is_alive():
+            discovery = DiscoveryService(service, interval)
+            discovery.start()
+            _services[service] = discovery
+        return discovery
+
+
 def parse_ip_address(ip_string):
     start_i = ip_string.find('//')
 
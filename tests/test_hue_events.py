@@ -0,0 +1,68 @@
+import threading
+import time
+
+import pytest
+
+import hue_events
+
+MOTION = {'type': 'update', 'data': [{'type': 'motion', 'id_v1': '/sensors/5', 'motion': {'motion': True}}]}
+LIGHT = {'type': 'update', 'data': [{'type': 'light', 'id_v1': '/lights/3', 'on': {'on': True},
+                                     'dimming': {'brightness': 50.0}}]}
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            raise AssertionError('timed out')
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def server():
+    server = hue_events.EventServer()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def stream(server):
+    received = []
+    lock = threading.Lock()
+
+    def callback(updates):
+        with lock:
+            received.extend(hue_events.v1_updates(updates))
+    stream = hue_events.EventStream('127.0.0.1', 'user', callback, port=server.port, scheme='http', backoff=0.05)
+    stream.received = received
+    stream.start()
+    wait_for(lambda: server.clients() == 1)
+    yield stream
+    stream.stop()
+    stream.join(5)
+
+
+def test_events_reach_the_callback(server, stream):
+    server.publish([MOTION])
+    server.publish([LIGHT])
+    wait_for(lambda: len(stream.received) == 2)
+    assert stream.received == [('sensors', 5, {'presence': True}), ('lights', 3, {'on': True, 'bri': 127})]
+    assert stream.healthy()
+    assert stream.last_event_id == '2:0'
+
+
+def test_reconnect_resumes_after_last_event(server, stream):
+    server.publish([MOTION])
+    wait_for(lambda: len(stream.received) == 1)
+    server.drop_clients()
+    server.publish([LIGHT])
+    wait_for(lambda: len(stream.received) == 2)
+    assert server.resume_ids == ['1:0']
+    assert stream.connects == 2
+    assert stream.received[-1] == ('lights', 3, {'on': True, 'bri': 127})
+
+
+def test_v1_updates_skips_resources_without_v1_id():
+    updates = [{'type': 'motion', 'motion': {'motion': True}},
+               {'type': 'temperature', 'id_v1': '/sensors/7', 'temperature': {'temperature': 21.5}}]
+    assert list(hue_events.v1_updates(updates)) == [('sensors', 7, {'temperature': 2150})]
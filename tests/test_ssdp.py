@@ -0,0 +1,64 @@
+import time
+
+import pytest
+
+import ssdp
+
+HUE = 'Philips Hue'
+LOCAL = dict(interfaces=['127.0.0.1'], timeout=2)
+
+
+@pytest.fixture
+def responders():
+    started = []
+
+    def start(**options):
+        responder = ssdp.Responder('http://127.0.0.1:80/description.xml', HUE, **options)
+        responder.start()
+        started.append(responder)
+        return responder
+    yield start
+    for responder in started:
+        responder.stop()
+
+
+def test_scan_yields_the_responder(responders):
+    responder = responders()
+    found = list(ssdp.scan(HUE, group=('127.0.0.1', responder.port), **LOCAL))
+    assert len(found) == 1
+    assert found[0].location == responder.location
+    assert found[0].usn == responder.usn
+    assert found[0].max_age == responder.max_age
+    assert found[0].address == '127.0.0.1'
+    assert responder.requests == 1
+
+
+def test_scan_ignores_other_services(responders):
+    responder = responders()
+    assert list(ssdp.scan('roku:ecp', group=('127.0.0.1', responder.port), quiet=0.2, **LOCAL)) == []
+
+
+def test_scan_stops_once_expected_devices_answered(responders):
+    responder = responders(delay=0.05)
+    started = time.time()
+    found = list(ssdp.scan(HUE, expected=1, group=('127.0.0.1', responder.port), quiet=5, **LOCAL))
+    assert len(found) == 1
+    assert time.time() - started < 1
+
+
+def test_scan_stops_after_quiet_period(responders):
+    responder = responders()
+    started = time.time()
+    list(ssdp.scan(HUE, group=('127.0.0.1', responder.port), quiet=0.2, interfaces=['127.0.0.1'], timeout=5))
+    assert time.time() - started < 2
+
+
+def test_scan_all_deduplicates_and_calls_back(responders):
+    # two sockets on the same interface get the same device back twice
+    responder = responders()
+    seen = []
+    found = ssdp.scan_all(HUE, callback=seen.append, group=('127.0.0.1', responder.port),
+                          interfaces=['127.0.0.1', '127.0.0.1'], timeout=2)
+    assert [response.usn for response in found] == [responder.usn]
+    assert seen == found
+    assert responder.requests == 2